@@ -0,0 +1,231 @@
+"""
+    A local stand-in for a matrix homeserver.
+
+    Serves just enough of the client-server api to run the PhotOsClient end to end:
+    login, whoami, filters, key uploads, /sync, /messages and /download (with ranges).
+    Attachments are encrypted when they are added, so the measured time is spent
+    in the client and not in preparing the data. The rooms are unencrypted,
+    the media events carry encrypted attachments like in an encrypted room.
+"""
+import asyncio
+import time
+import uuid
+from typing import Dict, List, Optional
+from aiohttp import web
+from mautrix.crypto.attachments import encrypt_attachment
+
+USER_ID = '@frame:localhost'
+DEVICE_ID = 'BENCHMARK'
+SENDER = '@user:localhost'
+CLIENT_PATH = '/_matrix/client/r0'
+MEDIA_PATH = '/_matrix/media/r0'
+UNKNOWN_ROUTE_PATTERN = '/{tail:.*}'
+UNKNOWN_ROUTE = '/{tail}'
+
+
+def _error(status: int, errcode: str) -> web.Response:
+    return web.json_response({'errcode': errcode, 'error': errcode}, status=status)
+
+
+class FakeHomeserver:
+    """
+    the events of one room are handed out in sync batches of at most {sync_batch_size},
+    the number of requests per endpoint is counted in {requests}
+    """
+
+    def __init__(self, sync_batch_size: int = 50) -> None:
+        self.sync_batch_size = sync_batch_size
+        self.requests: Dict[str, int] = {}
+        self._batches: List[Dict[str, List[dict]]] = []
+        self._history: Dict[str, List[dict]] = {}
+        self._media: Dict[str, bytes] = {}
+        self._event_count = 0
+        self._new_batch = asyncio.Condition()
+        self._stopping = False
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application(middlewares=[self._count_requests])
+        self.app.router.add_post(f'{CLIENT_PATH}/login', self._login)
+        self.app.router.add_get(f'{CLIENT_PATH}/account/whoami', self._whoami)
+        self.app.router.add_post(f'{CLIENT_PATH}/user/{{user_id}}/filter', self._filter)
+        self.app.router.add_post(f'{CLIENT_PATH}/keys/upload', self._keys_upload)
+        self.app.router.add_post(f'{CLIENT_PATH}/keys/query', self._keys_query)
+        self.app.router.add_get(f'{CLIENT_PATH}/joined_rooms', self._joined_rooms)
+        self.app.router.add_get(f'{CLIENT_PATH}/sync', self._sync)
+        self.app.router.add_get(f'{CLIENT_PATH}/rooms/{{room_id}}/messages', self._messages)
+        self.app.router.add_put(f'{CLIENT_PATH}/rooms/{{room_id}}/send/{{event_type}}/{{txn_id}}',
+                                self._send)
+        self.app.router.add_get(f'{MEDIA_PATH}/download/{{server_name}}/{{media_id}}',
+                                self._download)
+        self.app.router.add_route('*', UNKNOWN_ROUTE_PATTERN, self._unknown)
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+
+    @property
+    def base_url(self) -> str:
+        (host, port) = self._runner.addresses[0][:2]
+        return f'http://{host}:{port}'
+
+    async def stop(self) -> None:
+        # ends the waiting sync requests, the shutdown would wait for them
+        self._stopping = True
+        await self._notify()
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _next_event_id(self) -> str:
+        self._event_count += 1
+        return f'${self._event_count}:localhost'
+
+    def _event(self, room_id: str, content: dict, sender: str = SENDER) -> dict:
+        return {'type': 'm.room.message',
+                'event_id': self._next_event_id(),
+                'room_id': room_id,
+                'sender': sender,
+                'origin_server_ts': int(time.time() * 1000),
+                'content': content}
+
+    # pylint: disable=too-many-arguments
+    def media_event(self,
+                    room_id: str,
+                    data: bytes,
+                    body: str,
+                    mimetype: str,
+                    msgtype: str = 'm.image',
+                    thumbnail: bytes = None) -> dict:
+        """
+        encrypts {data} and serves the ciphertext under a new mxc url,
+        an optional jpeg {thumbnail} is served the same way
+        """
+        info = {'mimetype': mimetype, 'size': len(data)}
+        if thumbnail:
+            info['thumbnail_file'] = self._add_media(thumbnail)
+            info['thumbnail_info'] = {'mimetype': 'image/jpeg', 'size': len(thumbnail)}
+        return self._event(room_id, {'msgtype': msgtype,
+                                     'body': body,
+                                     'info': info,
+                                     'file': self._add_media(data)})
+
+    def _add_media(self, data: bytes) -> dict:
+        (ciphertext, encrypted_file) = encrypt_attachment(data)
+        media_id = uuid.uuid4().hex
+        self._media[media_id] = ciphertext
+        encrypted_file.url = f'mxc://localhost/{media_id}'
+        return encrypted_file.serialize()
+
+    def text_event(self, room_id: str, body: str) -> dict:
+        return self._event(room_id, {'msgtype': 'm.text', 'body': body})
+
+    def push(self, room_id: str, events: List[dict]) -> None:
+        """
+        queues the events for the next sync responses
+        """
+        for start in range(0, len(events), self.sync_batch_size):
+            self._batches.append({room_id: events[start:start + self.sync_batch_size]})
+        asyncio.get_running_loop().create_task(self._notify())
+
+    def add_history(self, room_id: str, events: List[dict]) -> None:
+        """
+        appends the events to the history of the room which is served by /messages
+        """
+        self._history.setdefault(room_id, []).extend(events)
+
+    async def _notify(self) -> None:
+        async with self._new_batch:
+            self._new_batch.notify_all()
+
+    @web.middleware
+    async def _count_requests(self, request: web.Request, handler) -> web.Response:
+        name = request.match_info.route.resource.canonical
+        if name == UNKNOWN_ROUTE:
+            name = request.path
+        self.requests[name] = self.requests.get(name, 0) + 1
+        return await handler(request)
+
+    async def _login(self, _request: web.Request) -> web.Response:
+        return web.json_response({'user_id': USER_ID,
+                                  'device_id': DEVICE_ID,
+                                  'access_token': 'benchmark-token'})
+
+    async def _whoami(self, _request: web.Request) -> web.Response:
+        return web.json_response({'user_id': USER_ID, 'device_id': DEVICE_ID})
+
+    async def _filter(self, _request: web.Request) -> web.Response:
+        return web.json_response({'filter_id': 'benchmark-filter'})
+
+    async def _keys_upload(self, _request: web.Request) -> web.Response:
+        return web.json_response({'one_time_key_counts': {'signed_curve25519': 50}})
+
+    async def _keys_query(self, _request: web.Request) -> web.Response:
+        return web.json_response({'device_keys': {}, 'failures': {}})
+
+    async def _joined_rooms(self, _request: web.Request) -> web.Response:
+        rooms = set(self._history)
+        for batch in self._batches:
+            rooms.update(batch)
+        return web.json_response({'joined_rooms': sorted(rooms)})
+
+    async def _send(self, _request: web.Request) -> web.Response:
+        return web.json_response({'event_id': self._next_event_id()})
+
+    async def _sync(self, request: web.Request) -> web.Response:
+        """
+        the since token is the index of the next batch, without a new batch
+        the request waits like a long poll until the timeout
+        """
+        since = request.query.get('since', 's0')
+        index = int(since[1:])
+        timeout = int(request.query.get('timeout', '0')) / 1000
+        if index >= len(self._batches) and timeout:
+            async with self._new_batch:
+                try:
+                    await asyncio.wait_for(
+                        self._new_batch.wait_for(
+                            lambda: self._stopping or index < len(self._batches)),
+                        timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+        response = {'next_batch': since,
+                    'device_one_time_keys_count': {'signed_curve25519': 50}}
+        if index < len(self._batches):
+            batch = self._batches[index]
+            response['next_batch'] = f's{index + 1}'
+            response['rooms'] = {'join': {
+                room_id: {'timeline': {'events': events, 'limited': False},
+                          'state': {'events': []}}
+                for (room_id, events) in batch.items()}}
+        return web.json_response(response)
+
+    async def _messages(self, request: web.Request) -> web.Response:
+        """
+        pages backwards through the history, 'h<index>' tokens point into the
+        history and sync tokens start at the latest event
+        """
+        history = self._history.get(request.match_info['room_id'], [])
+        token = request.query.get('from', '')
+        end = int(token[1:]) if token.startswith('h') else len(history)
+        start = max(0, end - int(request.query.get('limit', '10')))
+        response = {'start': token, 'chunk': list(reversed(history[start:end]))}
+        if start > 0:
+            response['end'] = f'h{start}'
+        return web.json_response(response)
+
+    async def _download(self, request: web.Request) -> web.Response:
+        data = self._media.get(request.match_info['media_id'])
+        if data is None:
+            return _error(404, 'M_NOT_FOUND')
+        # only open ranges (bytes=<offset>-) are sent by the client
+        offset = request.http_range.start or 0
+        if offset >= len(data) > 0:
+            return _error(416, 'M_UNKNOWN')
+        return web.Response(body=data[offset:],
+                            status=206 if offset else 200,
+                            content_type='application/octet-stream')
+
+    async def _unknown(self, _request: web.Request) -> web.Response:
+        return _error(404, 'M_UNRECOGNIZED')
@@ -0,0 +1,444 @@
+"""
+    End to end benchmark of the media ingestion against a local fake homeserver.
+
+    Every scenario runs the PhotOsClient in a fresh process (so the peak RSS belongs
+    to the scenario) and reports events/s, MB/s, the p50/p99 store latency (from the
+    start of the download, including the wait for a download slot, until the file
+    is committed), the peak RSS and the event loop lag. The results can be saved as
+    a baseline, later runs are compared against it and fail when a metric is worse
+    than the tolerance.
+
+        python -m benchmarks.ingest_throughput --save-baseline
+        python -m benchmarks.ingest_throughput --scenario photo-burst --scale 0.5
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, cast
+from unittest import mock
+import aiohttp
+from mautrix.util.logging import TraceLogger
+from matrix_photos.configuration import (ConvertConfiguration,
+                                         MatrixConfiguration,
+                                         MessageConvertConfiguration)
+from matrix_photos.photos_client import PhotOsClient
+from matrix_photos.utils import DiskUsage
+from benchmarks.fake_homeserver import DEVICE_ID, SENDER, USER_ID, FakeHomeserver
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+ROOM_ID = '!benchmark:localhost'
+MEGABYTE = 1024 * 1024
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# metrics which are compared with the baseline, True if a higher value is better
+COMPARED_METRICS = {
+    'events_per_second': True,
+    'megabytes_per_second': True,
+    'store_latency_p50_ms': False,
+    'store_latency_p99_ms': False,
+    'peak_rss_mb': False,
+    'event_loop_lag_max_ms': False,
+    'display_avg_ms': False,
+}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    nearest rank percentile, 0 for no values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+class PhotoFactory:
+    """
+    creates unique photos of roughly the same size, with Pillow the photos are
+    real jpeg files so they can be converted and captioned
+    """
+
+    def __init__(self, width: int = 800, height: int = 600) -> None:
+        if Image:
+            image = Image.effect_noise((width, height), 64).convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=85)
+            self._template = buffer.getvalue()
+        else:
+            self._template = b'\xff\xd8\xff\xe0' + os.urandom(width * height // 4)
+        self._count = 0
+
+    def create(self) -> bytes:
+        # bytes after the end of the jpeg are ignored by the decoders
+        self._count += 1
+        return self._template + self._count.to_bytes(8, 'big') + os.urandom(8)
+
+
+class SimulatedDisk:
+    """
+    a disk of {capacity_mb} which is filled by the files of the media path,
+    replaces the free space of the real disk to trigger the eviction
+    """
+
+    def __init__(self, media_path: str, capacity_mb: float) -> None:
+        self.media_path = media_path
+        self.capacity = int(capacity_mb * MEGABYTE)
+
+    def used(self) -> int:
+        used = 0
+        for (directory, _, files) in os.walk(self.media_path):
+            for name in files:
+                try:
+                    used += os.path.getsize(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        return used
+
+    def __call__(self, _path: str) -> DiskUsage:
+        used = self.used()
+        return DiskUsage(self.capacity, used, max(0, self.capacity - used))
+
+
+class Scenario(NamedTuple):
+    description: str
+    # creates the live events, every phase is sent after the events before were handled
+    prepare: Callable[[FakeHomeserver, float], List[List[dict]]]
+    overrides: Dict = {}
+    # space for the media files (multiplied by the scale) above the eviction threshold,
+    # 0 uses the real disk
+    disk_capacity_mb: float = 0
+    backfill: bool = False
+    needs_pillow: bool = False
+
+
+def _photo_events(server: FakeHomeserver, count: int) -> List[dict]:
+    photos = PhotoFactory()
+    return [server.media_event(ROOM_ID, photos.create(), f'photo{index}.jpg', 'image/jpeg')
+            for index in range(count)]
+
+
+def prepare_photo_burst(server: FakeHomeserver, scale: float) -> List[List[dict]]:
+    return [_photo_events(server, max(1, int(200 * scale)))]
+
+
+def prepare_large_videos(server: FakeHomeserver, scale: float) -> List[List[dict]]:
+    return [[server.media_event(ROOM_ID, os.urandom(int(48 * MEGABYTE * min(1.0, scale))),
+                                f'video{index}.mp4', 'video/mp4', 'm.video')
+             for index in range(max(1, int(4 * scale)))]]
+
+
+def prepare_progressive_videos(server: FakeHomeserver, scale: float) -> List[List[dict]]:
+    return [[server.media_event(ROOM_ID, os.urandom(int(48 * MEGABYTE * min(1.0, scale))),
+                                f'video{index}.mp4', 'video/mp4', 'm.video',
+                                thumbnail=os.urandom(32 * 1024))
+             for index in range(max(1, int(4 * scale)))]]
+
+
+def prepare_caption_storm(server: FakeHomeserver, scale: float) -> List[List[dict]]:
+    # a caption is sent after its photo was stored, like typed by a user,
+    # only a text message right after a media message of the sender is a caption
+    phases = []
+    for (index, photo) in enumerate(_photo_events(server, max(1, int(50 * scale)))):
+        phases.append([photo])
+        phases.append([server.text_event(ROOM_ID, f'caption {index}')])
+    return phases
+
+
+def prepare_disk_full(server: FakeHomeserver, scale: float) -> List[List[dict]]:
+    return [_photo_events(server, max(1, int(150 * scale)))]
+
+
+def prepare_backfill(server: FakeHomeserver, scale: float) -> List[List[dict]]:
+    server.add_history(ROOM_ID, _photo_events(server, max(1, int(200 * scale))))
+    return []
+
+
+SCENARIOS = {
+    'photo-burst': Scenario('many photos in a few syncs', prepare_photo_burst),
+    'large-videos': Scenario('a few large videos', prepare_large_videos,
+                             {'max_download_size_mb': 1024,
+                              'allowed_mimetypes': ['image/jpeg', 'video/mp4']}),
+    'progressive-videos': Scenario('large videos whose thumbnails are shown first',
+                                   prepare_progressive_videos,
+                                   {'max_download_size_mb': 1024,
+                                    'allowed_mimetypes': ['image/jpeg', 'video/mp4'],
+                                    'progressive_ingest': True}),
+    'caption-storm': Scenario('photos which are captioned right away',
+                              prepare_caption_storm, needs_pillow=True),
+    'disk-full': Scenario('photos on a nearly full disk', prepare_disk_full,
+                          {'min_free_disk_space_mb': 2, 'eviction_headroom_mb': 2,
+                           'eviction_interval_seconds': 1},
+                          disk_capacity_mb=20),
+    'backfill': Scenario('import of the room history with /messages', prepare_backfill,
+                         {'backfill_downloads_per_minute': 0}, backfill=True),
+}
+
+
+def benchmark_configuration(base_url: str, workdir: str, overrides: Dict) -> MatrixConfiguration:
+    media_path = os.path.join(workdir, 'media')
+    os.makedirs(media_path)
+    values = {
+        'user_id': USER_ID,
+        'user_password': 'benchmark',
+        'device_id': DEVICE_ID,
+        'base_url': base_url,
+        'database_url': f'sqlite:///{os.path.join(workdir, "crypto.db")}',
+        'media_path': media_path,
+        'media_file': os.path.join(workdir, 'filelist.txt'),
+        'complete_media_file': os.path.join(workdir, 'complete_filelist.txt'),
+        'min_free_disk_space_mb': 0,
+        'max_file_count': 20,
+        'max_download_size_mb': 15,
+        'admin_user': '',
+        'trusted_users': [SENDER],
+        'convert': ConvertConfiguration(convert_on_save=False,
+                                        convert_binary='/usr/bin/convert',
+                                        convert_parameters=['-resize', '1280x768'],
+                                        backend='pillow'),
+        'message_convert': MessageConvertConfiguration(
+            write_text_messages=True,
+            convert_binary='/usr/bin/convert',
+            convert_text_parameter='text 20,60',
+            convert_parameters=['-resize', '1280x768', '-fill', 'blue',
+                                '-pointsize', '60', '-draw'],
+            caption_delay_seconds=0.5),
+        'allowed_mimetypes': ['image/jpeg'],
+        'random_response_messages': [],
+    }
+    values.update(overrides)
+    return MatrixConfiguration(**values)
+
+
+class LoopLagMonitor:
+    """
+    samples the delay of a short sleep, the lag is the time the sleep took too long
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+
+class EventRecorder:
+    """
+    wraps the message handler and the ingest pipeline of the client to count the
+    handled events and to measure the latency of every stored file
+    """
+
+    def __init__(self) -> None:
+        self.handled = 0
+        self.latencies: List[float] = []
+        self._changed = asyncio.Event()
+
+    def install_handler(self, client: PhotOsClient) -> None:
+        # has to be installed before initialize() registers the handler
+        handle_message = client._handle_message  # pylint: disable=protected-access
+
+        async def recorded_handle_message(evt) -> None:
+            await handle_message(evt)
+            self.handled += 1
+            self._changed.set()
+        client._handle_message = recorded_handle_message  # pylint: disable=protected-access
+
+    def install_pipeline(self, client: PhotOsClient) -> None:
+        ingest = client.ingest_pipeline.ingest
+
+        async def recorded_ingest(*args, **kwargs):
+            start = time.perf_counter()
+            target = await ingest(*args, **kwargs)
+            self.latencies.append(time.perf_counter() - start)
+            return target
+        client.ingest_pipeline.ingest = recorded_ingest
+
+    async def wait_for(self, count: int, timeout: float) -> None:
+        deadline = time.perf_counter() + timeout
+        while self.handled < count:
+            self._changed.clear()
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f'only {self.handled} of {count} events were handled')
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+# pylint: disable=too-many-arguments
+async def _run_client(config: MatrixConfiguration,
+                      server: FakeHomeserver,
+                      scenario: Scenario,
+                      phases: List[List[dict]],
+                      logger,
+                      timeout: float) -> Dict[str, float]:
+    async with aiohttp.ClientSession() as session:
+        client = PhotOsClient(config, session, logger)
+        recorder = EventRecorder()
+        recorder.install_handler(client)
+        await client.initialize()
+        recorder.install_pipeline(client)
+
+        lag = LoopLagMonitor()
+        lag.start()
+        start = time.perf_counter()
+        await client.start()
+        try:
+            events = 0
+            for phase in phases:
+                server.push(ROOM_ID, phase)
+                events += len(phase)
+                await recorder.wait_for(events, timeout)
+            if scenario.backfill:
+                events = (await client.run_backfill([ROOM_ID])).events
+            await client.text_message_command_handler.flush()
+            elapsed = time.perf_counter() - start
+        finally:
+            lag.stop()
+            await client.stop()
+
+    return {
+        'events': events,
+        'stored_files': client.metrics.stored_files.value,
+        'evicted_files': client.metrics.evicted_files.value,
+        'seconds': elapsed,
+        'events_per_second': events / elapsed,
+        'megabytes_per_second': client.metrics.download_bytes.value / MEGABYTE / elapsed,
+        'store_latency_p50_ms': percentile(recorder.latencies, 0.5) * 1000,
+        'store_latency_p99_ms': percentile(recorder.latencies, 0.99) * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'event_loop_lag_max_ms': max(lag.lags, default=0.0) * 1000,
+        'event_loop_lag_p99_ms': percentile(lag.lags, 0.99) * 1000,
+        'display_avg_ms': client.metrics.display_seconds.average * 1000,
+    }
+
+
+async def run_scenario(name: str, scale: float, timeout: float) -> Dict[str, float]:
+    scenario = SCENARIOS[name]
+    logger = cast(TraceLogger, logging.getLogger(f'benchmark.{name}'))
+    workdir = tempfile.mkdtemp(prefix='photos-benchmark-')
+    server = FakeHomeserver()
+    await server.start()
+    try:
+        phases = scenario.prepare(server, scale)
+        config = benchmark_configuration(server.base_url, workdir, scenario.overrides)
+        disk = SimulatedDisk(config.media_path,
+                             config.min_free_disk_space_mb + config.eviction_headroom_mb
+                             + scenario.disk_capacity_mb * scale)
+        simulated_disk = (mock.patch('matrix_photos.storage_strategy.disk_usage', disk)
+                          if scenario.disk_capacity_mb else contextlib.nullcontext())
+        with simulated_disk:
+            return await _run_client(config, server, scenario, phases, logger, timeout)
+    finally:
+        await server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_scenario_process(name: str, scale: float, timeout: float) -> Dict[str, float]:
+    logging.basicConfig(level=logging.ERROR)
+    return asyncio.run(run_scenario(name, scale, timeout))
+
+
+def compare(results: Dict[str, Dict[str, float]],
+            baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[str]:
+    """
+    returns the metrics which are worse than the baseline by more than {tolerance}
+    """
+    regressions = []
+    for (name, metrics) in results.items():
+        for (metric, higher_is_better) in COMPARED_METRICS.items():
+            previous = baseline.get(name, {}).get(metric)
+            if not previous:
+                continue
+            change = (metrics[metric] - previous) / previous
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f'{name} {metric}: {previous:.1f} -> {metrics[metric]:.1f} '
+                                   f'({change:+.0%})')
+    return regressions
+
+
+def print_results(name: str, metrics: Dict[str, float]) -> None:
+    print(f'{name}: {metrics["events"]} events in {metrics["seconds"]:.2f}s, '
+          f'{metrics["events_per_second"]:.1f} events/s, '
+          f'{metrics["megabytes_per_second"]:.1f} MB/s, '
+          f'store p50 {metrics["store_latency_p50_ms"]:.1f}ms '
+          f'p99 {metrics["store_latency_p99_ms"]:.1f}ms, '
+          f'peak rss {metrics["peak_rss_mb"]:.0f}MB, '
+          f'loop lag max {metrics["event_loop_lag_max_ms"]:.1f}ms, '
+          f'display avg {metrics["display_avg_ms"]:.1f}ms, '
+          f'{metrics["stored_files"]:.0f} stored, {metrics["evicted_files"]:.0f} evicted')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--scenario', action='append', dest='scenarios', choices=SCENARIOS)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the number and the size of the files')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative regression against the baseline')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        if SCENARIOS[name].needs_pillow and not Image:
+            print(f'{name}: skipped, Pillow is not installed')
+            continue
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[name] = executor.submit(run_scenario_process,
+                                            name, args.scale, args.timeout).result()
+        print_results(name, results[name])
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump({'scale': args.scale, 'results': results}, baseline_file, indent=2)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline, encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['scale'] != args.scale:
+        print(f'baseline was measured with scale {baseline["scale"]}, not compared')
+        return 0
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print(f'regression: {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
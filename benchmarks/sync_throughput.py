@@ -0,0 +1,78 @@
+"""
+    Sync processing throughput of the crypto database backends.
+
+    Simulates the database writes of sync responses (membership updates and the
+    sync token) against every given database url, sqlite urls are measured with
+    the default journal and with the tuned settings of the client.
+
+        python -m benchmarks.sync_throughput --syncs 200 --members 20 \\
+            --database-url sqlite:///tmp/bench.db --database-url postgres://user:pw@localhost/bench
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import List
+from mautrix.crypto import OlmAccount, PgCryptoStateStore, PgCryptoStore
+from mautrix.types import Membership, RoomID, SyncToken, UserID
+from matrix_photos.database import DatabaseSettings, create_database, start_database
+
+ACCOUNT_ID = '@benchmark:localhost'
+
+
+async def measure(settings: DatabaseSettings, syncs: int, members: int) -> float:
+    """
+    returns the processed syncs per second
+    """
+    database = create_database(settings)
+    await start_database(database, settings)
+    try:
+        state_store = PgCryptoStateStore(database)
+        await state_store.upgrade_table.upgrade(database)
+        crypto_store = PgCryptoStore(ACCOUNT_ID, 'benchmark', database)
+        await crypto_store.put_account(OlmAccount())
+
+        start = time.perf_counter()
+        for sync in range(syncs):
+            room_id = RoomID(f'!room{sync % 10}:localhost')
+            for member in range(members):
+                await state_store.set_membership(room_id,
+                                                 UserID(f'@user{member}:localhost'),
+                                                 Membership.JOIN)
+            await crypto_store.put_next_batch(SyncToken(f's{sync}'))
+        return syncs / (time.perf_counter() - start)
+    finally:
+        await database.stop()
+
+
+def benchmark_settings(database_urls: List[str]) -> List[DatabaseSettings]:
+    settings = []
+    for database_url in database_urls:
+        tuned = DatabaseSettings(database_url)
+        if tuned.is_sqlite:
+            settings.append(tuned._replace(sqlite_journal_mode='delete',
+                                           sqlite_synchronous='full'))
+        settings.append(tuned)
+    return settings
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--database-url', action='append', dest='database_urls')
+    parser.add_argument('--syncs', type=int, default=200)
+    parser.add_argument('--members', type=int, default=20)
+    args = parser.parse_args()
+
+    database_urls = args.database_urls or [
+        f'sqlite:///{os.path.join(tempfile.mkdtemp(), "benchmark.db")}']
+    for settings in benchmark_settings(database_urls):
+        rate = await measure(settings, args.syncs, args.members)
+        mode = (f' ({settings.sqlite_journal_mode}, {settings.sqlite_synchronous})'
+                if settings.is_sqlite else '')
+        print(f'{settings.database_url}{mode}: {rate:.1f} syncs/s, '
+              f'{rate * (args.members + 1):.0f} writes/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -10,8 +10,9 @@ import argparse
 import yaml
 from aiohttp import ClientSession
 from mautrix.util.logging import TraceLogger
-from .photos_client import PhotOsClient
+from .photos_client import AccountMismatchException, PhotOsClient
 from .configuration import MatrixConfiguration
+from .supervisor import Supervisor, load_account_configurations
 
 loop = asyncio.get_event_loop()
 
@@ -21,10 +22,17 @@ commandline_parser.add_argument("-c", "--config", type=str,
                                 default="~/config.yaml",
                                 required=True, metavar="<path>",
                                 help="the path to your config file")
+subcommands = commandline_parser.add_subparsers(dest="command")
+backfill_parser = subcommands.add_parser("backfill",
+                                         help="import the media history of the joined rooms "
+                                         "and exit, continues where the last backfill stopped")
+backfill_parser.add_argument("--room", action="append", dest="rooms", metavar="<room id>",
+                             help="only import this room (can be given several times)")
 
 args = commandline_parser.parse_args()
 
 PHOTOS_CLIENT = None
+SUPERVISOR = None
 HTTP_CLIENT = None
 CONFIG = None
 
@@ -45,14 +53,23 @@ async def main():
     global HTTP_CLIENT
     HTTP_CLIENT = ClientSession(loop=loop)
     global PHOTOS_CLIENT
+    global SUPERVISOR
     # pylint: enable=global-statement
 
+    if CONFIG.get("accounts"):
+        SUPERVISOR = Supervisor(load_account_configurations(CONFIG), HTTP_CLIENT, TRACE_LOGGER)
+        await SUPERVISOR.start()
+        return
+
     async def try_connect() -> bool:
+        # pylint: disable=broad-except
         try:
             await PHOTOS_CLIENT.initialize()
             await PHOTOS_CLIENT.start()
             return True
-        # pylint: disable=broad-except
+        except AccountMismatchException as exception:
+            TRACE_LOGGER.fatal(exception)
+            sys.exit(exception.exit_code)
         except Exception as exception:
             TRACE_LOGGER.exception(exception)
             return False
@@ -67,15 +84,50 @@ async def main():
         await asyncio.sleep(5)
 
 
+async def backfill() -> None:
+    # pylint: disable=global-statement
+    global HTTP_CLIENT
+    HTTP_CLIENT = ClientSession(loop=loop)
+    global PHOTOS_CLIENT
+    # pylint: enable=global-statement
+
+    for configuration in load_account_configurations(CONFIG):
+        PHOTOS_CLIENT = PhotOsClient(configuration, HTTP_CLIENT, TRACE_LOGGER)
+        try:
+            await PHOTOS_CLIENT.initialize()
+        except AccountMismatchException as exception:
+            TRACE_LOGGER.error('%s: %s, skip the backfill', configuration.user_id, exception)
+            await PHOTOS_CLIENT.stop()
+            continue
+        # the sync keeps running so room keys can arrive while the history is imported
+        await PHOTOS_CLIENT.start()
+        result = await PHOTOS_CLIENT.run_backfill(args.rooms)
+        print(f'{configuration.user_id}: {result}')
+        await PHOTOS_CLIENT.stop()
+        PHOTOS_CLIENT = None
+
+
 async def stop() -> None:
     logger.info('terminate client')
     if PHOTOS_CLIENT:
         await PHOTOS_CLIENT.stop()
 
+    if SUPERVISOR:
+        await SUPERVISOR.stop()
+
     if HTTP_CLIENT:
         await HTTP_CLIENT.close()
 
 # pylint: disable=broad-except
+if args.command == "backfill":
+    try:
+        loop.run_until_complete(backfill())
+        loop.run_until_complete(stop())
+        sys.exit(0)
+    except KeyboardInterrupt:
+        loop.run_until_complete(stop())
+        sys.exit(1)
+
 try:
     logger.info("Starting PhotOS Matrix Client")
     loop.run_until_complete(main())
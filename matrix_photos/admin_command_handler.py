@@ -1,26 +1,52 @@
+import os
 from enum import Enum
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
 from mautrix.types.event.message import MessageType, TextMessageEventContent
 from .utils import disk_usage, reread_files
 from .configuration import MatrixConfiguration
+from .storage_strategy import DefaultStorageStrategy
+from .metrics import Metrics
+from .diagnostics import Diagnostics
 
 class AdminCommands(str, Enum):
     HELP = '!help'
     REREAD = '!reread'
     STATS = '!stats'
+    BACKFILL = '!backfill'
+    FAVOURITE = '!favourite'
+    TRANSCODE = '!transcode'
+    PROFILE = '!profile'
+    HEAP = '!heap'
 
     @staticmethod
     def list():
         return list(map(lambda c: c.value, AdminCommands))
 
+    # pylint: disable=too-many-return-statements
     @staticmethod
     def get_description(command):
         if command == AdminCommands.HELP:
             return f'{command} - shows this message'
         if command == AdminCommands.REREAD:
-            return f'{command} - reread directory with images and create image text files'
+            return (f'{command} - reread directory with images, '
+                    'create image text files and rebuild the hash index')
         if command == AdminCommands.STATS:
             return f'{command} - show various statistics like free diskspace'
+        if command == AdminCommands.BACKFILL:
+            return (f'{command} [room ids] - import the media history of the given rooms '
+                    '(or all joined rooms), continues where the last backfill stopped')
+        if command == AdminCommands.FAVOURITE:
+            return (f'{command} [filename] - mark the latest (or the given) file as favourite, '
+                    'favourites are kept by the retention limits, again to remove the mark')
+        if command == AdminCommands.TRANSCODE:
+            return f'{command} - show the progress of the video transcode jobs'
+        if command == AdminCommands.PROFILE:
+            return (f'{command} start|stop - profile the client with cProfile, '
+                    'stop replies the functions with the most time and writes the profile')
+        if command == AdminCommands.HEAP:
+            return (f'{command} start|snapshot|stop - trace the memory with tracemalloc, '
+                    'snapshot replies the top allocation sites or the growth since '
+                    'the previous snapshot')
         return ''
 
     @staticmethod
@@ -30,9 +56,21 @@ class AdminCommands(str, Enum):
 
 class AdminCommandHandler:
 
-    def __init__(self, config: MatrixConfiguration, logger) -> None:
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 config: MatrixConfiguration,
+                 logger,
+                 storage_strategy: DefaultStorageStrategy = None,
+                 metrics: Metrics = None,
+                 start_backfill: Callable[[Optional[List[str]]], str] = None,
+                 transcode_status: Callable[[], str] = None) -> None:
         self.log = logger
         self.config = config
+        self.storage_strategy = storage_strategy
+        self.metrics = metrics
+        self.start_backfill = start_backfill
+        self.transcode_status = transcode_status
+        self.diagnostics = Diagnostics(config, logger)
 
     @staticmethod
     def _create_help_message() -> str:
@@ -41,15 +79,64 @@ class AdminCommandHandler:
     def _show_stats(self) -> str:
         stats = disk_usage(self.config.media_path)
         free_mb = stats.free / (1024*1024*1024)
-        return f'Free disk space (Gb): {free_mb}'
+        lines = [f'Free disk space (Gb): {free_mb}']
+        if self.storage_strategy:
+            media_stats = self.storage_strategy.media_index.stats()
+            lines.append(f'Media files: {media_stats.count}')
+            lines.append(f'Media size (Mb): {media_stats.size / (1024*1024):.1f}')
+        if self.metrics:
+            lines.append(self.metrics.summary())
+        return '\n'.join(lines)
 
     def _reread_files(self) -> str:
-        reread_files(self.config.media_path,
-                     self.config.media_file,
-                     self.config.complete_media_file,
-                     self.config.max_file_count)
+        if self.storage_strategy:
+            self.storage_strategy.media_index.rebuild()
+            self.storage_strategy.reread()
+        else:
+            reread_files(self.config.media_path,
+                         self.config.media_file,
+                         self.config.complete_media_file,
+                         self.config.max_file_count)
         return "Done reread files"
 
+    def _backfill(self, params: List[str]) -> str:
+        if not self.start_backfill:
+            return 'backfill is not available'
+        room_ids = [param for param in params if param.startswith('!')]
+        return self.start_backfill(room_ids or None)
+
+    def _toggle_favourite(self, params: List[str]) -> str:
+        if not self.storage_strategy:
+            return 'favourites are not available'
+        media_index = self.storage_strategy.media_index
+        path = (os.path.join(self.config.media_path, os.path.basename(params[0]))
+                if params else media_index.latest())
+        if not path:
+            return 'no media files stored'
+        favourite = not media_index.is_favourite(path)
+        if not media_index.set_favourite(path, favourite):
+            return f'{os.path.basename(path)} is not a stored media file'
+        return f'{os.path.basename(path)} is {"now" if favourite else "no longer"} a favourite'
+
+    def _profile(self, params: List[str]) -> str:
+        action = params[0] if params else ''
+        if action == 'start':
+            return self.diagnostics.start_profile()
+        if action == 'stop':
+            return self.diagnostics.stop_profile()
+        return AdminCommands.get_description(AdminCommands.PROFILE)
+
+    def _heap(self, params: List[str]) -> str:
+        action = params[0] if params else ''
+        if action == 'start':
+            return self.diagnostics.start_heap()
+        if action == 'snapshot':
+            return self.diagnostics.heap_snapshot()
+        if action == 'stop':
+            return self.diagnostics.stop_heap()
+        return AdminCommands.get_description(AdminCommands.HEAP)
+
+    # pylint: disable=too-many-return-statements
     def _handle_command(self, command: str, params: List) -> str:
         self.log.trace(f'_handle_command: {command}')
         self.log.trace(params)
@@ -60,6 +147,17 @@ class AdminCommandHandler:
                 return AdminCommandHandler._create_help_message()
             if command == AdminCommands.STATS:
                 return self._show_stats()
+            if command == AdminCommands.BACKFILL:
+                return self._backfill(params)
+            if command == AdminCommands.FAVOURITE:
+                return self._toggle_favourite(params)
+            if command == AdminCommands.TRANSCODE:
+                return (self.transcode_status() if self.transcode_status
+                        else 'transcoding is not available')
+            if command == AdminCommands.PROFILE:
+                return self._profile(params)
+            if command == AdminCommands.HEAP:
+                return self._heap(params)
         # pylint: disable=broad-except
         except Exception as exception:
             return str(exception)
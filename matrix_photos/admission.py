@@ -0,0 +1,109 @@
+"""
+    Admission control of the media downloads.
+
+    Before a download starts the mimetype and the size of the media event are checked
+    and the expected disk space is reserved. The expected space is the size of the file
+    and, for converted images, of the copy written by convert. The reservations of the
+    running downloads are subtracted from the free space, so parallel downloads can not
+    write more than the free space above {min_free_disk_space_mb}.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+from .configuration import MatrixConfiguration
+from .eviction import MEGABYTE
+from .metrics import Metrics
+from .storage_strategy import DefaultStorageStrategy
+
+
+class InsufficientDiskSpaceException(Exception):
+
+    def __init__(self, required_bytes, message="Not enough disk space for the download"):
+        self.required_bytes = required_bytes
+        self.message = f'{message}: {required_bytes} bytes'
+        super().__init__(self.message)
+
+
+class AdmissionController:
+    """
+    a download which does not fit into the free space evicts the eldest files ahead of
+    time, if that is not enough it is deferred until a running download is finished
+    """
+
+    def __init__(self,
+                 config: MatrixConfiguration,
+                 logger,
+                 storage_strategy: DefaultStorageStrategy,
+                 metrics: Metrics = None) -> None:
+        self._config = config
+        self.log = logger
+        self.storage_strategy = storage_strategy
+        self.metrics = metrics or Metrics()
+        self.reserved_bytes = 0
+        self._released = asyncio.Condition()
+
+    def expected_bytes(self, size: Optional[int], mimetype: Optional[str]) -> int:
+        """
+        the disk space a download takes until it is committed, without a known {size}
+        the {max_download_size_mb} is expected
+        """
+        size = size or self._config.max_download_size_mb * MEGABYTE
+        converted = self._config.derivative_size or self._config.convert.convert_on_save
+        if converted and (mimetype or '').startswith('image/'):
+            return 2 * size
+        return size
+
+    def available_bytes(self) -> int:
+        reserve = self._config.min_free_disk_space_mb * MEGABYTE
+        return self.storage_strategy.free_bytes() - reserve - self.reserved_bytes
+
+    def check(self, mimetype: Optional[str], size: Optional[int]) -> str:
+        """
+        decides without any network request whether a media event can be downloaded,
+        returns the reason why it is rejected or an empty string
+        """
+        if mimetype not in self._config.allowed_mimetypes:
+            return f'mimetype not allowed: {mimetype}'
+        if (size or 0) > self._config.max_download_size_mb * MEGABYTE:
+            return 'max download size exceeded'
+        # the stored files can be evicted and the reserved space is released,
+        # so only files which do not fit even then are rejected
+        evictable = self.storage_strategy.media_index.stats().size or 0
+        capacity = self.available_bytes() + self.reserved_bytes + evictable
+        if self.expected_bytes(size, mimetype) > capacity:
+            return 'not enough disk space'
+        return ''
+
+    async def _admit(self, required_bytes: int) -> None:
+        deferred = False
+        while required_bytes > self.available_bytes():
+            headroom = self._config.eviction_headroom_mb * MEGABYTE
+            if self.storage_strategy.evict_bytes(
+                    required_bytes - self.available_bytes() + headroom):
+                continue
+            if not self.reserved_bytes:
+                raise InsufficientDiskSpaceException(required_bytes)
+            if not deferred:
+                deferred = True
+                self.metrics.deferred_downloads.inc()
+                self.log.debug(f'defer download of {required_bytes} bytes')
+            await self._released.wait()
+        self.reserved_bytes += required_bytes
+        self.metrics.reserved_bytes.set(self.reserved_bytes)
+
+    @asynccontextmanager
+    async def reserve(self, size: Optional[int], mimetype: Optional[str]):
+        """
+        reserves the expected space of the file while it is downloaded and converted,
+        the {mimetype} of the media event decides whether the converted copy is expected
+        """
+        required_bytes = self.expected_bytes(size, mimetype)
+        async with self._released:
+            await self._admit(required_bytes)
+        try:
+            yield
+        finally:
+            async with self._released:
+                self.reserved_bytes -= required_bytes
+                self.metrics.reserved_bytes.set(self.reserved_bytes)
+                self._released.notify_all()
@@ -0,0 +1,118 @@
+"""
+    Streaming download and decryption of encrypted matrix attachments.
+
+    mautrix' download_media/decrypt_attachment keep the whole ciphertext
+    and the whole plaintext in memory, this module processes the attachment
+    chunk by chunk so memory usage does not depend on the attachment size.
+    An interrupted download continues with a range request after the
+    already decrypted part.
+"""
+import binascii
+import struct
+import time
+from http import HTTPStatus
+from typing import AsyncIterator
+import unpaddedbase64
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Util import Counter
+from mautrix.errors import DecryptionError
+from mautrix.types import EncryptedFile
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentDecryptor:
+    """
+    incremental AES-CTR decryption with a SHA-256 check of the ciphertext,
+    call update() for every chunk and verify() after the last one
+    """
+
+    def __init__(self, key: str, file_hash: str, vector: str) -> None:
+        # seconds spent in update(), used to tell decryption from download time
+        self.elapsed = 0.0
+        self.size = 0
+        self._expected_hash = unpaddedbase64.decode_base64(file_hash)
+        self._sha256 = SHA256.new()
+
+        try:
+            byte_key = unpaddedbase64.decode_base64(key)
+        except (binascii.Error, TypeError) as error:
+            raise DecryptionError("Error decoding key.") from error
+
+        try:
+            byte_iv = unpaddedbase64.decode_base64(vector)
+            prefix = byte_iv[:8]
+            initial_value = struct.unpack(">Q", byte_iv[8:])[0]
+        except (binascii.Error, TypeError, IndexError, struct.error) as error:
+            raise DecryptionError("Error decoding initial values.") from error
+
+        counter = Counter.new(64, prefix=prefix, initial_value=initial_value)
+        try:
+            self._cipher = AES.new(byte_key, AES.MODE_CTR, counter=counter)
+        except ValueError as error:
+            raise DecryptionError("Failed to create AES cipher") from error
+
+    @staticmethod
+    def from_encrypted_file(encrypted_file: EncryptedFile) -> 'AttachmentDecryptor':
+        return AttachmentDecryptor(encrypted_file.key.key,
+                                   encrypted_file.hashes['sha256'],
+                                   encrypted_file.iv)
+
+    def update(self, chunk: bytes) -> bytes:
+        start = time.perf_counter()
+        self.size += len(chunk)
+        self._sha256.update(chunk)
+        plaintext = self._cipher.decrypt(chunk)
+        self.elapsed += time.perf_counter() - start
+        return plaintext
+
+    def resume(self, plaintext: bytes) -> None:
+        """
+        advances over already decrypted data, the CTR decryption of the plaintext
+        returns the ciphertext which is needed for the hash
+        """
+        self._sha256.update(self._cipher.decrypt(plaintext))
+
+    def resume_from_file(self, filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+        """
+        advances over the decrypted data in {filename}, returns the offset of the download
+        """
+        offset = 0
+        with open(filename, 'rb') as binary_file:
+            for chunk in iter(lambda: binary_file.read(chunk_size), b''):
+                self.resume(chunk)
+                offset += len(chunk)
+        return offset
+
+    def verify(self) -> None:
+        if self._sha256.digest() != self._expected_hash:
+            raise DecryptionError("Mismatched SHA-256 digest.")
+
+
+async def iter_decrypted_media(client,
+                               encrypted_file: EncryptedFile,
+                               chunk_size: int = DEFAULT_CHUNK_SIZE,
+                               decryptor: AttachmentDecryptor = None,
+                               offset: int = 0) -> AsyncIterator[bytes]:
+    """
+    downloads the encrypted attachment and yields the decrypted chunks,
+    raises a DecryptionError after the last chunk if the hash does not match.
+    with an {offset} only the rest of the attachment is requested, the {decryptor}
+    has to be resumed to the offset, servers without range support send everything
+    """
+    decryptor = decryptor or AttachmentDecryptor.from_encrypted_file(encrypted_file)
+    url = client.api.get_download_url(encrypted_file.url)
+    headers = {'Range': f'bytes={offset}-'} if offset else None
+    async with client.api.session.get(url, headers=headers) as response:
+        # the previous download ended exactly at the end of the attachment
+        if not (offset and response.status == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE):
+            response.raise_for_status()
+            skip = offset if response.status != HTTPStatus.PARTIAL_CONTENT else 0
+            async for chunk in response.content.iter_chunked(chunk_size):
+                if skip:
+                    (chunk, skip) = (chunk[skip:], max(0, skip - len(chunk)))
+                    if not chunk:
+                        continue
+                yield decryptor.update(chunk)
+    decryptor.verify()
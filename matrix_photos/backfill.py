@@ -0,0 +1,177 @@
+"""
+    Import of the media history of the joined rooms.
+
+    The rooms are paged backwards with /messages, the encrypted events of a page are
+    decrypted together and the media is downloaded through the ingest pipeline.
+    The pagination token is saved in the media index after every page, so a large
+    history can be imported across restarts.
+"""
+import asyncio
+from typing import Callable, List, Optional, Tuple
+from mautrix.api import Method, Path
+from mautrix.errors import DecryptionError
+from mautrix.types import Event, EventType
+from mautrix.types.event.encrypted import EncryptedEvent
+from mautrix.types.event.message import MediaMessageEventContent
+from mautrix.types.filter import RoomEventFilter
+from mautrix.types.misc import PaginationDirection
+from mautrix.types.primitive import RoomID, SyncToken
+from .configuration import MatrixConfiguration
+from .ingest_pipeline import IngestPipeline
+from .storage_strategy import DefaultStorageStrategy
+
+# pylint: disable=no-member, unexpected-keyword-arg
+MESSAGE_FILTER = RoomEventFilter(types=[EventType.ROOM_MESSAGE, EventType.ROOM_ENCRYPTED])
+# pylint: enable=no-member, unexpected-keyword-arg
+
+
+class BackfillResult:
+
+    def __init__(self) -> None:
+        self.events = 0
+        self.stored = 0
+        self.duplicates = 0
+        self.undecryptable = 0
+
+    def __str__(self) -> str:
+        return (f'{self.events} events, {self.stored} files stored, '
+                f'{self.duplicates} duplicates, {self.undecryptable} not decryptable')
+
+
+class Backfill:
+    """
+    pages through the history with {backfill_page_size} events per request and starts
+    at most {backfill_downloads_per_minute} downloads per minute (0 means no limit),
+    the downloads of one page run concurrently in the ingest pipeline
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 config: MatrixConfiguration,
+                 logger,
+                 client,
+                 ingest_pipeline: IngestPipeline,
+                 storage_strategy: DefaultStorageStrategy,
+                 accept: Callable[[object], bool]) -> None:
+        self.config = config
+        self.log = logger
+        self.client = client
+        self.ingest_pipeline = ingest_pipeline
+        self.storage_strategy = storage_strategy
+        self.accept = accept
+        self._next_download = 0.0
+
+    async def _throttle(self) -> None:
+        if self.config.backfill_downloads_per_minute <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self._next_download)
+        self._next_download = start + 60 / self.config.backfill_downloads_per_minute
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _decrypt_event(self, evt):
+        if isinstance(evt, EncryptedEvent):
+            return await self.client.crypto.decrypt_megolm_event(evt)
+        return evt
+
+    async def _decrypt(self, events: List, result: BackfillResult) -> List:
+        """
+        decrypts the events of one page at once, events without room keys are skipped
+        """
+        decrypted = await asyncio.gather(*(self._decrypt_event(evt) for evt in events),
+                                         return_exceptions=True)
+        readable = []
+        for (evt, decrypted_event) in zip(events, decrypted):
+            if isinstance(decrypted_event, DecryptionError):
+                result.undecryptable += 1
+                self.log.trace(f'backfill: can not decrypt {evt.event_id}: {decrypted_event}')
+            elif isinstance(decrypted_event, BaseException):
+                raise decrypted_event
+            else:
+                readable.append(decrypted_event)
+        return readable
+
+    async def _ingest(self, room_id: RoomID, evt, result: BackfillResult) -> None:
+        await self._throttle()
+        target = await self.ingest_pipeline.ingest(room_id,
+                                                   evt.content.file,
+                                                   str(evt.content.body),
+                                                   evt.timestamp / 1000,
+                                                   evt.sender,
+                                                   size=evt.content.info.size,
+                                                   mimetype=evt.content.info.mimetype)
+        if target:
+            result.stored += 1
+        else:
+            result.duplicates += 1
+
+    async def _import_page(self, room_id: RoomID, events: List, result: BackfillResult) -> int:
+        """
+        stores the media of one page, returns the number of new media events
+        """
+        media_events = [evt for evt in await self._decrypt(events, result)
+                        if isinstance(evt.content, MediaMessageEventContent) and self.accept(evt)]
+        new_events = []
+        for evt in reversed(media_events):
+            if self.storage_strategy.find_duplicate(evt.content.file.hashes['sha256']):
+                result.duplicates += 1
+            else:
+                new_events.append(evt)
+        await asyncio.gather(*(self._ingest(room_id, evt, result) for evt in new_events))
+        return len(new_events)
+
+    async def _get_messages(self,
+                            room_id: RoomID,
+                            token: SyncToken) -> Tuple[List, Optional[SyncToken]]:
+        """
+        one page of older events and the token of the next page,
+        the request is sent directly since the homeserver omits the end token
+        at the beginning of the history which client.get_messages does not accept
+        """
+        content = await self.client.api.request(
+            Method.GET,
+            Path.rooms[room_id].messages,
+            query_params={'from': token,
+                          'dir': PaginationDirection.BACKWARD.value,
+                          'limit': str(self.config.backfill_page_size),
+                          'filter': MESSAGE_FILTER.json()})
+        events = [Event.deserialize(event)  # pylint: disable=no-member
+                  for event in content.get('chunk', [])]
+        return (events, content.get('end'))
+
+    async def backfill_room(self, room_id: RoomID, result: BackfillResult) -> None:
+        """
+        continues at the saved pagination token, a room whose history was imported
+        completely is only paged until the first page without new media
+        """
+        media_index = self.storage_strategy.media_index
+        (token, done) = media_index.backfill_state(room_id)
+        if done or not token:
+            token = await self.client.sync_store.get_next_batch()
+
+        while True:
+            (events, end) = await self._get_messages(room_id, token)
+            result.events += len(events)
+            new_media = await self._import_page(room_id, events, result)
+
+            if not end or end == token:
+                media_index.set_backfill_state(room_id, None, True)
+                break
+
+            token = end
+            media_index.set_backfill_state(room_id, token, done and not new_media)
+            if done and not new_media:
+                break
+        self.log.info(f'backfill of {room_id} finished')
+
+    async def run(self, room_ids: List[RoomID] = None) -> BackfillResult:
+        """
+        imports the history of the given rooms or of all joined rooms
+        """
+        result = BackfillResult()
+        for room_id in room_ids or await self.client.get_joined_rooms():
+            await self.backfill_room(room_id, result)
+        self.storage_strategy.reread()
+        return result
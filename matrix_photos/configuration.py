@@ -1,10 +1,14 @@
-from typing import List, NamedTuple, Dict
+from typing import List, NamedTuple, Dict, Sequence
 
 
 class ConvertConfiguration(NamedTuple):
     convert_on_save: bool
     convert_binary: str
     convert_parameters: List[str]
+    max_concurrent_jobs: int = 1
+    max_queued_jobs: int = 16
+    job_timeout_seconds: int = 120
+    backend: str = 'subprocess'
 
 
 class MessageConvertConfiguration(NamedTuple):
@@ -12,6 +16,22 @@ class MessageConvertConfiguration(NamedTuple):
     convert_binary: str
     convert_text_parameter: str
     convert_parameters: List[str]
+    caption_delay_seconds: float = 2.0
+
+
+class TranscodeConfiguration(NamedTuple):
+    enabled: bool = False
+    ffmpeg_binary: str = '/usr/bin/ffmpeg'
+    ffprobe_binary: str = '/usr/bin/ffprobe'
+    # tuples, the defaults are shared by all instances
+    mimetypes: Sequence[str] = ('video/mp4', 'video/quicktime')
+    ffmpeg_parameters: Sequence[str] = ('-vf', "scale='min(1920,iw)':-2",
+                                        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+                                        '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+                                        '-movflags', '+faststart')
+    target_extension: str = '.mp4'
+    max_concurrent_jobs: int = 1
+    job_timeout_seconds: int = 3600
 
 
 class MatrixConfiguration(NamedTuple):
@@ -32,6 +52,34 @@ class MatrixConfiguration(NamedTuple):
     message_convert: MessageConvertConfiguration
     allowed_mimetypes: List[str]
     random_response_messages: List[str]
+    max_parallel_downloads: int = 4
+    download_retries: int = 3
+    progressive_ingest: bool = False
+    eviction_headroom_mb: int = 0
+    eviction_interval_seconds: int = 300
+    metrics_host: str = '127.0.0.1'
+    metrics_port: int = 0
+    max_pending_decryptions: int = 500
+    pending_decryption_ttl_seconds: int = 3600
+    derivative_size: str = ''
+    derivative_cache_mb: int = 0
+    database_pool_min_size: int = 0
+    database_pool_max_size: int = 0
+    sqlite_journal_mode: str = 'wal'
+    sqlite_synchronous: str = 'normal'
+    sqlite_cache_size_kb: int = 2048
+    sync_filter: bool = True
+    sync_timeline_limit: int = 50
+    sync_lazy_load_members: bool = True
+    backfill_page_size: int = 100
+    backfill_downloads_per_minute: int = 60
+    retention_max_total_mb: int = 0
+    retention_max_age_days: int = 0
+    retention_room_quota_mb: int = 0
+    retention_sender_quota_mb: int = 0
+    retention_keep_favourites: bool = True
+    diagnostics_path: str = ''
+    transcode: TranscodeConfiguration = TranscodeConfiguration()
 
     @staticmethod
     def from_dict(data: Dict):
@@ -40,4 +88,6 @@ class MatrixConfiguration(NamedTuple):
         convert = ConvertConfiguration(**convert_dict)
         message_convert_dict = clone.pop('message_convert')
         message_convert = MessageConvertConfiguration(**message_convert_dict)
-        return MatrixConfiguration(**clone, convert=convert, message_convert=message_convert)
+        transcode = TranscodeConfiguration(**clone.pop('transcode', {}))
+        return MatrixConfiguration(**clone, convert=convert, message_convert=message_convert,
+                                   transcode=transcode)
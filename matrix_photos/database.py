@@ -0,0 +1,93 @@
+"""
+    Creation of the crypto database.
+
+    The pool size can be configured for both backends, SQLite databases are switched
+    to the write ahead log and a relaxed synchronous mode, so a sync response does not
+    cause one fsync per written row on the SD card of a photo frame.
+"""
+from contextlib import AsyncExitStack
+from typing import Any, Dict, NamedTuple
+from urllib.parse import urlparse
+from mautrix.crypto import PgCryptoStateStore, PgCryptoStore
+from mautrix.util.async_db import Database as AsyncDatabase
+from .configuration import MatrixConfiguration
+
+SQLITE_SCHEMES = ('sqlite', 'sqlite3')
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+
+
+class DatabaseSettings(NamedTuple):
+    database_url: str
+    pool_min_size: int = 0
+    pool_max_size: int = 0
+    sqlite_journal_mode: str = 'wal'
+    sqlite_synchronous: str = 'normal'
+    sqlite_cache_size_kb: int = 2048
+
+    @staticmethod
+    def from_configuration(config: MatrixConfiguration) -> 'DatabaseSettings':
+        return DatabaseSettings(config.database_url,
+                                config.database_pool_min_size,
+                                config.database_pool_max_size,
+                                config.sqlite_journal_mode,
+                                config.sqlite_synchronous,
+                                config.sqlite_cache_size_kb)
+
+    @property
+    def is_sqlite(self) -> bool:
+        return urlparse(self.database_url).scheme in SQLITE_SCHEMES
+
+    @property
+    def sqlite_connections(self) -> int:
+        return max(1, self.pool_min_size)
+
+    def database_args(self) -> Dict[str, Any]:
+        """
+        the pool arguments, the driver defaults are used for sizes of 0
+        """
+        if self.is_sqlite:
+            return {'min_size': self.sqlite_connections}
+        args = {}
+        if self.pool_min_size:
+            args['min_size'] = self.pool_min_size
+        if self.pool_max_size:
+            args['max_size'] = max(self.pool_min_size, self.pool_max_size)
+        return args
+
+
+def create_database(settings: DatabaseSettings, logger=None) -> AsyncDatabase:
+    return AsyncDatabase.create(settings.database_url,
+                                db_args=settings.database_args(),
+                                upgrade_table=PgCryptoStore.upgrade_table,
+                                log=logger)
+
+
+async def _tune_sqlite(database: AsyncDatabase, settings: DatabaseSettings) -> None:
+    journal_mode = settings.sqlite_journal_mode.lower()
+    synchronous = settings.sqlite_synchronous.lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f'unknown sqlite journal mode {settings.sqlite_journal_mode}')
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f'unknown sqlite synchronous mode {settings.sqlite_synchronous}')
+
+    # the pragmas (except the journal mode) only apply to one connection,
+    # so all connections of the pool are taken at once
+    async with AsyncExitStack() as stack:
+        for _ in range(settings.sqlite_connections):
+            connection = await stack.enter_async_context(database.acquire())
+            await connection.execute(f'PRAGMA journal_mode={journal_mode}')
+            await connection.execute(f'PRAGMA synchronous={synchronous}')
+            await connection.execute(f'PRAGMA cache_size=-{int(settings.sqlite_cache_size_kb)}')
+            await connection.execute('PRAGMA temp_store=memory')
+
+
+async def start_database(database: AsyncDatabase, settings: DatabaseSettings) -> None:
+    """
+    connects the pool and upgrades the tables, the sqlite connections are tuned afterwards.
+    a database which is shared by several clients is started once before the clients
+    """
+    await database.start()
+    await PgCryptoStateStore.upgrade_table.upgrade(database)
+    if settings.is_sqlite:
+        await _tune_sqlite(database, settings)
@@ -0,0 +1,131 @@
+"""
+    Queue for events which can not be decrypted yet.
+
+    Usually the megolm session of an event arrives shortly after the event itself,
+    so undecryptable events are kept until the matching m.room_key or
+    m.forwarded_room_key arrives and are decrypted in one batch then.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+from mautrix.errors import DecryptionError
+from mautrix.types.event.encrypted import EncryptedEvent
+from mautrix.types.primitive import SessionID
+from .metrics import Metrics
+
+
+class PendingDecryptionQueue:
+    """
+    keeps at most {max_events} events for at most {ttl_seconds} seconds,
+    only one room key request is sent per session no matter how many events are waiting
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 client,
+                 logger,
+                 metrics: Metrics,
+                 max_events: int = 500,
+                 ttl_seconds: int = 3600) -> None:
+        self.client = client
+        self.log = logger
+        self.metrics = metrics
+        self.max_events = max_events
+        self.ttl_seconds = ttl_seconds
+        self._pending: 'OrderedDict[SessionID, List[Tuple[float, EncryptedEvent]]]' = OrderedDict()
+        self._waiters: Dict[SessionID, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return sum(len(events) for events in self._pending.values())
+
+    def _drop_eldest(self) -> None:
+        session_id = next(iter(self._pending))
+        events = self._pending[session_id]
+        (_, evt) = events.pop(0)
+        if not events:
+            del self._pending[session_id]
+        self.metrics.decryption_failures.inc()
+        self.log.warn(f'pending decryption queue full, dropped event {evt.event_id}')
+
+    def add(self, evt: EncryptedEvent) -> None:
+        session_id = evt.content.session_id
+        while len(self) >= self.max_events:
+            self._drop_eldest()
+
+        self._pending.setdefault(session_id, []).append((time.monotonic() + self.ttl_seconds, evt))
+        if session_id not in self._waiters:
+            self._waiters[session_id] = asyncio.create_task(self._wait_for_session(evt))
+
+    async def _request_room_key(self, evt: EncryptedEvent) -> None:
+        try:
+            self.log.trace(f'request room keys for session {evt.content.session_id}')
+            self.metrics.room_key_requests.inc()
+            await self.client.crypto.request_room_key(
+                evt.room_id,
+                evt.content.sender_key,
+                evt.content.session_id,
+                from_devices={evt.sender: [evt.content.device_id]},
+                timeout=0)
+        # pylint: disable=broad-except
+        except Exception as error:
+            self.log.error(error)
+        # pylint: enable=broad-except
+
+    async def _has_session(self, evt: EncryptedEvent) -> bool:
+        return await self.client.crypto.crypto_store.has_group_session(
+            evt.room_id, evt.content.sender_key, evt.content.session_id)
+
+    async def _wait_for_session(self, evt: EncryptedEvent) -> None:
+        session_id = evt.content.session_id
+        try:
+            received = await self._has_session(evt)
+            if not received:
+                await self._request_room_key(evt)
+            while not received and self._pending.get(session_id):
+                remaining = max(expires for (expires, _) in self._pending[session_id])
+                received = await self.client.crypto.wait_for_session(
+                    evt.room_id,
+                    evt.content.sender_key,
+                    session_id,
+                    timeout=max(0.0, remaining - time.monotonic()))
+                if not received:
+                    self._expire(session_id)
+
+            if received:
+                await self._decrypt_pending(session_id)
+        # pylint: disable=broad-except
+        except Exception as error:
+            self.log.error(error)
+        # pylint: enable=broad-except
+        finally:
+            del self._waiters[session_id]
+
+    def _expire(self, session_id: SessionID) -> None:
+        now = time.monotonic()
+        events = self._pending.get(session_id, [])
+        alive = [(expires, evt) for (expires, evt) in events if expires > now]
+        for _ in range(len(events) - len(alive)):
+            self.metrics.decryption_failures.inc()
+        if alive:
+            self._pending[session_id] = alive
+        else:
+            self._pending.pop(session_id, None)
+            self.log.warn(f'no room keys received for session {session_id}, dropped events')
+
+    async def _decrypt_pending(self, session_id: SessionID) -> None:
+        events = self._pending.pop(session_id, [])
+        self.log.trace(f'room keys for session {session_id} received, '
+                       f'decrypt {len(events)} events')
+        for (_, evt) in events:
+            try:
+                decrypted = await self.client.crypto.decrypt_megolm_event(evt)
+                self.client.dispatch_event(decrypted, evt.source)
+            except DecryptionError as error:
+                self.metrics.decryption_failures.inc()
+                self.log.error(f'failed to decrypt {evt.event_id}: {error}')
+
+    async def stop(self) -> None:
+        for waiter in self._waiters.values():
+            waiter.cancel()
+        await asyncio.gather(*self._waiters.values(), return_exceptions=True)
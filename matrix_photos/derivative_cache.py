@@ -0,0 +1,123 @@
+"""
+    Cache of display sized copies of the stored media.
+
+    The originals are kept untouched, the copies are stored in a hidden directory
+    of the media_path, named by the content hash of the original and the target size.
+"""
+import os
+from collections import OrderedDict
+from typing import Optional
+from .file_convert import FileConvert
+
+DERIVATIVE_DIRECTORY = '.derivatives'
+
+
+class DerivativeCache:
+    """
+    creates the copies with the configured convert backend and keeps the
+    total size of the cache below {max_bytes} by deleting the least recently used copies
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 media_path: str,
+                 size: str,
+                 max_bytes: int,
+                 convert: FileConvert,
+                 convert_params,
+                 logger) -> None:
+        self.log = logger
+        self.size = size
+        self.max_bytes = max_bytes
+        self.convert = convert
+        self.convert_params = [*convert_params, '-resize', f'{size}>']
+        self.directory = os.path.join(media_path, DERIVATIVE_DIRECTORY)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self.total_bytes = 0
+        with os.scandir(self.directory) as entries:
+            files = [(entry.stat().st_mtime, entry.path, entry.stat().st_size)
+                     for entry in entries if entry.is_file() and not entry.name.startswith('.')]
+        for (_, path, file_size) in sorted(files):
+            self._entries[path] = file_size
+            self.total_bytes += file_size
+
+    def path_for(self, plaintext_sha256: str, original: str) -> str:
+        (_, ext) = os.path.splitext(original)
+        return os.path.join(self.directory, f'{plaintext_sha256}_{self.size}{ext}')
+
+    def lookup(self, plaintext_sha256: Optional[str], original: str) -> Optional[str]:
+        """
+        the cached copy of the {original} or None if there is no copy
+        """
+        if not plaintext_sha256:
+            return None
+        path = self.path_for(plaintext_sha256, original)
+        if path not in self._entries:
+            return None
+        self._entries.move_to_end(path)
+        return path
+
+    async def create(self, plaintext_sha256: str, source: str) -> Optional[str]:
+        """
+        creates the copy of {source} (if it is not cached yet) through a hidden temporary file,
+        returns None when the conversion failed
+        """
+        path = self.lookup(plaintext_sha256, source)
+        if path:
+            return path
+
+        path = self.path_for(plaintext_sha256, source)
+        temp_filename = os.path.join(self.directory, f'.{os.path.basename(path)}')
+        await self.convert.convert_file(source, self.convert_params, target=temp_filename)
+        if not os.path.isfile(temp_filename):
+            return None
+        os.replace(temp_filename, path)
+
+        file_size = os.path.getsize(path)
+        self._entries[path] = file_size
+        self.total_bytes += file_size
+        return path
+
+    def size_of(self, plaintext_sha256: Optional[str], original: str) -> int:
+        if not plaintext_sha256:
+            return 0
+        return self._entries.get(self.path_for(plaintext_sha256, original), 0)
+
+    def _remove(self, path: str) -> int:
+        file_size = self._entries.pop(path, 0)
+        self.total_bytes -= file_size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return file_size
+
+    def remove(self, plaintext_sha256: Optional[str], original: str) -> int:
+        """
+        removes the copy of a deleted original, returns the freed bytes
+        """
+        if not plaintext_sha256:
+            return 0
+        return self._remove(self.path_for(plaintext_sha256, original))
+
+    def evict(self, required_bytes: int) -> int:
+        """
+        deletes the least recently used copies until {required_bytes} are freed
+        """
+        freed = 0
+        while freed < required_bytes and self._entries:
+            freed += self._remove(next(iter(self._entries)))
+        return freed
+
+    def enforce_limit(self) -> int:
+        """
+        deletes the least recently used copies when the cache is larger than {max_bytes},
+        returns the freed bytes
+        """
+        if self.max_bytes <= 0 or self.total_bytes <= self.max_bytes:
+            return 0
+        freed = self.evict(self.total_bytes - self.max_bytes)
+        self.log.trace(f'evicted {freed} bytes from the derivative cache')
+        return freed
@@ -0,0 +1,124 @@
+"""
+    On-demand profiling of the running client.
+
+    A cProfile session profiles the event loop between start and stop, tracemalloc
+    snapshots show where memory is allocated and what grew since the previous snapshot.
+    The replies contain the top entries, the full dumps are written to the
+    {diagnostics_path} (by default media_path/.diagnostics) for pstats or tracemalloc.
+"""
+import cProfile
+import os
+import pstats
+import tracemalloc
+from datetime import datetime
+from typing import List, Optional
+from .configuration import MatrixConfiguration
+
+DIAGNOSTICS_DIRECTORY = '.diagnostics'
+TOP_ENTRIES = 10
+# the allocations of the import machinery and of tracemalloc itself are not interesting
+TRACEMALLOC_FILTERS = [
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+]
+
+
+def _location(filename: str, lineno: int) -> str:
+    return f'{os.path.basename(os.path.dirname(filename))}/{os.path.basename(filename)}:{lineno}'
+
+
+class Diagnostics:
+    """
+    runs at most one cProfile session and one tracemalloc trace at a time
+    """
+
+    def __init__(self, config: MatrixConfiguration, logger) -> None:
+        self._config = config
+        self.log = logger
+        self._profile: Optional[cProfile.Profile] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def directory(self) -> str:
+        return (self._config.diagnostics_path
+                or os.path.join(self._config.media_path, DIAGNOSTICS_DIRECTORY))
+
+    def _dump_path(self, prefix: str, ext: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f'{prefix}-{datetime.now():%Y%m%d-%H%M%S-%f}{ext}')
+
+    def start_profile(self) -> str:
+        if self._profile:
+            return 'profiling is already running'
+        profile = cProfile.Profile()
+        profile.enable()
+        self._profile = profile
+        return 'profiling started, send !profile stop for the results'
+
+    def stop_profile(self) -> str:
+        """
+        writes the profile and returns the functions with the most own time
+        """
+        if not self._profile:
+            return 'profiling is not running'
+        (profile, self._profile) = (self._profile, None)
+        profile.disable()
+        path = self._dump_path('profile', '.prof')
+        profile.dump_stats(path)
+        self.log.info(f'profile written to {path}')
+
+        # (filename, line, function): (primitive calls, calls, own time, cumulative time, callers)
+        entries = sorted(pstats.Stats(profile).stats.items(),
+                         key=lambda entry: entry[1][2],
+                         reverse=True)[:TOP_ENTRIES]
+        lines = [f'{own:.3f}s {cumulative:.3f}s {calls}x {function} ({_location(filename, line)})'
+                 for ((filename, line, function), (_, calls, own, cumulative, _)) in entries]
+        return '\n'.join([f'top functions by own time (own, cumulative, calls), '
+                          f'full profile in {path}', *lines])
+
+    def start_heap(self) -> str:
+        if tracemalloc.is_tracing():
+            return 'tracemalloc is already running'
+        tracemalloc.start()
+        self._snapshot = None
+        return 'tracemalloc started, send !heap snapshot for the allocation sites'
+
+    def heap_snapshot(self) -> str:
+        """
+        writes a snapshot and returns the largest allocation sites,
+        after the first snapshot the sites which grew the most since the previous snapshot
+        """
+        if not tracemalloc.is_tracing():
+            return 'tracemalloc is not running, send !heap start first'
+        snapshot = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS)
+        path = self._dump_path('heap', '.snapshot')
+        snapshot.dump(path)
+        self.log.info(f'heap snapshot written to {path}')
+
+        lines: List[str] = []
+        if self._snapshot:
+            lines.append(f'top growth since the previous snapshot, full snapshot in {path}')
+            for stat in snapshot.compare_to(self._snapshot, 'lineno')[:TOP_ENTRIES]:
+                frame = stat.traceback[0]
+                lines.append(f'{stat.size_diff / 1024:+.1f} KiB {stat.count_diff:+d} blocks '
+                             f'{_location(frame.filename, frame.lineno)}')
+        else:
+            lines.append(f'top allocation sites, full snapshot in {path}')
+            for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]:
+                frame = stat.traceback[0]
+                lines.append(f'{stat.size / 1024:.1f} KiB {stat.count} blocks '
+                             f'{_location(frame.filename, frame.lineno)}')
+        self._snapshot = snapshot
+        (current, peak) = tracemalloc.get_traced_memory()
+        lines.append(f'traced memory {current / (1024*1024):.1f} MiB, '
+                     f'peak {peak / (1024*1024):.1f} MiB')
+        return '\n'.join(lines)
+
+    def stop_heap(self) -> str:
+        if not tracemalloc.is_tracing():
+            return 'tracemalloc is not running'
+        tracemalloc.stop()
+        self._snapshot = None
+        return 'tracemalloc stopped'
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+from mautrix.types.primitive import EventID, RoomID, UserID
+from .room_order import RoomOrder
+
+
+class EventHistory:
+    """
+    remembers per room and sender whether the latest message was a media message
+    and the encrypted hash of the latest media message, filled from the live sync
+    stream so the server has only to be asked after a restart.
+    the messages are recorded in the order of the sync, also when their decryptions
+    finish in another order
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        # (is_media, encrypted_sha256 of the latest media message)
+        self._latest: 'OrderedDict[Tuple[RoomID, UserID], Tuple[bool, Optional[str]]]' = \
+            OrderedDict()
+        # the order of the encrypted events is reserved before they are decrypted
+        self._order = RoomOrder()
+
+    def reserve(self, room_id: RoomID, event_id: EventID) -> None:
+        """
+        reserves the position of the event before it is decrypted, an event which is
+        not recorded has to be released with release
+        """
+        self._order.reserve(room_id, event_id)
+
+    def release(self, event_id: EventID) -> None:
+        self._order.release_reserved(event_id)
+
+    def record(self,
+               room_id: RoomID,
+               sender: UserID,
+               is_media: bool,
+               encrypted_sha256: str = None) -> Optional[bool]:
+        """
+        stores the type of the new message and returns whether the message before was
+        a media message, or None when there was no message of the sender since the start
+        """
+        key = (room_id, sender)
+        (previous, media_sha256) = self._latest.pop(key, (None, None))
+        self._latest[key] = (is_media, encrypted_sha256 if is_media else media_sha256)
+        if len(self._latest) > self.max_entries:
+            self._latest.popitem(last=False)
+        return previous
+
+    # pylint: disable=too-many-arguments
+    async def record_in_order(self,
+                              room_id: RoomID,
+                              sender: UserID,
+                              is_media: bool,
+                              encrypted_sha256: str = None,
+                              event_id: EventID = None) -> Tuple[Optional[bool], Optional[str]]:
+        """
+        records the message after the messages of the room before {event_id} like record,
+        returns also the encrypted hash of the latest media message before the message
+        """
+        async with self._order.in_order(room_id, event_id):
+            media_sha256 = self.media_sha256(room_id, sender)
+            return (self.record(room_id, sender, is_media, encrypted_sha256), media_sha256)
+
+    def media_sha256(self, room_id: RoomID, sender: UserID) -> Optional[str]:
+        """
+        the encrypted hash of the latest media message of the sender
+        """
+        return self._latest.get((room_id, sender), (None, None))[1]
@@ -0,0 +1,35 @@
+from typing import Iterable, List, NamedTuple, Tuple
+
+MEGABYTE = 1024 * 1024
+
+
+class EvictionPlan(NamedTuple):
+    files: List[str]
+    size: int
+
+
+def bytes_to_free(free_bytes: int, threshold_mb: int, target_mb: int) -> int:
+    """
+    number of bytes which have to be deleted to get {target_mb} of free space,
+    0 as long as there are at least {threshold_mb} free
+    """
+    if threshold_mb <= 0 or free_bytes >= threshold_mb * MEGABYTE:
+        return 0
+    return max(0, target_mb * MEGABYTE - free_bytes)
+
+
+def plan_eviction(candidates: Iterable[Tuple[str, int]], required_bytes: int) -> EvictionPlan:
+    """
+    takes (path, size) tuples, the eldest first, until their sizes cover {required_bytes}
+    """
+    files = []
+    size = 0
+    if required_bytes <= 0:
+        return EvictionPlan(files, size)
+
+    for (path, file_size) in candidates:
+        files.append(path)
+        size += file_size or 0
+        if size >= required_bytes:
+            break
+    return EvictionPlan(files, size)
@@ -1,39 +1,246 @@
-import subprocess
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+from .configuration import ConvertConfiguration
+from .metrics import Metrics
+from .image_operations import ImageOperations, apply_image_operations, is_available
+
+
+class ThreadTimeoutError(asyncio.TimeoutError):
+    """
+    a function run in the thread pool timed out, the {thread} is still running
+    """
+
+    def __init__(self, thread: asyncio.Future) -> None:
+        self.thread = thread
+        super().__init__()
+
+
+class ConvertPool:
+    """
+    runs the convert jobs (asyncio subprocesses or functions in a thread pool) so the
+    event loop is not blocked, at most {max_concurrent_jobs} jobs run at the same time and
+    at most {max_queued_jobs} jobs are waiting, callers have to wait until there is room
+    in the queue
+    """
+
+    def __init__(self, config: ConvertConfiguration, logger, metrics: Metrics = None) -> None:
+        self.log = logger
+        self.metrics = metrics or Metrics()
+        self.max_workers = max(1, config.max_concurrent_jobs)
+        self.timeout = config.job_timeout_seconds
+        self._queue = asyncio.Queue(maxsize=max(1, config.max_queued_jobs))
+        self._workers: List[asyncio.Task] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._threads: Set[asyncio.Future] = set()
+        self.active_jobs = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _start_workers(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker())
+                             for _ in range(self.max_workers)]
+
+    async def _run_process(self, params: List[str]) -> Tuple[int, str, str]:
+        process = await asyncio.create_subprocess_exec(*params,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        return (process.returncode,
+                stdout.decode(errors='replace'),
+                stderr.decode(errors='replace'))
+
+    async def _worker(self) -> None:
+        while True:
+            job, future = await self._queue.get()
+            self.active_jobs += 1
+            try:
+                with self.metrics.convert_seconds.time():
+                    result = await job()
+                if not future.done():
+                    future.set_result(result)
+            except ThreadTimeoutError as error:
+                # the caller gets its own exception, the traceback of {error} holds this frame
+                if not future.done():
+                    future.set_exception(asyncio.TimeoutError())
+                # a thread can not be stopped, so the slot is kept until it is finished
+                await asyncio.gather(error.thread, return_exceptions=True)
+            except Exception as error:  # pylint: disable=broad-except
+                if not future.done():
+                    future.set_exception(error)
+            finally:
+                if not future.done():
+                    future.cancel()
+                self.active_jobs -= 1
+                self._queue.task_done()
+
+    async def submit(self, job: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        queues the job and waits until it is finished
+        """
+        self._start_workers()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((job, future))
+        self.log.trace(f'convert queue depth {self.queue_depth}')
+        return await future
+
+    async def run(self, params: List[str]) -> Tuple[int, str, str]:
+        """
+        queues the command and waits until it is finished,
+        returns the returncode, stdout and stderr of the process
+        """
+        return await self.submit(lambda: self._run_process(params))
+
+    async def run_in_executor(self, function: Callable, *args) -> Any:
+        """
+        queues the function which is run in a thread pool with {max_concurrent_jobs} threads,
+        raises a TimeoutError after {job_timeout_seconds} but the thread keeps its slot until
+        the function returns
+        """
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix='convert')
+        loop = asyncio.get_running_loop()
+
+        async def job():
+            thread = loop.run_in_executor(self._executor, function, *args)
+            self._threads.add(thread)
+            thread.add_done_callback(self._threads.discard)
+            try:
+                return await asyncio.wait_for(asyncio.shield(thread), self.timeout)
+            except asyncio.TimeoutError as error:
+                raise ThreadTimeoutError(thread) from error
+
+        return await self.submit(job)
+
+    async def stop(self) -> None:
+        """
+        stops the workers, the running and the queued jobs are cancelled
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while not self._queue.empty():
+            (_, future) = self._queue.get_nowait()
+            future.cancel()
+            self._queue.task_done()
+        if self._executor:
+            # a function which is not running yet is cancelled, a running one is finished
+            for thread in self._threads:
+                thread.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class SubprocessConvertBackend:
+    """
+    runs the configured convert binary (usually ImageMagick) for every conversion
+    """
+
+    def __init__(self, convert_binary: str, logger, pool: ConvertPool) -> None:
+        self.log = logger
+        self.convert_binary = convert_binary
+        self.pool = pool
+
+    # pylint: disable=too-many-arguments
+    async def convert(self,
+                      filename,
+                      convert_params,
+                      message=None,
+                      convert_text_parameter: str = None,
+                      target: str = None):
+        text = []
+
+        if message:
+            msg = f"'{message}'"
+            text.append(f'{convert_text_parameter} {msg}')
+
+        params = [
+            self.convert_binary,
+            *convert_params,
+            *text,
+            f'{filename}',
+            f'{target or filename}'
+        ]
+
+        (returncode, stdout, stderr) = await self.pool.run(params)
+        self.log.trace(stdout)
+        self.log.trace(stderr)
+        if returncode != 0:
+            self.log.error(f'{self.convert_binary} exited with {returncode}: {stderr}')
+
+
+class PillowConvertBackend:
+    """
+    converts the images in-process with Pillow in the thread pool of the ConvertPool,
+    falls back to the subprocess backend for convert parameters Pillow does not support
+    """
+
+    def __init__(self, logger, pool: ConvertPool, fallback: SubprocessConvertBackend) -> None:
+        self.log = logger
+        self.pool = pool
+        self.fallback = fallback
+
+    # pylint: disable=too-many-arguments
+    async def convert(self,
+                      filename,
+                      convert_params,
+                      message=None,
+                      convert_text_parameter: str = None,
+                      target: str = None):
+        operations = ImageOperations.from_convert_parameters(
+            convert_params, convert_text_parameter if message else None)
+        if operations.unsupported:
+            self.log.warn(f'unsupported convert parameters for pillow {operations.unsupported}, '
+                          f'use {self.fallback.convert_binary}')
+            return await self.fallback.convert(filename, convert_params,
+                                               message, convert_text_parameter, target)
+
+        return await self.pool.run_in_executor(apply_image_operations,
+                                               filename, operations, message, target)
 
 
 class FileConvert:
 
-    def __init__(self, convert_binary: str, logger) -> None:
+    def __init__(self,
+                 convert_binary: str,
+                 logger,
+                 pool: ConvertPool,
+                 backend: str = 'subprocess') -> None:
         self.log = logger
         self.convert_binary = convert_binary
+        self.pool = pool
+        self.backend = SubprocessConvertBackend(convert_binary, logger, pool)
+        if backend == 'pillow':
+            if is_available():
+                self.backend = PillowConvertBackend(logger, pool, self.backend)
+            else:
+                self.log.error('pillow convert backend configured but Pillow is not installed')
 
-    def convert_file(self,
-                     filename,
-                     convert_params,
-                     message=None,
-                     convert_text_parameter: str = None):
+    # pylint: disable=too-many-arguments
+    async def convert_file(self,
+                           filename,
+                           convert_params,
+                           message=None,
+                           convert_text_parameter: str = None,
+                           target: str = None):
+        """
+        converts {filename} in place or into {target}
+        """
         try:
             self.log.trace(f'convert_file {filename}')
-
-            text = []
-
-            if message:
-                msg = f"'{message}'"
-                text.append(f'{convert_text_parameter} {msg}')
-
-            params = [
-                self.convert_binary,
-                *convert_params,
-                *text,
-                f'{filename}',
-                f'{filename}'
-            ]
-
-            result = subprocess.run(
-                params, capture_output=True, text=True, check=True)
-            self.log.trace(result.stdout)
-            self.log.trace(result.stderr)
-        #pylint: disable=broad-except
-        except Exception as error:
+            await self.backend.convert(filename, convert_params, message, convert_text_parameter,
+                                       target)
+        except asyncio.TimeoutError:
+            self.log.error(f'convert_file {filename} timed out after {self.pool.timeout}s')
+        except Exception as error:  # pylint: disable=broad-except
             self.log.error(error)
-        #pylint: enable=broad-except
@@ -0,0 +1,165 @@
+"""
+    In-process image conversion with Pillow.
+
+    Supports the subset of the convert parameters which is used for photo frames
+    (-auto-orient, -resize, -quality, -strip and the text options for captions),
+    the image is decoded once, all operations are applied and it is encoded once.
+"""
+import os
+import re
+import tempfile
+from typing import List, NamedTuple, Optional, Tuple
+from .utils import set_default_mode
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageOps
+    LANCZOS = getattr(Image, 'Resampling', Image).LANCZOS
+except ImportError:
+    Image = None
+
+FLAGS = ('-auto-orient', '-strip')
+OPTIONS = ('-resize', '-quality', '-font', '-fill', '-pointsize', '-draw')
+RESIZE_PATTERN = re.compile(r'^(?P<width>\d*)(x(?P<height>\d*))?(?P<percent>%)?(?P<flag>[<>!^]?)$')
+TEXT_PATTERN = re.compile(r'^text\s+(?P<x>-?\d+),(?P<y>-?\d+)$')
+DEFAULT_FONTS = ('DejaVuSans.ttf', 'Arial.ttf')
+
+
+def is_available() -> bool:
+    return Image is not None
+
+
+class ImageOperations(NamedTuple):
+    auto_orient: bool = False
+    strip: bool = False
+    resize: Optional[str] = None
+    quality: Optional[int] = None
+    font: Optional[str] = None
+    fill: str = 'black'
+    pointsize: int = 12
+    text_position: Tuple[int, int] = (0, 0)
+    unsupported: Tuple[str, ...] = ()
+
+    @staticmethod
+    def from_convert_parameters(convert_params: List[str],
+                                convert_text_parameter: str = None) -> 'ImageOperations':
+        values = {}
+        unsupported = []
+        params = list(convert_params)
+        while params:
+            param = params.pop(0)
+            if param in FLAGS:
+                values[param[1:].replace('-', '_')] = True
+            elif param == '-draw' and not params:
+                # the text is appended after -draw by the message convert
+                pass
+            elif param in OPTIONS and params:
+                values[param[1:]] = params.pop(0)
+            else:
+                unsupported.append(param)
+
+        if convert_text_parameter:
+            match = TEXT_PATTERN.match(convert_text_parameter.strip())
+            if match:
+                values['text_position'] = (int(match['x']), int(match['y']))
+            else:
+                unsupported.append(convert_text_parameter)
+
+        _validate_values(values, unsupported)
+        return ImageOperations(**values, unsupported=tuple(unsupported))
+
+
+def _validate_values(values: dict, unsupported: List[str]) -> None:
+    if 'draw' in values:
+        unsupported.extend(['-draw', values.pop('draw')])
+    if 'resize' in values and not RESIZE_PATTERN.match(values['resize']):
+        unsupported.extend(['-resize', values.pop('resize')])
+    for numeric in ('quality', 'pointsize'):
+        if numeric in values:
+            try:
+                values[numeric] = int(values[numeric])
+            except ValueError:
+                unsupported.extend([f'-{numeric}', values.pop(numeric)])
+
+
+def _resize_size(size: Tuple[int, int], geometry: str) -> Optional[Tuple[int, int]]:
+    match = RESIZE_PATTERN.match(geometry)
+    (width, height) = size
+    target_width = int(match['width']) if match['width'] else None
+    target_height = int(match['height']) if match['height'] else None
+
+    if match['percent']:
+        scale_x = (target_width or 100) / 100
+        scale_y = (target_height or target_width or 100) / 100
+        return (max(1, round(width * scale_x)), max(1, round(height * scale_y)))
+    if match['flag'] == '!' and target_width and target_height:
+        return (target_width, target_height)
+
+    scales = [target / current for (target, current)
+              in ((target_width, width), (target_height, height)) if target]
+    if not scales:
+        return None
+    scale = max(scales) if match['flag'] == '^' else min(scales)
+    if (match['flag'] == '>' and scale >= 1) or (match['flag'] == '<' and scale <= 1):
+        return None
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+
+def _load_font(operations: ImageOperations):
+    candidates = []
+    if operations.font:
+        candidates.extend([operations.font, f'{operations.font}.ttf'])
+    candidates.extend(DEFAULT_FONTS)
+    for candidate in candidates:
+        try:
+            return ImageFont.truetype(candidate, operations.pointsize)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+def apply_image_operations(filename: str,
+                           operations: ImageOperations,
+                           message: str = None,
+                           target: str = None) -> None:
+    """
+    decodes {filename}, applies the operations and writes the result to {target}
+    (or back to {filename}) through a temporary file
+    """
+    target = target or filename
+    with Image.open(filename) as source:
+        image_format = source.format
+        image = source
+        if operations.auto_orient:
+            image = ImageOps.exif_transpose(image)
+
+        if operations.resize:
+            size = _resize_size(image.size, operations.resize)
+            if size and size != image.size:
+                image = image.resize(size, LANCZOS)
+
+        if message:
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB')
+            draw = ImageDraw.Draw(image)
+            draw.text(operations.text_position, message, fill=operations.fill,
+                      font=_load_font(operations), anchor='ls')
+
+        save_args = {}
+        if operations.quality:
+            save_args['quality'] = operations.quality
+        exif = image.getexif()
+        if exif and not operations.strip:
+            save_args['exif'] = exif.tobytes()
+
+        (_, ext) = os.path.splitext(target)
+        (handle, temp_filename) = tempfile.mkstemp(prefix='.', suffix=ext,
+                                                   dir=os.path.dirname(os.path.abspath(target)))
+        set_default_mode(handle)
+        os.close(handle)
+        try:
+            image.save(temp_filename, format=image_format, **save_args)
+            os.replace(temp_filename, target)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
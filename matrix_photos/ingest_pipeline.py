@@ -0,0 +1,349 @@
+"""
+    Concurrent ingestion of media events.
+
+    Downloads, decryption and conversion of several events run in parallel,
+    the files are committed to the media files in the order the events
+    were received per room. Interrupted downloads are continued where they
+    stopped, also after a restart.
+"""
+import asyncio
+import json
+import mimetypes
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+import aiohttp
+from mautrix.errors import DecryptionError
+from mautrix.types import EncryptedFile
+from mautrix.types.primitive import EventID, RoomID
+from .admission import AdmissionController
+from .attachment_stream import AttachmentDecryptor, iter_decrypted_media
+from .media_index import JournalEntry
+from .room_order import RoomOrder
+from .storage_strategy import DefaultStorageStrategy, StagedFile
+from .metrics import Metrics
+from .transcode_queue import TranscodeQueue
+
+# delay before the first retry of a failed download, it grows with every retry
+RETRY_SECONDS = 2
+
+
+class Thumbnail(NamedTuple):
+    """
+    the encrypted thumbnail of a media event, it is shown until the file is stored
+    """
+    file: EncryptedFile
+    mimetype: str
+
+
+class StageTimings:
+    """
+    collects the number of runs, the total and the maximum duration per stage
+    """
+
+    STAGES = ('download', 'decrypt', 'convert', 'wait', 'commit')
+
+    def __init__(self) -> None:
+        self.count = {stage: 0 for stage in StageTimings.STAGES}
+        self.total = {stage: 0.0 for stage in StageTimings.STAGES}
+        self.max = {stage: 0.0 for stage in StageTimings.STAGES}
+
+    def add(self, stage: str, seconds: float, durations: Dict[str, float] = None) -> None:
+        if durations is not None:
+            durations[stage] = seconds
+        self.count[stage] += 1
+        self.total[stage] += seconds
+        self.max[stage] = max(self.max[stage], seconds)
+
+    @contextmanager
+    def measure(self, stage: str, durations: Dict[str, float]):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, durations)
+
+    def summary(self) -> str:
+        lines = []
+        for stage in StageTimings.STAGES:
+            count = self.count[stage]
+            average = self.total[stage] / count if count else 0.0
+            lines.append(f'{stage}: {count} runs, avg {average:.3f}s, max {self.max[stage]:.3f}s')
+        return '\n'.join(lines)
+
+
+# pylint: disable=too-many-instance-attributes
+class IngestPipeline:
+    """
+    runs at most {max_parallel_downloads} downloads at the same time and only
+    as many as the {admission} has disk space for,
+    the stored videos are handed to the {transcode_queue},
+    every event waits for the previous event of the same room before it is committed,
+    the pending events are recorded in the ingest journal of the media index,
+    the thumbnails of the events are shown while the files are downloaded
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 client,
+                 storage_strategy: DefaultStorageStrategy,
+                 max_parallel_downloads: int,
+                 logger,
+                 metrics: Metrics = None,
+                 download_retries: int = 3,
+                 admission: AdmissionController = None,
+                 transcode_queue: TranscodeQueue = None) -> None:
+        self.client = client
+        self.admission = admission
+        self.transcode_queue = transcode_queue
+        self.download_retries = download_retries
+        self.storage_strategy = storage_strategy
+        self.log = logger
+        self.metrics = metrics or Metrics()
+        self.timings = StageTimings()
+        self._download_slots = asyncio.Semaphore(max(1, max_parallel_downloads))
+        # the order of the encrypted events is reserved before they are decrypted
+        self._order = RoomOrder()
+        self._resumable_downloads: Set[str] = set()
+        self._thumbnail_tasks: Dict[str, asyncio.Task] = {}
+
+    def reserve_order(self, room_id: RoomID, event_id: EventID) -> None:
+        """
+        reserves the position of the event in the room before it is decrypted, the
+        decryptions finish in any order. the ingest of {event_id} takes the position,
+        an event which is not ingested has to be released with release_order
+        """
+        self._order.reserve(room_id, event_id)
+
+    async def wait_for_previous(self, room_id: RoomID, event_id: EventID = None) -> None:
+        """
+        waits until the events of the room before {event_id} are committed or failed
+        """
+        async with self._order.in_order(room_id, event_id):
+            pass
+
+    def release_order(self, event_id: EventID) -> None:
+        self._order.release_reserved(event_id)
+
+    async def _download(self,
+                        encrypted_file: EncryptedFile,
+                        filename: str,
+                        resumable: bool) -> Tuple[Optional[StagedFile], AttachmentDecryptor]:
+        """
+        downloads into the part file of the attachment, a download which breaks off is
+        continued with a range request up to {download_retries} times, a continued
+        download which does not match the hash is downloaded again from the start.
+        a download which is not {resumable} uses a temporary file and starts from the
+        beginning again
+        """
+        encrypted_sha256 = encrypted_file.hashes['sha256']
+        part_filename = (self.storage_strategy.part_filename(encrypted_sha256, filename)
+                         if resumable else None)
+        attempt = 0
+        while True:
+            decryptor = AttachmentDecryptor.from_encrypted_file(encrypted_file)
+            offset = (decryptor.resume_from_file(part_filename)
+                      if part_filename and os.path.exists(part_filename) else 0)
+            if offset:
+                self.log.debug(f'continue download of {filename} at {offset} bytes')
+            try:
+                staged = await self.storage_strategy.stage(
+                    iter_decrypted_media(self.client, encrypted_file,
+                                         decryptor=decryptor, offset=offset),
+                    filename,
+                    encrypted_sha256,
+                    part_filename)
+                return (staged, decryptor)
+            except DecryptionError:
+                if part_filename and os.path.exists(part_filename):
+                    os.remove(part_filename)
+                if not offset:
+                    raise
+                self.log.warn(f'continued download of {filename} is corrupt, start again')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if attempt >= self.download_retries:
+                    raise
+                attempt += 1
+                self.log.warn(f'download of {filename} failed: {error}, '
+                              f'continue in {RETRY_SECONDS * attempt}s')
+                await asyncio.sleep(RETRY_SECONDS * attempt)
+
+    async def _timed_download(self,
+                              encrypted_file: EncryptedFile,
+                              filename: str,
+                              resumable: bool,
+                              durations: Dict[str, float]) -> Optional[StagedFile]:
+        async with self._download_slots:
+            start = time.perf_counter()
+            (staged, decryptor) = await self._download(encrypted_file, filename, resumable)
+            elapsed = time.perf_counter() - start
+        self.timings.add('download', elapsed - decryptor.elapsed, durations)
+        self.timings.add('decrypt', decryptor.elapsed, durations)
+        self.metrics.download_bytes.inc(decryptor.size)
+        self.metrics.download_seconds.observe(durations['download'])
+        self.metrics.decrypt_seconds.observe(durations['decrypt'])
+        return staged
+
+    def _reserve(self, size: Optional[int], mimetype: Optional[str]):
+        if not self.admission:
+            return nullcontext()
+        return self.admission.reserve(size, mimetype)
+
+    async def _show_thumbnail(self, thumbnail: Thumbnail, encrypted_sha256: str) -> bool:
+        """
+        the thumbnail is downloaded without a download slot, it is small and should not
+        wait for the downloads of large files. a failed thumbnail is only logged
+        """
+        start = time.perf_counter()
+        ext = mimetypes.guess_extension(thumbnail.mimetype or '') or '.jpg'
+        try:
+            await self.storage_strategy.show_thumbnail(
+                iter_decrypted_media(self.client, thumbnail.file), encrypted_sha256, ext)
+            self.metrics.display_seconds.observe(time.perf_counter() - start)
+            return True
+        except (DecryptionError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+            self.log.warn(f'failed to show the thumbnail: {error}')
+            return False
+
+    async def _stop_thumbnail(self, encrypted_sha256: str) -> bool:
+        """
+        cancels the thumbnail if it is not shown yet, returns True if it was shown
+        """
+        task = self._thumbnail_tasks.pop(encrypted_sha256, None)
+        if not task:
+            return False
+        shown = task.done() and not task.cancelled() and task.result()
+        task.cancel()
+        await asyncio.wait([task])
+        return shown
+
+    async def _end_download(self, encrypted_sha256: str, finished: bool) -> None:
+        """
+        frees the part file for the next event with the same attachment,
+        the thumbnail of a {finished} event is not listed anymore
+        """
+        self._resumable_downloads.discard(encrypted_sha256)
+        await self._stop_thumbnail(encrypted_sha256)
+        if finished:
+            self.storage_strategy.remove_thumbnail(encrypted_sha256)
+
+    async def _commit_in_order(self,
+                               previous: Optional[asyncio.Future],
+                               staged: Optional[StagedFile],
+                               durations: Dict[str, float],
+                               timestamp: Optional[float],
+                               room_id: RoomID,
+                               sender: Optional[str]) -> Optional[str]:
+        """
+        commits the file after the previous event of the room,
+        returns the stored filename or None if the file was a duplicate
+        """
+        if previous:
+            with self.timings.measure('wait', durations):
+                await previous
+
+        if not staged:
+            self.metrics.duplicate_files.inc()
+            return None
+
+        thumbnail_shown = await self._stop_thumbnail(staged.encrypted_sha256)
+        with self.timings.measure('commit', durations):
+            target = self.storage_strategy.commit(staged, timestamp, room_id, sender)
+        self.metrics.stored_files.inc()
+        if self.transcode_queue:
+            self.transcode_queue.submit(target)
+        if not thumbnail_shown:
+            self.metrics.display_seconds.observe(sum(durations.values()))
+        return target
+
+    # pylint: disable=too-many-locals
+    async def ingest(self,
+                     room_id: RoomID,
+                     encrypted_file: EncryptedFile,
+                     filename: str,
+                     timestamp: float = None,
+                     sender: str = None,
+                     thumbnail: Thumbnail = None,
+                     size: int = None,
+                     event_id: EventID = None,
+                     mimetype: str = None) -> Optional[str]:
+        """
+        downloads, decrypts and converts the file and commits it to the media files,
+        the room and the {sender} are kept in the index for the retention quotas,
+        returns the stored filename or None if the file was a duplicate.
+        the {thumbnail} is listed until the file is committed in its place.
+        the disk space for the {size} of the file is reserved before the download, the
+        {mimetype} of the event is guessed from the {filename} when it is not known.
+        the position of the event in the room is the one reserved for {event_id}, or
+        the end of the room when it was not reserved.
+        the event stays in the ingest journal until the file is stored or can never
+        be stored, so it is retried after a restart
+        """
+        # this has to happen before the first await to keep the order of the events
+        position = self._order.take(room_id, event_id)
+        encrypted_sha256 = encrypted_file.hashes['sha256']
+        self.storage_strategy.media_index.journal_add(
+            JournalEntry(encrypted_sha256, room_id, filename,
+                         json.dumps(encrypted_file.serialize()), timestamp, sender))
+        # the same attachment can be sent twice, only one download may use the part file
+        resumable = encrypted_sha256 not in self._resumable_downloads
+        self._resumable_downloads.add(encrypted_sha256)
+        if thumbnail and resumable:
+            self._thumbnail_tasks[encrypted_sha256] = asyncio.create_task(
+                self._show_thumbnail(thumbnail, encrypted_sha256))
+        durations = {}
+        staged = None
+        finished = True
+        try:
+            async with self._reserve(size, mimetype or mimetypes.guess_type(filename)[0]):
+                staged = await self._timed_download(encrypted_file, filename, resumable,
+                                                    durations)
+                if staged:
+                    with self.timings.measure('convert', durations):
+                        await self.storage_strategy.convert_staged(staged)
+
+            return await self._commit_in_order(position.previous, staged, durations,
+                                               timestamp, room_id, sender)
+        except DecryptionError:
+            # the file can never be stored
+            raise
+        except BaseException:
+            finished = False
+            raise
+        finally:
+            # a committed file was renamed, so only a file which was not committed is removed
+            if staged:
+                DefaultStorageStrategy.discard(staged)
+            if resumable:
+                await self._end_download(encrypted_sha256, finished)
+            if finished:
+                self.storage_strategy.media_index.journal_remove(encrypted_sha256)
+            else:
+                self.log.warn(f'{filename} was not stored, it is retried after a restart')
+            self._order.release(position)
+            self.log.debug(f'ingest {filename}: ' +
+                           ', '.join(f'{stage} {seconds:.3f}s'
+                                     for (stage, seconds) in durations.items()))
+
+    async def resume_journal(self) -> int:
+        """
+        ingests the media events of the journal which were not stored before the
+        last shutdown, returns the number of resumed events
+        """
+        media_index = self.storage_strategy.media_index
+        pending = []
+        for entry in media_index.journal_entries():
+            if self.storage_strategy.find_duplicate(entry.encrypted_sha256):
+                media_index.journal_remove(entry.encrypted_sha256)
+                continue
+            encrypted_file = EncryptedFile.deserialize(json.loads(entry.encrypted_file))
+            pending.append(self.ingest(entry.room_id, encrypted_file, entry.filename,
+                                       entry.timestamp, entry.sender))
+        if pending:
+            self.log.info(f'resume {len(pending)} media downloads of the ingest journal')
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.log.error(f'resumed download failed: {result}')
+        return len(pending)
+# pylint: enable=too-many-instance-attributes
@@ -0,0 +1,452 @@
+"""
+    Persistent index of the files stored in the media_path.
+
+    The index is a small sqlite database which lives as hidden file
+    in the media_path, so it is moved and deleted together with the media.
+"""
+import os
+import sqlite3
+import time
+import hashlib
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from .utils import is_media_filename
+
+INDEX_FILENAME = '.media-index.db'
+
+_UPGRADES = [
+    [
+        '''CREATE TABLE media (
+            path TEXT PRIMARY KEY,
+            encrypted_sha256 TEXT,
+            plaintext_sha256 TEXT
+        )''',
+        'CREATE INDEX media_encrypted_sha256 ON media (encrypted_sha256)',
+        'CREATE INDEX media_plaintext_sha256 ON media (plaintext_sha256)',
+    ],
+    [
+        'ALTER TABLE media ADD COLUMN mtime REAL',
+        'ALTER TABLE media ADD COLUMN size INTEGER',
+        'CREATE INDEX media_mtime ON media (mtime)',
+    ],
+    [
+        '''CREATE TABLE captions (
+            path TEXT PRIMARY KEY,
+            caption TEXT
+        )''',
+    ],
+    [
+        '''CREATE TABLE backfill (
+            room_id TEXT PRIMARY KEY,
+            token TEXT,
+            done INTEGER NOT NULL DEFAULT 0
+        )''',
+    ],
+    [
+        'ALTER TABLE media ADD COLUMN room_id TEXT',
+        'ALTER TABLE media ADD COLUMN sender TEXT',
+        'ALTER TABLE media ADD COLUMN favourite INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX media_room_id ON media (room_id, mtime)',
+        'CREATE INDEX media_sender ON media (sender, mtime)',
+    ],
+    [
+        '''CREATE TABLE ingest_journal (
+            encrypted_sha256 TEXT PRIMARY KEY,
+            room_id TEXT,
+            filename TEXT,
+            encrypted_file TEXT,
+            timestamp REAL,
+            sender TEXT,
+            added REAL
+        )''',
+    ],
+    [
+        '''CREATE TABLE transcode_jobs (
+            source TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            error TEXT,
+            added REAL
+        )''',
+    ],
+    # a file can be sent several times with different keys, so the encrypted hashes
+    # have their own table, the encrypted_sha256 column of media is no longer used
+    # (sqlite before 3.35 can not drop it)
+    [
+        '''CREATE TABLE encrypted_hashes (
+            encrypted_sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL
+        )''',
+        'CREATE INDEX encrypted_hashes_path ON encrypted_hashes (path)',
+        'INSERT OR IGNORE INTO encrypted_hashes (encrypted_sha256, path) '
+        'SELECT encrypted_sha256, path FROM media WHERE encrypted_sha256 IS NOT NULL',
+        'DROP INDEX media_encrypted_sha256',
+        'UPDATE media SET encrypted_sha256 = NULL',
+    ],
+]
+
+# the columns the files can be grouped by for quotas
+QUOTA_COLUMNS = ('room_id', 'sender')
+
+
+def file_sha256(filename: str, chunk_size: int = 64 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as binary_file:
+        for chunk in iter(lambda: binary_file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class MediaStats(NamedTuple):
+    count: int
+    size: int
+
+
+class JournalEntry(NamedTuple):
+    encrypted_sha256: str
+    room_id: str
+    filename: str
+    # the serialized EncryptedFile of the event
+    encrypted_file: str
+    timestamp: Optional[float] = None
+    sender: Optional[str] = None
+
+
+class TranscodeJob(NamedTuple):
+    source: str
+    # pending, running or failed, finished jobs are removed
+    state: str
+    error: Optional[str] = None
+
+
+# pylint: disable=too-many-public-methods
+class MediaIndex:
+    """
+    maps the stored files to the sha256 of the encrypted attachments (as sent in the events,
+    one file can have several) and to the sha256 of the decrypted data,
+    it also keeps the files ordered by mtime so the directory has not to be listed and sorted
+    """
+
+    def __init__(self, media_path: str, logger) -> None:
+        self.log = logger
+        self.media_path = media_path
+        self._db = sqlite3.connect(os.path.join(media_path, INDEX_FILENAME))
+        self._upgrade()
+        self.reconcile()
+
+    def _upgrade(self) -> None:
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        for index, statements in enumerate(_UPGRADES[version:], start=version + 1):
+            self.log.trace(f'upgrade media index to version {index}')
+            with self._db:
+                for statement in statements:
+                    self._db.execute(statement)
+                self._db.execute(f'PRAGMA user_version = {index}')
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _existing_path(self, table: str, column: str, value: str) -> Optional[str]:
+        if not value:
+            return None
+        for (path,) in self._db.execute(f'SELECT path FROM {table} WHERE {column} = ?',
+                                        (value,)):
+            if os.path.isfile(path):
+                return path
+            self.remove(path)
+        return None
+
+    def find_by_encrypted_hash(self, encrypted_sha256: str) -> Optional[str]:
+        return self._existing_path('encrypted_hashes', 'encrypted_sha256', encrypted_sha256)
+
+    def find_by_plaintext_hash(self, plaintext_sha256: str) -> Optional[str]:
+        return self._existing_path('media', 'plaintext_sha256', plaintext_sha256)
+
+    # pylint: disable=too-many-arguments
+    def add(self,
+            path: str,
+            plaintext_sha256: str,
+            encrypted_sha256: str = None,
+            room_id: str = None,
+            sender: str = None) -> None:
+        """
+        adds or updates the file, the room, the sender and the favourite mark
+        of an already indexed file are kept when they are not given,
+        {encrypted_sha256} is added to the encrypted hashes of the file
+        """
+        stat = os.stat(path)
+        with self._db:
+            self._db.execute('INSERT INTO media '
+                             '(path, plaintext_sha256, mtime, size, room_id, sender) '
+                             'VALUES (?, ?, ?, ?, ?, ?) '
+                             'ON CONFLICT (path) DO UPDATE '
+                             'SET plaintext_sha256 = excluded.plaintext_sha256, '
+                             'mtime = excluded.mtime, size = excluded.size, '
+                             'room_id = COALESCE(excluded.room_id, room_id), '
+                             'sender = COALESCE(excluded.sender, sender)',
+                             (path, plaintext_sha256, stat.st_mtime, stat.st_size,
+                              room_id, sender))
+            if encrypted_sha256:
+                self._db.execute('INSERT OR REPLACE INTO encrypted_hashes '
+                                 '(encrypted_sha256, path) VALUES (?, ?)',
+                                 (encrypted_sha256, path))
+
+    def remove(self, path: str) -> None:
+        self.remove_many([path])
+
+    def remove_many(self, paths: List[str]) -> None:
+        with self._db:
+            self._db.executemany('DELETE FROM media WHERE path = ?', ((path,) for path in paths))
+            self._db.executemany('DELETE FROM encrypted_hashes WHERE path = ?',
+                                 ((path,) for path in paths))
+            self._db.executemany('DELETE FROM transcode_jobs WHERE source = ?',
+                                 ((path,) for path in paths))
+
+    def rename(self, path: str, new_path: str) -> None:
+        """
+        moves the entry and the captions of {path} to the already written {new_path},
+        the hashes, the room, the sender and the favourite mark are kept
+        """
+        stat = os.stat(new_path)
+        with self._db:
+            self._db.execute('UPDATE OR REPLACE media SET path = ?, mtime = ?, size = ? '
+                             'WHERE path = ?',
+                             (new_path, stat.st_mtime, stat.st_size, path))
+            self._db.execute('UPDATE encrypted_hashes SET path = ? WHERE path = ?',
+                             (new_path, path))
+            self._db.execute('UPDATE OR REPLACE captions SET path = ? WHERE path = ?',
+                             (new_path, path))
+
+    def paths(self) -> List[str]:
+        """
+        all indexed files, the eldest first
+        """
+        return [path for (path,) in self._db.execute('SELECT path FROM media ORDER BY mtime')]
+
+    def hashed_paths(self) -> List[Tuple[str, Optional[str]]]:
+        """
+        path and plaintext hash of all indexed files, the eldest first
+        """
+        return self._db.execute('SELECT path, plaintext_sha256 FROM media '
+                                'ORDER BY mtime').fetchall()
+
+    def oldest(self, limit: int) -> List[Tuple[str, int]]:
+        """
+        path and size of the eldest {limit} files
+        """
+        return self._db.execute('SELECT path, size FROM media ORDER BY mtime LIMIT ?',
+                                (limit,)).fetchall()
+
+    def iter_oldest(self) -> Iterator[Tuple[str, int]]:
+        """
+        lazily yields path and size of all files, the eldest first
+        """
+        cursor = self._db.execute('SELECT path, size FROM media ORDER BY mtime')
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def iter_oldest_hashed(
+            self, favourites_last: bool = False) -> Iterator[Tuple[str, int, Optional[str]]]:
+        """
+        like iter_oldest, but also yields the plaintext hash,
+        with {favourites_last} the favourites follow all other files
+        """
+        order = 'favourite, mtime' if favourites_last else 'mtime'
+        cursor = self._db.execute(
+            f'SELECT path, size, plaintext_sha256 FROM media ORDER BY {order}')
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def latest(self) -> Optional[str]:
+        row = self._db.execute('SELECT path FROM media ORDER BY mtime DESC LIMIT 1').fetchone()
+        return row[0] if row else None
+
+    def plaintext_hashes(self, paths: List[str]) -> Dict[str, Optional[str]]:
+        hashes = {}
+        for path in paths:
+            row = self._db.execute('SELECT plaintext_sha256 FROM media WHERE path = ?',
+                                   (path,)).fetchone()
+            hashes[path] = row[0] if row else None
+        return hashes
+
+    def set_favourite(self, path: str, favourite: bool) -> bool:
+        """
+        marks {path} as favourite, returns False if the file is not indexed
+        """
+        with self._db:
+            cursor = self._db.execute('UPDATE media SET favourite = ? WHERE path = ?',
+                                      (int(favourite), path))
+        return cursor.rowcount > 0
+
+    def is_favourite(self, path: str) -> bool:
+        row = self._db.execute('SELECT favourite FROM media WHERE path = ?', (path,)).fetchone()
+        return bool(row and row[0])
+
+    def iter_deletable(self,
+                       keep_favourites: bool,
+                       column: str = None,
+                       value: str = None) -> Iterator[Tuple[str, int]]:
+        """
+        lazily yields path and size of the files which may be deleted, the eldest first,
+        optionally only the files with {value} in the quota {column}
+        """
+        conditions = []
+        params = []
+        if keep_favourites:
+            conditions.append('favourite = 0')
+        if column:
+            if column not in QUOTA_COLUMNS:
+                raise ValueError(f'unknown quota column {column}')
+            conditions.append(f'{column} = ?')
+            params.append(value)
+        where = f'WHERE {" AND ".join(conditions)} ' if conditions else ''
+        cursor = self._db.execute(f'SELECT path, size FROM media {where}ORDER BY mtime', params)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def older_than(self, mtime: float, keep_favourites: bool) -> List[str]:
+        favourites = ' AND favourite = 0' if keep_favourites else ''
+        return [path for (path,) in self._db.execute(
+            f'SELECT path FROM media WHERE mtime < ?{favourites} ORDER BY mtime', (mtime,))]
+
+    def usage_over(self, column: str, max_bytes: int) -> List[Tuple[str, int]]:
+        """
+        the values of the quota {column} whose files use more than {max_bytes}
+        together with their size
+        """
+        if column not in QUOTA_COLUMNS:
+            raise ValueError(f'unknown quota column {column}')
+        return self._db.execute(f'SELECT {column}, SUM(size) FROM media '
+                                f'WHERE {column} IS NOT NULL GROUP BY {column} '
+                                'HAVING SUM(size) > ?', (max_bytes,)).fetchall()
+
+    def captions(self, path: str) -> List[str]:
+        """
+        the caption lines drawn onto {path}
+        """
+        row = self._db.execute('SELECT caption FROM captions WHERE path = ?', (path,)).fetchone()
+        return row[0].split('\n') if row and row[0] else []
+
+    def set_captions(self, path: str, captions: List[str]) -> None:
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO captions (path, caption) VALUES (?, ?)',
+                             (path, '\n'.join(captions)))
+
+    def remove_captions(self, paths: List[str]) -> None:
+        with self._db:
+            self._db.executemany('DELETE FROM captions WHERE path = ?',
+                                 ((path,) for path in paths))
+
+    def backfill_state(self, room_id: str) -> Tuple[Optional[str], bool]:
+        """
+        the pagination token where the backfill of {room_id} continues
+        and whether the complete history was imported
+        """
+        row = self._db.execute('SELECT token, done FROM backfill WHERE room_id = ?',
+                               (room_id,)).fetchone()
+        return (row[0], bool(row[1])) if row else (None, False)
+
+    def set_backfill_state(self, room_id: str, token: Optional[str], done: bool) -> None:
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO backfill (room_id, token, done) '
+                             'VALUES (?, ?, ?)', (room_id, token, int(done)))
+
+    def journal_add(self, entry: JournalEntry) -> None:
+        """
+        records a media event before the download starts, an entry for the same
+        attachment is kept
+        """
+        with self._db:
+            self._db.execute('INSERT OR IGNORE INTO ingest_journal '
+                             '(encrypted_sha256, room_id, filename, encrypted_file, '
+                             'timestamp, sender, added) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (*entry, time.time()))
+
+    def journal_remove(self, encrypted_sha256: str) -> None:
+        with self._db:
+            self._db.execute('DELETE FROM ingest_journal WHERE encrypted_sha256 = ?',
+                             (encrypted_sha256,))
+
+    def journal_entries(self) -> List[JournalEntry]:
+        """
+        the media events which were not stored yet, the eldest first
+        """
+        return [JournalEntry(*row) for row in self._db.execute(
+            'SELECT encrypted_sha256, room_id, filename, encrypted_file, timestamp, sender '
+            'FROM ingest_journal ORDER BY added')]
+
+    def transcode_add(self, source: str) -> None:
+        with self._db:
+            self._db.execute('INSERT OR IGNORE INTO transcode_jobs (source, state, added) '
+                             'VALUES (?, ?, ?)', (source, 'pending', time.time()))
+
+    def transcode_set_state(self, source: str, state: str, error: str = None) -> None:
+        with self._db:
+            self._db.execute('UPDATE transcode_jobs SET state = ?, error = ? WHERE source = ?',
+                             (state, error, source))
+
+    def transcode_remove(self, source: str) -> None:
+        with self._db:
+            self._db.execute('DELETE FROM transcode_jobs WHERE source = ?', (source,))
+
+    def transcode_job(self, source: str) -> Optional[TranscodeJob]:
+        row = self._db.execute('SELECT source, state, error FROM transcode_jobs '
+                               'WHERE source = ?', (source,)).fetchone()
+        return TranscodeJob(*row) if row else None
+
+    def transcode_jobs(self) -> List[TranscodeJob]:
+        """
+        the unfinished and the failed transcode jobs, the eldest first
+        """
+        return [TranscodeJob(*row) for row in self._db.execute(
+            'SELECT source, state, error FROM transcode_jobs ORDER BY added')]
+
+    def stats(self) -> MediaStats:
+        (count, size) = self._db.execute('SELECT COUNT(*), SUM(size) FROM media').fetchone()
+        return MediaStats(count, size or 0)
+
+    def reconcile(self) -> None:
+        """
+        syncs the index with the {media_path}, picks up files added or changed outside
+        the client and drops deleted files, only one directory scan and no sorting needed
+        """
+        indexed = {path: (mtime, size) for (path, mtime, size)
+                   in self._db.execute('SELECT path, mtime, size FROM media')}
+        changed = []
+        with os.scandir(self.media_path) as entries:
+            for entry in entries:
+                if not is_media_filename(entry.name) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if indexed.pop(entry.path, None) != (stat.st_mtime, stat.st_size):
+                    changed.append((entry.path, stat.st_mtime, stat.st_size))
+
+        if changed or indexed:
+            self.log.trace(f'reconcile media index: {len(changed)} changed, '
+                           f'{len(indexed)} removed')
+        with self._db:
+            self._db.executemany('INSERT INTO media (path, mtime, size) VALUES (?, ?, ?) '
+                                 'ON CONFLICT (path) DO UPDATE '
+                                 'SET mtime = excluded.mtime, size = excluded.size',
+                                 changed)
+            self._db.executemany('DELETE FROM media WHERE path = ?',
+                                 ((path,) for path in indexed))
+            self._db.executemany('DELETE FROM encrypted_hashes WHERE path = ?',
+                                 ((path,) for path in indexed))
+
+    def rebuild(self) -> None:
+        """
+        reconciles the index and hashes all files without a known hash,
+        existing hashes are kept since the hashes of converted files
+        can not be restored from the disk
+        """
+        self.reconcile()
+        unhashed = [path for (path,) in
+                    self._db.execute('SELECT path FROM media WHERE plaintext_sha256 IS NULL')]
+        with self._db:
+            self._db.executemany('UPDATE media SET plaintext_sha256 = ? WHERE path = ?',
+                                 ((file_sha256(path), path) for path in unhashed))
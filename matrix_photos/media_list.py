@@ -0,0 +1,61 @@
+from collections import deque
+from typing import Iterator, List, Optional
+from .utils import write_lines_atomic
+
+
+class RecentMediaList:
+    """
+    keeps the latest {max_file_count} filenames of the {media_file} in memory,
+    appending, evicting the eldest entry and getting the latest entry are O(1)
+    """
+
+    def __init__(self, media_file: str, max_file_count: int) -> None:
+        self.media_file = media_file
+        self._entries = deque(maxlen=max(1, max_file_count))
+        self.reload()
+
+    def reload(self) -> None:
+        """
+        reads the {media_file} again, e.g. after it was rewritten by reread_files
+        """
+        self._entries.clear()
+        try:
+            with open(self.media_file, 'r', encoding='utf-8') as text_file:
+                self._entries.extend(line.strip() for line in text_file if line.strip())
+        except IOError:
+            pass
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def entries(self) -> List[str]:
+        return list(self._entries)
+
+    def last(self) -> str:
+        return self._entries[-1] if self._entries else ""
+
+    def append(self, filename: str) -> None:
+        self._entries.append(filename)
+        self.write()
+
+    def replace(self, filename: str, replacement: Optional[str]) -> bool:
+        """
+        puts {replacement} at the position of {filename} or removes the entry if
+        {replacement} is None, returns False if {filename} is not listed
+        """
+        try:
+            index = self._entries.index(filename)
+        except ValueError:
+            return False
+        if replacement is None:
+            del self._entries[index]
+        else:
+            self._entries[index] = replacement
+        self.write()
+        return True
+
+    def write(self) -> None:
+        write_lines_atomic(self.media_file, self._entries)
@@ -0,0 +1,225 @@
+"""
+    Metrics of the photo ingestion in the prometheus text format.
+
+    The metrics are collected in memory and can optionally be scraped from
+    a small aiohttp server, the !stats admin command shows a summary.
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Sequence
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name} {self.value}']
+
+
+class Gauge:
+
+    kind = 'gauge'
+
+    def __init__(self,
+                 name: str,
+                 description: str,
+                 function: Callable[[], float] = None) -> None:
+        self.name = name
+        self.description = description
+        self.function = function
+        self._value = 0.0
+
+    @property
+    def value(self) -> float:
+        if self.function:
+            return self.function()
+        return self._value
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def samples(self) -> List[str]:
+        return [f'{self.name} {self.value}']
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 description: str,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    @property
+    def average(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def samples(self) -> List[str]:
+        lines = [f'{self.name}_bucket{{le="{bound}"}} {count}'
+                 for (bound, count) in zip(self.buckets, self.bucket_counts)]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+# pylint: disable=too-many-instance-attributes
+class Metrics:
+    """
+    all metrics of one client
+    """
+
+    def __init__(self) -> None:
+        self.download_bytes = Counter('photos_download_bytes_total',
+                                      'Bytes of downloaded media')
+        self.download_seconds = Histogram('photos_download_seconds',
+                                          'Time spent downloading one media file')
+        self.decrypt_seconds = Histogram('photos_decrypt_seconds',
+                                         'Time spent decrypting one media file')
+        self.convert_seconds = Histogram('photos_convert_seconds',
+                                         'Duration of one convert process')
+        self.display_seconds = Histogram('photos_display_seconds',
+                                         'Time from receiving a media file until it or its '
+                                         'thumbnail was listed')
+        self.convert_queue_depth = Gauge('photos_convert_queue_depth',
+                                         'Number of waiting convert jobs')
+        self.stored_files = Counter('photos_stored_files_total',
+                                    'Number of stored media files')
+        self.duplicate_files = Counter('photos_duplicate_files_total',
+                                       'Number of media files skipped as duplicates')
+        self.transcoded_files = Counter('photos_transcoded_files_total',
+                                        'Number of videos replaced by their transcoded copy')
+        self.transcode_queue_depth = Gauge('photos_transcode_queue_depth',
+                                           'Number of waiting transcode jobs')
+        self.evicted_files = Counter('photos_evicted_files_total',
+                                     'Number of files deleted to free disk space')
+        self.retention_deleted_files = Counter('photos_retention_deleted_files_total',
+                                               'Number of files deleted by the retention policies')
+        self.reserved_bytes = Gauge('photos_reserved_bytes',
+                                    'Disk space reserved for the running downloads')
+        self.deferred_downloads = Counter('photos_deferred_downloads_total',
+                                          'Number of downloads which waited for disk space')
+        self.disk_free_bytes = Gauge('photos_disk_free_bytes',
+                                     'Free disk space of the media path')
+        self.decryption_failures = Counter('photos_decryption_failures_total',
+                                           'Number of events which could not be decrypted')
+        self.room_key_requests = Counter('photos_room_key_requests_total',
+                                         'Number of sent room key requests')
+        self.event_loop_lag_seconds = Gauge('photos_event_loop_lag_seconds',
+                                            'Latest delay of the event loop')
+        self.startup_seconds = Gauge('photos_startup_seconds',
+                                     'Time from the start until the client was connected')
+        self.first_event_seconds = Gauge('photos_first_event_seconds',
+                                         'Time from the start until the first event was handled')
+
+    def all(self) -> List:
+        return [metric for metric in vars(self).values()
+                if isinstance(metric, (Counter, Gauge, Histogram))]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.all():
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        return '\n'.join([
+            f'Stored files: {int(self.stored_files.value)}, '
+            f'duplicates: {int(self.duplicate_files.value)}, '
+            f'evicted: {int(self.evicted_files.value)}, '
+            f'retention: {int(self.retention_deleted_files.value)}, '
+            f'transcoded: {int(self.transcoded_files.value)}',
+            f'Downloaded (Mb): {self.download_bytes.value / (1024*1024):.1f}',
+            f'Download avg (s): {self.download_seconds.average:.3f}, '
+            f'decrypt avg (s): {self.decrypt_seconds.average:.3f}, '
+            f'convert avg (s): {self.convert_seconds.average:.3f}, '
+            f'display avg (s): {self.display_seconds.average:.3f}',
+            f'Convert queue depth: {int(self.convert_queue_depth.value)}',
+            f'Reserved (Mb): {self.reserved_bytes.value / (1024*1024):.1f}, '
+            f'deferred downloads: {int(self.deferred_downloads.value)}',
+            f'Decryption failures: {int(self.decryption_failures.value)}, '
+            f'room key requests: {int(self.room_key_requests.value)}',
+            f'Event loop lag (s): {self.event_loop_lag_seconds.value:.3f}',
+            f'Startup (s): {self.startup_seconds.value:.2f}, '
+            f'first event (s): {self.first_event_seconds.value:.2f}',
+        ])
+# pylint: enable=too-many-instance-attributes
+
+
+async def monitor_event_loop_lag(metrics: Metrics, interval: float = 1.0) -> None:
+    """
+    measures how much later than expected the event loop wakes up from a sleep
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        metrics.event_loop_lag_seconds.set(max(0.0, loop.time() - start - interval))
+
+
+class MetricsServer:
+    """
+    serves the metrics at http://{host}:{port}/metrics
+    """
+
+    def __init__(self, metrics: Metrics, host: str, port: int, logger) -> None:
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.log = logger
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle_metrics(self, _request: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.render(),
+                            content_type='text/plain',
+                            charset='utf-8')
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.log.info(f'metrics available at http://{self.host}:{self.port}/metrics')
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
@@ -7,11 +7,11 @@
     Parts from this source code are inspired by maubot:
     https://github.com/maubot/maubot
 """
-import sys
+import time
 import asyncio
 import traceback
 import random
-from typing import Union
+from typing import List, Optional
 from mautrix.client import client as mau
 from mautrix.client.dispatcher import SimpleDispatcher
 from mautrix.client.encryption_manager import DecryptionDispatcher
@@ -19,38 +19,62 @@ from mautrix.client.encryption_manager import DecryptionDispatcher
 from mautrix.crypto import (
     PgCryptoStateStore,
     OlmMachine,
-    StateStore as CryptoStateStore,
     PgCryptoStore
 )
-from mautrix.crypto.attachments.attachments import decrypt_attachment
-from mautrix.client.state_store.sqlalchemy import SQLStateStore as BaseSQLStateStore
 from mautrix.types.event.encrypted import EncryptedEvent
 from mautrix.types.event.message import (MediaMessageEventContent,
                                          MessageType,
                                          TextMessageEventContent
                                          )
 from mautrix.types.misc import PaginationDirection
-from mautrix.types.primitive import RoomID, UserID
+from mautrix.types.primitive import EventID, RoomID, UserID
 from mautrix.util.async_db import Database as AsyncDatabase
 from mautrix.types import (StrippedStateEvent,
                            Membership,
                            EventType
                            )
 
-from mautrix.errors import DecryptionError
+from mautrix.errors import DecryptionError, MatrixInvalidToken, SessionNotFound
 from matrix_photos.text_message_command_handler import TextmessageCommandHandler
 from .storage_strategy import DefaultStorageStrategy
+from .admission import AdmissionController
+from .ingest_pipeline import IngestPipeline, Thumbnail
+from .transcode_queue import TranscodeQueue
+from .backfill import Backfill, BackfillResult
+from .event_history import EventHistory
+from .decryption_queue import PendingDecryptionQueue
+from .session_store import SessionStore
+from .database import DatabaseSettings, create_database, start_database
+from .sync_filter import build_sync_filter, filter_hash
+from .metrics import Metrics, MetricsServer, monitor_event_loop_lag
+from .utils import disk_usage
+from .file_convert import ConvertPool
 from .admin_command_handler import AdminCommandHandler
 from .text_message_command_handler import TextmessageCommandHandler
 from .configuration import MatrixConfiguration
 
 
-class SQLStateStore(BaseSQLStateStore, CryptoStateStore):
-    pass
+class AccountMismatchException(Exception):
+    """
+    the homeserver confirmed another user or device than the configured one,
+    a single client exits with the {exit_code}
+    """
+
+    def __init__(self, exit_code: int, message: str) -> None:
+        self.exit_code = exit_code
+        self.message = message
+        super().__init__(self.message)
+
+
 class ClientDecryptionDispatcher(SimpleDispatcher):
     """
-    This is a custom decryption dispatcher which sends a m.room_key_request to-device event
-    when decryption fails in order to try decryption again.
+    This is a custom decryption dispatcher which keeps events in a queue when the
+    megolm session is missing and sends a m.room_key_request to-device event
+    in order to decrypt the events as soon as the keys arrive.
+    The position of the event in its room is reserved in the {ingest_pipeline} and
+    the {event_history} before the decryption, so media events are stored and
+    messages are recorded in the order of the sync even when their decryptions
+    finish in another order.
     """
 
     #pylint: disable=no-member
@@ -58,68 +82,99 @@ class ClientDecryptionDispatcher(SimpleDispatcher):
     #pylint: enable=no-member
     client: mau.Client
     user_id = ""
-
-    async def _request_room_key_for_event(self, evt: EncryptedEvent):
-        try:
-            self.client.crypto_log.trace("request room keys")
-            await self.client.crypto.request_room_key(
-                evt.room_id,
-                evt.content.sender_key,
-                evt.content.session_id,
-                from_devices={evt.sender: [evt.content.device_id]}, timeout=10)
-        #pylint:disable=broad-except
-        except Exception as error:
-            self.client.crypto_log.error(error)
-        #pylint:enable=broad-except
-
-    async def _retry_handle_event(self, evt: EncryptedEvent):
-        try:
-            self.client.crypto_log.trace("retry to handle event")
-            await self._handle_event(evt)
-        #pylint:disable=broad-except
-        except Exception as retry_error:
-            self.client.crypto_log.error("failed to retry", retry_error)
-        #pylint:enable=broad-except
+    metrics = Metrics()
+    pending_decryptions: PendingDecryptionQueue = None
+    ingest_pipeline: IngestPipeline = None
+    event_history: EventHistory = None
 
     async def _handle_event(self, evt: EncryptedEvent) -> None:
         decrypted = await self.client.crypto.decrypt_megolm_event(evt)
-        self.client.dispatch_event(decrypted, evt.source)
+        # the handlers have to take the reserved position before it is released
+        await asyncio.gather(*self.client.dispatch_event(decrypted, evt.source))
 
     async def handle(self, evt: EncryptedEvent) -> None:
+        # the handlers run as separate tasks, this has to happen before the first await
+        if self.ingest_pipeline:
+            self.ingest_pipeline.reserve_order(evt.room_id, evt.event_id)
+        if self.event_history:
+            self.event_history.reserve(evt.room_id, evt.event_id)
         try:
             self.client.crypto_log.trace(
                 f'try to decrypt event {evt.event_id}')
             await self._handle_event(evt)
-        except DecryptionError as error:
+        except SessionNotFound as error:
+            if self.pending_decryptions is None:
+                raise
             self.client.crypto_log.warn(
-                'decryption error, try to request room keys', error)
-            await self._request_room_key_for_event(evt)
-            await self._retry_handle_event(evt)
+                f'decryption error, wait for room keys: {error}')
+            self.pending_decryptions.add(evt)
+        except DecryptionError as error:
+            self.metrics.decryption_failures.inc()
+            self.client.crypto_log.error(f'failed to decrypt {evt.event_id}: {error}')
+        finally:
+            if self.ingest_pipeline:
+                self.ingest_pipeline.release_order(evt.event_id)
+            if self.event_history:
+                self.event_history.release(evt.event_id)
 
 
+# pylint: disable=too-many-instance-attributes
 class PhotOsClient():
     '''
         A Simple Matrix client which automatically joins room invitations from trusted users
         and downloads all attachments into a specified folder
     '''
 
-    global_state_store: Union['BaseSQLStateStore',
-                              'CryptoStateStore'] = SQLStateStore()
-
-    def __init__(self, config: MatrixConfiguration, client_session, logger) -> None:
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 config: MatrixConfiguration,
+                 client_session,
+                 logger,
+                 database: AsyncDatabase = None,
+                 convert_pool: ConvertPool = None) -> None:
+        '''
+            {database} and {convert_pool} can be shared by several clients,
+            shared resources are not stopped when the client stops
+        '''
         self._config = config
         self.client_session = client_session
         self.log = logger
-        self.storage_strategy = DefaultStorageStrategy(config, logger)
+        self._started = time.monotonic()
+        self._shared_database = database
+        self._owns_convert_pool = convert_pool is None
+        self.metrics = Metrics()
+        self.convert_pool = convert_pool or ConvertPool(config.convert, logger, self.metrics)
+        self.storage_strategy = DefaultStorageStrategy(config, logger, self.convert_pool,
+                                                       self.metrics)
+        self.metrics.convert_queue_depth.function = lambda: self.convert_pool.queue_depth
+        self.transcode_queue = TranscodeQueue(config, logger, self.storage_strategy, self.metrics)
+        self.metrics.transcode_queue_depth.function = lambda: self.transcode_queue.queue_depth
+        self.metrics.disk_free_bytes.function = lambda: disk_usage(config.media_path).free
 
         if self._config.admin_user:
-            self.admin_command_handler = AdminCommandHandler(config, logger)
+            self.admin_command_handler = AdminCommandHandler(
+                config, logger, self.storage_strategy, self.metrics, self.start_backfill,
+                self.transcode_queue.status)
 
+        self.event_history = EventHistory()
         self.text_message_command_handler = TextmessageCommandHandler(
-            config, logger)
+            config, logger, self.convert_pool, self.storage_strategy)
 
         self.crypto_db = None
+        self.session_store = None
+        self.sync_filter_id = None
         self.client = None
+        self.admission = None
+        self.ingest_pipeline = None
+        self.backfill = None
+        self.pending_decryptions = None
+        self.metrics_server = None
+        if self._config.metrics_port:
+            self.metrics_server = MetricsServer(self.metrics,
+                                                self._config.metrics_host,
+                                                self._config.metrics_port,
+                                                logger)
+        self._background_tasks: List[asyncio.Task] = []
 
     async def _get_valid_device_id(self, crypto_store: PgCryptoStore) -> None:
         crypto_device_id = await crypto_store.get_device_id()
@@ -133,8 +188,8 @@ class PhotOsClient():
 
     async def initialize(self):
         '''Prepare crypto store and initialize a matrix client'''
-        self.crypto_db = AsyncDatabase.create(
-            self._config.database_url, upgrade_table=PgCryptoStore.upgrade_table)
+        database_settings = DatabaseSettings.from_configuration(self._config)
+        self.crypto_db = self._shared_database or create_database(database_settings)
         crypto_store = PgCryptoStore(
             account_id=self._config.user_id, pickle_key="mau.crypto", db=self.crypto_db)
         state_store = PgCryptoStateStore(self.crypto_db)
@@ -147,8 +202,9 @@ class PhotOsClient():
                                  sync_store=crypto_store,
                                  log=self.log)
 
-        await self.crypto_db.start()
-        await state_store.upgrade_table.upgrade(self.crypto_db)
+        # a shared database was started and upgraded by the supervisor
+        if not self._shared_database:
+            await start_database(self.crypto_db, database_settings)
         await crypto_store.open()
 
         crypto = OlmMachine(self.client, crypto_store, state_store, self.log)
@@ -156,6 +212,26 @@ class PhotOsClient():
         self.client.crypto = crypto
         self.client.crypto_log = self.log
 
+        self.admission = AdmissionController(self._config,
+                                             self.log,
+                                             self.storage_strategy,
+                                             self.metrics)
+        self.ingest_pipeline = IngestPipeline(self.client,
+                                              self.storage_strategy,
+                                              self._config.max_parallel_downloads,
+                                              self.log,
+                                              self.metrics,
+                                              self._config.download_retries,
+                                              self.admission,
+                                              self.transcode_queue)
+
+        self.backfill = Backfill(self._config,
+                                 self.log,
+                                 self.client,
+                                 self.ingest_pipeline,
+                                 self.storage_strategy,
+                                 self._is_wanted_media)
+
         self.client.ignore_first_sync = False
         self.client.ignore_initial_sync = False
 
@@ -168,44 +244,103 @@ class PhotOsClient():
             self.log.debug("Enabled encryption support")
 
         self.client.remove_dispatcher(DecryptionDispatcher)
-        ClientDecryptionDispatcher.user_id = self._config.user_id
         self.client.add_dispatcher(ClientDecryptionDispatcher)
+        decryption_dispatcher = self.client.dispatchers[ClientDecryptionDispatcher]
+        decryption_dispatcher.user_id = self._config.user_id
+        decryption_dispatcher.metrics = self.metrics
+        decryption_dispatcher.ingest_pipeline = self.ingest_pipeline
+        decryption_dispatcher.event_history = self.event_history
+        decryption_dispatcher.pending_decryptions = self.pending_decryptions = \
+            PendingDecryptionQueue(self.client,
+                                   self.log,
+                                   self.metrics,
+                                   self._config.max_pending_decryptions,
+                                   self._config.pending_decryption_ttl_seconds)
+
+        self.session_store = SessionStore(self.crypto_db, self._config.user_id)
+        await self.session_store.open()
+        if not await self._restore_session():
+            await self._login()
+
+        await self._confirm_connection()
+        if self._config.sync_filter:
+            self.sync_filter_id = await self._upload_sync_filter()
+
+        if await crypto_store.get_next_batch():
+            self.log.debug('resume sync from the stored sync token')
+        self.metrics.startup_seconds.set(time.monotonic() - self._started)
+        self.log.info(f'client initialized in {self.metrics.startup_seconds.value:.2f}s')
 
-        login_response = await self.client.login(self._config.user_id,
-                                                 password=self._config.user_password)
-        self.log.trace(login_response)
+        #pylint: disable=no-member
+        self.client.add_event_handler(
+            EventType.ROOM_MEMBER, self._handle_invite)
+        self.client.add_event_handler(
+            EventType.ROOM_MESSAGE, self._handle_message)
+        #pylint: enable=no-member
 
+    async def _confirm_connection(self) -> None:
+        """
+        checks the access token and the device with whoami,
+        logs in again if the stored access token was revoked,
+        raises an AccountMismatchException if the user or the device do not match
+        """
+        retry_seconds = 1
         while True:
             try:
                 whoami = await self.client.whoami()
-            # pylint: disable=broad-except
-            except Exception:
+            except MatrixInvalidToken:
+                self.log.warn('stored access token is not valid anymore, log in again')
+                await self.session_store.delete()
+                await self._login()
+                continue
+            except Exception:  # pylint: disable=broad-except
                 self.log.exception(
-                    "Failed to connect to homeserver, retrying in 10 seconds...")
-                await asyncio.sleep(10)
+                    f"Failed to connect to homeserver, retrying in {retry_seconds} seconds...")
+                await asyncio.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, 30)
                 continue
-            # pylint: enable=broad-except
+            # pylint: disable=line-too-long
             if whoami.user_id != self._config.user_id:
-                # pylint: disable=line-too-long
-                self.log.fatal(
-                    f"User ID mismatch: configured {self._config.user_id}, but server said {whoami.user_id}"
-                )
-                sys.exit(11)
-            elif whoami.device_id and self._config.device_id and whoami.device_id != self._config.device_id:
-                self.log.fatal(f"Device ID mismatch: configured {self._config.device_id}, "
-                               f"but server said {whoami.device_id}")
-                sys.exit(12)
-                # pylint: enable=line-too-long
+                raise AccountMismatchException(
+                    11, f"User ID mismatch: configured {self._config.user_id}, but server said {whoami.user_id}")
+            if whoami.device_id and self._config.device_id and whoami.device_id != self._config.device_id:
+                raise AccountMismatchException(
+                    12, f"Device ID mismatch: configured {self._config.device_id}, but server said {whoami.device_id}")
+            # pylint: enable=line-too-long
             self.log.debug(
                 f"Confirmed connection as {whoami.user_id} / {whoami.device_id}")
             break
 
-        #pylint: disable=no-member
-        self.client.add_event_handler(
-            EventType.ROOM_MEMBER, self._handle_invite)
-        self.client.add_event_handler(
-            EventType.ROOM_MESSAGE, self._handle_message)
-        #pylint: enable=no-member
+    async def _upload_sync_filter(self) -> Optional[str]:
+        """
+        uploads the sync filter once, the filter id is reused until the filter changes
+        """
+        sync_filter = build_sync_filter(self._config.sync_timeline_limit,
+                                        self._config.sync_lazy_load_members)
+        sync_filter_hash = filter_hash(sync_filter)
+        filter_id = await self.session_store.get_filter_id(sync_filter_hash)
+        if not filter_id:
+            filter_id = await self.client.create_filter(sync_filter)
+            await self.session_store.put_filter_id(sync_filter_hash, filter_id)
+            self.log.debug(f'uploaded sync filter {filter_id}')
+        return filter_id
+
+    async def _restore_session(self) -> bool:
+        """
+        reuses the stored access token if it belongs to the configured {device_id}
+        """
+        session = await self.session_store.get()
+        if not session or session.device_id != self._config.device_id:
+            return False
+        self.log.debug('reuse stored access token')
+        self.client.api.token = session.access_token
+        return True
+
+    async def _login(self) -> None:
+        login_response = await self.client.login(self._config.user_id,
+                                                 password=self._config.user_password)
+        self.log.trace(login_response)
+        await self.session_store.put(login_response.device_id, login_response.access_token)
 
     async def _handle_invite(self, evt: StrippedStateEvent) -> None:
         self.log.trace('_handle_invite')
@@ -233,13 +368,14 @@ class PhotOsClient():
     def is_admin_user(self, user_id: UserID) -> bool:
         return user_id == self._config.admin_user
 
-    def max_download_size_exceeded(self, media_content: MediaMessageEventContent) -> bool:
-        media_size = media_content.info.size
-        return self._config.max_download_size_mb < media_size / (1024*1024)
-
-    async def _store_data(self, media_content: MediaMessageEventContent) -> bool:
-        if self.max_download_size_exceeded(media_content):
-            self.log.warn('max download size exceeded')
+    async def _store_data(self,
+                          room_id: RoomID,
+                          media_content: MediaMessageEventContent,
+                          sender: UserID = None,
+                          event_id: EventID = None) -> bool:
+        rejection = self.admission.check(media_content.info.mimetype, media_content.info.size)
+        if rejection:
+            self.log.warn(rejection)
             return False
 
         if not media_content.file:
@@ -247,17 +383,50 @@ class PhotOsClient():
                 'mediamessage does not contain encrypted data, is encryption enabled in your room?')
             return False
 
-        encrypted_data = await self.client.download_media(media_content.file.url)
+        encrypted_sha256 = media_content.file.hashes['sha256']
+        existing = self.storage_strategy.find_duplicate(encrypted_sha256)
+        if existing:
+            self.log.trace(f'skip download, file already stored as {existing}')
+            return True
+
+        await self.ingest_pipeline.ingest(room_id, media_content.file, str(media_content.body),
+                                          sender=sender,
+                                          thumbnail=self._thumbnail(media_content),
+                                          size=media_content.info.size,
+                                          event_id=event_id,
+                                          mimetype=media_content.info.mimetype)
+        return True
 
-        file_hash = media_content.file.hashes['sha256']
-        vector = media_content.file.iv
-        decrypted_data = decrypt_attachment(
-            encrypted_data, media_content.file.key.key, file_hash, vector)
+    def _thumbnail(self, media_content: MediaMessageEventContent) -> Optional[Thumbnail]:
+        """
+        the thumbnail which is shown until the file is stored with {progressive_ingest}
+        """
+        # audio infos have no thumbnail
+        thumbnail_file = getattr(media_content.info, 'thumbnail_file', None)
+        if not self._config.progressive_ingest or not thumbnail_file:
+            return None
+        thumbnail_info = media_content.info.thumbnail_info
+        return Thumbnail(thumbnail_file, thumbnail_info.mimetype if thumbnail_info else None)
+
+    def _is_wanted_media(self, evt) -> bool:
+        return (bool(evt.content.file)
+                and not self.admission.check(evt.content.info.mimetype, evt.content.info.size))
+
+    async def run_backfill(self, room_ids: List[RoomID] = None) -> BackfillResult:
+        """
+        imports the media history of the given rooms or of all joined rooms
+        """
+        result = await self.backfill.run(room_ids)
+        self.log.info(f'backfill finished: {result}')
+        return result
 
-        # IDEA maybe store the hash somewhere and only store the file
-        # if we dont have a file with the same hash
-        self.storage_strategy.store(decrypted_data, str(media_content.body))
-        return True
+    def start_backfill(self, room_ids: List[RoomID] = None) -> str:
+        if any(task.get_name() == 'backfill' for task in self._background_tasks
+               if not task.done()):
+            return 'backfill is already running'
+        self._background_tasks.append(
+            asyncio.create_task(self.run_backfill(room_ids), name='backfill'))
+        return f'backfill started for {len(room_ids) if room_ids else "all"} rooms'
 
     def _is_allowed_content(self, content: MediaMessageEventContent):
         result = content.info.mimetype in self._config.allowed_mimetypes
@@ -281,15 +450,40 @@ class PhotOsClient():
 
         return False
 
-    async def _handle_message_event(self, evt: StrippedStateEvent) -> None:
+    async def _handle_message_event(self,
+                                    evt: StrippedStateEvent,
+                                    previous_was_media: Optional[bool],
+                                    media_sha256: Optional[str]) -> None:
         if self._is_admin_command(evt):
             await self._handle_admin_command(evt)
         else:
             is_foreign_message = evt.sender != self._config.user_id
-            media_message_before = await self.message_before_was_media_message(evt.room_id,
-                                                                               evt.sender)
+            media_message_before = previous_was_media
+            if media_message_before is None:
+                media_message_before = await self.message_before_was_media_message(evt.room_id,
+                                                                                   evt.sender)
             if is_foreign_message and media_message_before:
-                self.text_message_command_handler.handle(evt.content)
+                await self.text_message_command_handler.handle(
+                    evt.content, await self._caption_target(evt, media_sha256))
+
+    async def _caption_target(self,
+                              evt: StrippedStateEvent,
+                              encrypted_sha256: Optional[str]) -> Optional[str]:
+        """
+        the stored file of the media message with the {encrypted_sha256} the text message
+        follows, it is known only after the media message was committed, before that the
+        last image is the previous image or the thumbnail of the media message.
+        returns None if the media message is not known and an empty string if it was
+        not stored
+        """
+        await self.ingest_pipeline.wait_for_previous(evt.room_id, evt.event_id)
+        if not encrypted_sha256:
+            return None
+        stored = self.storage_strategy.find_duplicate(encrypted_sha256)
+        if not stored:
+            self.log.warn('the media message of the caption was not stored, skip the caption')
+            return ''
+        return self.storage_strategy.display_path_of(stored)
 
     async def message_before_was_media_message(self, room_id: RoomID, sender_id: UserID) -> bool:
         token = await self.client.sync_store.get_next_batch()
@@ -339,15 +533,21 @@ class PhotOsClient():
         self.log.trace('_handle_message')
 
         try:
+            is_media = isinstance(evt.content, MediaMessageEventContent)
+            (previous_was_media, media_sha256) = await self.event_history.record_in_order(
+                evt.room_id, evt.sender, is_media,
+                evt.content.file.hashes['sha256'] if is_media and evt.content.file else None,
+                evt.event_id)
+
             if isinstance(evt.content, TextMessageEventContent):
                 self.log.trace('TextMessageEventContent')
-                await self._handle_message_event(evt)
+                await self._handle_message_event(evt, previous_was_media, media_sha256)
 
             if (isinstance(evt.content, MediaMessageEventContent)
                 and self._is_allowed_content(evt.content)
                 ):
                 self.log.trace('MediaMessageEventContent')
-                if await self._store_data(evt.content):
+                if await self._store_data(evt.room_id, evt.content, evt.sender, evt.event_id):
                     await self._send_random_response_message(evt)
                 else:
                     await self._send_reply_text_message(evt, "your file has been revoked.")
@@ -358,11 +558,38 @@ class PhotOsClient():
             traceback.print_exc()
         # pylint: enable=broad-except
 
+        if not self.metrics.first_event_seconds.value:
+            self.metrics.first_event_seconds.set(time.monotonic() - self._started)
+            self.log.info('first event handled after '
+                          f'{self.metrics.first_event_seconds.value:.2f}s')
+
     async def stop(self):
-        self.client.stop()
-        await self.crypto_db.stop()
+        for task in self._background_tasks:
+            task.cancel()
+        self._background_tasks = []
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        if self.client:
+            self.client.stop()
+        if self.pending_decryptions:
+            await self.pending_decryptions.stop()
+        await self.text_message_command_handler.flush()
+        if self._owns_convert_pool:
+            await self.convert_pool.stop()
+        if self.crypto_db and not self._shared_database:
+            await self.crypto_db.stop()
         self.log.info('client stopped!')
 
     async def start(self):
         self.log.info('starting client')
-        self.client.start(None)
+        if not self._background_tasks:
+            self._background_tasks = [
+                asyncio.create_task(self.storage_strategy.run_eviction()),
+                asyncio.create_task(monitor_event_loop_lag(self.metrics)),
+                asyncio.create_task(self.storage_strategy.create_missing_derivatives()),
+                asyncio.create_task(self.ingest_pipeline.resume_journal()),
+                asyncio.create_task(self.transcode_queue.run()),
+            ]
+            if self.metrics_server:
+                await self.metrics_server.start()
+        self.client.start(self.sync_filter_id)
@@ -0,0 +1,131 @@
+"""
+    Retention policies for the stored media.
+
+    The policies select the files to delete from the media index, the media_path
+    is never listed. The policies run one after the other and every policy sees the
+    index after the deletions of the policies before, so a file is only deleted once
+    and the later policies do not delete more than needed.
+"""
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List
+from .configuration import MatrixConfiguration
+from .eviction import MEGABYTE, plan_eviction
+from .media_index import MediaIndex
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+class RetentionPolicy(ABC):
+    """
+    base class of the policies, favourites are never selected with {keep_favourites}
+    """
+
+    name = ''
+
+    def __init__(self, keep_favourites: bool = True) -> None:
+        self.keep_favourites = keep_favourites
+
+    @abstractmethod
+    def select(self, media_index: MediaIndex, now: float) -> List[str]:
+        """
+        the files to delete, the eldest first
+        """
+
+
+class MaxAgePolicy(RetentionPolicy):
+    """
+    deletes files which are older than {max_age_days}
+    """
+
+    name = 'max age'
+
+    def __init__(self, max_age_days: float, keep_favourites: bool = True) -> None:
+        super().__init__(keep_favourites)
+        self.max_age_seconds = max_age_days * DAY_SECONDS
+
+    def select(self, media_index: MediaIndex, now: float) -> List[str]:
+        return media_index.older_than(now - self.max_age_seconds, self.keep_favourites)
+
+
+class QuotaPolicy(RetentionPolicy):
+    """
+    deletes the eldest files of every room or sender (the {column}) which stores
+    more than {max_bytes}, files without a known room or sender are not counted
+    """
+
+    def __init__(self, column: str, max_bytes: int, keep_favourites: bool = True) -> None:
+        super().__init__(keep_favourites)
+        self.column = column
+        self.max_bytes = max_bytes
+        self.name = f'{column} quota'
+
+    def select(self, media_index: MediaIndex, now: float) -> List[str]:
+        selected = []
+        for (value, size) in media_index.usage_over(self.column, self.max_bytes):
+            candidates = media_index.iter_deletable(self.keep_favourites, self.column, value)
+            selected.extend(plan_eviction(candidates, size - self.max_bytes).files)
+        return selected
+
+
+class MaxTotalSizePolicy(RetentionPolicy):
+    """
+    deletes the eldest files while all files together are bigger than {max_bytes}
+    """
+
+    name = 'max total size'
+
+    def __init__(self, max_bytes: int, keep_favourites: bool = True) -> None:
+        super().__init__(keep_favourites)
+        self.max_bytes = max_bytes
+
+    def select(self, media_index: MediaIndex, now: float) -> List[str]:
+        excess = media_index.stats().size - self.max_bytes
+        return plan_eviction(media_index.iter_deletable(self.keep_favourites), excess).files
+
+
+class RetentionEngine:
+    """
+    applies the policies in the given order, further policies can be passed
+    to the DefaultStorageStrategy
+    """
+
+    def __init__(self, policies: List[RetentionPolicy], logger) -> None:
+        self.policies = policies
+        self.log = logger
+
+    @staticmethod
+    def from_configuration(config: MatrixConfiguration, logger) -> 'RetentionEngine':
+        """
+        the age and the quotas are applied first, they usually delete the eldest files
+        which also counts for {retention_max_total_mb}
+        """
+        keep = config.retention_keep_favourites
+        policies = []
+        if config.retention_max_age_days > 0:
+            policies.append(MaxAgePolicy(config.retention_max_age_days, keep))
+        if config.retention_room_quota_mb > 0:
+            policies.append(QuotaPolicy('room_id', config.retention_room_quota_mb * MEGABYTE, keep))
+        if config.retention_sender_quota_mb > 0:
+            policies.append(QuotaPolicy('sender', config.retention_sender_quota_mb * MEGABYTE,
+                                        keep))
+        if config.retention_max_total_mb > 0:
+            policies.append(MaxTotalSizePolicy(config.retention_max_total_mb * MEGABYTE, keep))
+        return RetentionEngine(policies, logger)
+
+    def enforce(self,
+                media_index: MediaIndex,
+                delete: Callable[[List[str]], List[str]],
+                now: float = None) -> Dict[str, int]:
+        """
+        runs the policies and deletes the selected files with {delete}, which has to remove
+        them from the index, returns the number of deleted files per policy
+        """
+        now = time.time() if now is None else now
+        deleted = {}
+        for policy in self.policies:
+            selected = policy.select(media_index, now)
+            if selected:
+                deleted[policy.name] = len(delete(selected))
+                self.log.trace(f'retention {policy.name}: deleted {deleted[policy.name]} files')
+        return deleted
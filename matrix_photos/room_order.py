@@ -0,0 +1,82 @@
+"""
+    Order of the events per room.
+
+    The encrypted events of a sync are decrypted in separate tasks which finish in any
+    order. The position of an event in its room is reserved before the decryption, so
+    the work which depends on the previous events of the room can wait for them.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, NamedTuple, Optional
+from mautrix.types.primitive import EventID, RoomID
+
+
+class RoomPosition(NamedTuple):
+    """
+    the position of an event in its room, it is done after {previous} is done
+    """
+    room_id: RoomID
+    previous: Optional[asyncio.Future]
+    done: asyncio.Future
+
+
+class RoomOrder:
+    """
+    the position of an event is done once the event and all events before it in
+    the room are released
+    """
+
+    def __init__(self) -> None:
+        self._room_tails: Dict[RoomID, asyncio.Future] = {}
+        self._reserved: Dict[EventID, RoomPosition] = {}
+
+    def _enqueue(self, room_id: RoomID) -> RoomPosition:
+        previous = self._room_tails.get(room_id)
+        done = asyncio.get_running_loop().create_future()
+        self._room_tails[room_id] = done
+        return RoomPosition(room_id, previous, done)
+
+    def reserve(self, room_id: RoomID, event_id: EventID) -> None:
+        """
+        reserves the position of the event in the room before it is decrypted,
+        an event which does not take the position has to be released with release_reserved
+        """
+        self._reserved[event_id] = self._enqueue(room_id)
+
+    def take(self, room_id: RoomID, event_id: EventID = None) -> RoomPosition:
+        """
+        the position reserved for {event_id}, or the end of the room when it was not reserved
+        """
+        return self._reserved.pop(event_id, None) or self._enqueue(room_id)
+
+    def release(self, position: RoomPosition) -> None:
+        """
+        the next event of the room is done once the previous event is released too
+        """
+        if position.previous and not position.previous.done():
+            position.previous.add_done_callback(
+                lambda _: self.release(position._replace(previous=None)))
+            return
+        if not position.done.done():
+            position.done.set_result(None)
+        if self._room_tails.get(position.room_id) is position.done:
+            del self._room_tails[position.room_id]
+
+    def release_reserved(self, event_id: EventID) -> None:
+        position = self._reserved.pop(event_id, None)
+        if position:
+            self.release(position)
+
+    @asynccontextmanager
+    async def in_order(self, room_id: RoomID, event_id: EventID = None):
+        """
+        waits until the events of the room before {event_id} are done,
+        the event is released when the block is left
+        """
+        position = self.take(room_id, event_id)
+        try:
+            if position.previous:
+                await asyncio.shield(position.previous)
+            yield
+        finally:
+            self.release(position)
@@ -0,0 +1,70 @@
+"""
+    Persistent login session of the client.
+
+    The access token is stored next to the crypto tables in the crypto database,
+    so the client does not have to log in (and create a new device session on the
+    homeserver) on every start. The id of the uploaded sync filter is kept as well.
+"""
+from typing import NamedTuple, Optional
+from mautrix.util.async_db import Database
+
+
+class StoredSession(NamedTuple):
+    device_id: str
+    access_token: str
+
+
+class SessionStore:
+    """
+    keeps the access token and the sync filter id of {user_id}
+    """
+
+    def __init__(self, database: Database, user_id: str) -> None:
+        self.database = database
+        self.user_id = user_id
+
+    async def open(self) -> None:
+        await self.database.execute('''CREATE TABLE IF NOT EXISTS photos_session (
+            user_id TEXT PRIMARY KEY,
+            device_id TEXT NOT NULL,
+            access_token TEXT NOT NULL
+        )''')
+        await self.database.execute('''CREATE TABLE IF NOT EXISTS photos_sync_filter (
+            user_id TEXT PRIMARY KEY,
+            filter_hash TEXT NOT NULL,
+            filter_id TEXT NOT NULL
+        )''')
+
+    async def get(self) -> Optional[StoredSession]:
+        row = await self.database.fetchrow('SELECT device_id, access_token FROM photos_session '
+                                           'WHERE user_id = $1', self.user_id)
+        if not row:
+            return None
+        return StoredSession(row['device_id'], row['access_token'])
+
+    async def put(self, device_id: str, access_token: str) -> None:
+        await self.database.execute('INSERT INTO photos_session '
+                                    '(user_id, device_id, access_token) '
+                                    'VALUES ($1, $2, $3) ON CONFLICT (user_id) DO UPDATE '
+                                    'SET device_id = excluded.device_id, '
+                                    'access_token = excluded.access_token',
+                                    self.user_id, device_id, access_token)
+
+    async def delete(self) -> None:
+        await self.database.execute('DELETE FROM photos_session WHERE user_id = $1', self.user_id)
+
+    async def get_filter_id(self, filter_hash: str) -> Optional[str]:
+        """
+        the id of the uploaded filter, None if the filter definition has changed
+        """
+        return await self.database.fetchval('SELECT filter_id FROM photos_sync_filter '
+                                            'WHERE user_id = $1 AND filter_hash = $2',
+                                            self.user_id, filter_hash)
+
+    async def put_filter_id(self, filter_hash: str, filter_id: str) -> None:
+        await self.database.execute('INSERT INTO photos_sync_filter '
+                                    '(user_id, filter_hash, filter_id) '
+                                    'VALUES ($1, $2, $3) ON CONFLICT (user_id) DO UPDATE '
+                                    'SET filter_hash = excluded.filter_hash, '
+                                    'filter_id = excluded.filter_id',
+                                    self.user_id, filter_hash, filter_id)
@@ -1,20 +1,53 @@
 import os
+import asyncio
+import glob
+import hashlib
+import shutil
+import tempfile
 from pathlib import Path
-from .utils import reread_files, disk_usage, get_media_file_list
+from typing import AsyncIterator, List, NamedTuple, Optional
+from .utils import reread_files, disk_usage, set_default_mode
 from .configuration import MatrixConfiguration
-from .file_convert import FileConvert
+from .file_convert import FileConvert, ConvertPool
+from .derivative_cache import DerivativeCache
+from .media_index import MediaIndex
+from .media_list import RecentMediaList
+from .eviction import MEGABYTE, bytes_to_free, plan_eviction
+from .metrics import Metrics
+from .retention import RetentionEngine
 
+CAPTION_SOURCE_DIRECTORY = '.captions'
+THUMBNAIL_DIRECTORY = '.thumbnails'
 
+
+class StagedFile(NamedTuple):
+    temp_filename: str
+    filename: str
+    plaintext_sha256: str
+    encrypted_sha256: str
+
+
+# pylint: disable=too-many-public-methods
 class DefaultStorageStrategy():
     """
     stores the latest {max_file_count} pictures in the {media_file} textfile
-    all other pictures are written to the {complete_media_file} textfile
+    all other pictures are written to the {complete_media_file} textfile,
+    the {retention} engine is built from the configuration if it is not given
     """
 
-    def __init__(self, config: MatrixConfiguration, logger) -> None:
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 config: MatrixConfiguration,
+                 logger,
+                 convert_pool: ConvertPool,
+                 metrics: Metrics = None,
+                 retention: RetentionEngine = None) -> None:
         self._config = config
         self.log = logger
-        self._convert = FileConvert(config.convert.convert_binary, logger)
+        self.metrics = metrics or Metrics()
+        self.retention = retention or RetentionEngine.from_configuration(config, logger)
+        self._convert = FileConvert(config.convert.convert_binary, logger, convert_pool,
+                                    config.convert.backend)
 
         media_path = self._config.media_path
         # pylint: disable=line-too-long
@@ -30,6 +63,19 @@ class DefaultStorageStrategy():
             self.log.trace('local image directory found')
         # pylint: enable=line-too-long
 
+        self.media_index = MediaIndex(media_path, logger)
+        self.recent_media = RecentMediaList(self._config.media_file, self._config.max_file_count)
+        self.derivatives: Optional[DerivativeCache] = None
+        if self._config.derivative_size:
+            convert_params = (self._config.convert.convert_parameters
+                              if self._config.convert.convert_on_save else [])
+            self.derivatives = DerivativeCache(media_path,
+                                               self._config.derivative_size,
+                                               self._config.derivative_cache_mb * MEGABYTE,
+                                               self._convert,
+                                               convert_params,
+                                               logger)
+
     def _append_to_complete_media_file(self, filename) -> None:
         if not self._config.complete_media_file:
             return
@@ -38,17 +84,7 @@ class DefaultStorageStrategy():
             binary_file.write(f'{filename}\n')
 
     def _add_to_media_file(self, filename) -> None:
-        file_data = []
-        try:
-            with open(self._config.media_file, 'r', encoding='utf-8') as text_file:
-                file_data = text_file.readlines()
-        except IOError:
-            pass
-
-        file_data.append(f'{filename}\n')
-        with open(self._config.media_file, 'w+', encoding='utf-8') as text_file:
-            new_data = file_data[-self._config.max_file_count:]
-            text_file.writelines(new_data)
+        self.recent_media.append(filename)
 
     @staticmethod
     def _get_next_filename(prefered_filename: str, index: int = 0) -> str:
@@ -60,55 +96,383 @@ class DefaultStorageStrategy():
             index += 1
         return new_filename
 
-    def _convert_file(self, filename: str):
-        self._convert.convert_file(
+    async def _convert_file(self, filename: str):
+        await self._convert.convert_file(
             filename, self._config.convert.convert_parameters)
 
-    def _delete_eldest_file(self):
-        try:
-            file_list = get_media_file_list(self._config.media_path)
-            if len(file_list) > 0:
-                file_to_delete = file_list[0]
+    async def _prepare_file(self, filename: str, plaintext_sha256: str) -> None:
+        """
+        creates the display sized copy of the file if {derivative_size} is set,
+        otherwise the file itself is converted if {convert_on_save} is set
+        """
+        if self.derivatives:
+            await self.derivatives.create(plaintext_sha256, filename)
+            if self.derivatives.enforce_limit():
+                self.reread()
+        elif self._config.convert.convert_on_save:
+            await self._convert_file(filename)
+
+    def _display_path(self, path: str, plaintext_sha256: Optional[str]) -> str:
+        if self.derivatives:
+            return self.derivatives.lookup(plaintext_sha256, path) or path
+        return path
+
+    def display_path_of(self, path: str) -> str:
+        """
+        the file which is listed for the stored {path}, its display sized copy if there is one
+        """
+        return self._display_path(path, self.media_index.plaintext_hashes([path]).get(path))
+
+    def _delete_files(self, files: List[str]) -> List[str]:
+        deleted = []
+        for file_to_delete in files:
+            try:
                 os.remove(file_to_delete)
-        # pylint: disable=broad-except
-        except Exception as error:
-            self.log.error(error)
-        # pylint: enable=broad-except
-
-    def _delete_eldest_files(self):
-        free_space_mb = disk_usage(
-            self._config.media_path).free / (1024 * 1024)
-        if ((self._config.min_free_disk_space_mb > 0)
-                    and self._config.min_free_disk_space_mb > free_space_mb
-                ):
-            self._delete_eldest_file()
-            self._delete_eldest_files()
-
-    def _check_storage_limit(self):
-        free_space_mb = disk_usage(
-            self._config.media_path).free / (1024 * 1024)
-        if ((self._config.min_free_disk_space_mb > 0)
-                and self._config.min_free_disk_space_mb > free_space_mb
-            ):
-            self._delete_eldest_files()
-            reread_files(self._config.media_path,
-                         self._config.media_file,
-                         self._config.complete_media_file,
-                         self._config.max_file_count)
-
-    def store(self, data: bytes, filename: str) -> None:
+                deleted.append(file_to_delete)
+            except FileNotFoundError:
+                deleted.append(file_to_delete)
+            except Exception as error:  # pylint: disable=broad-except
+                self.log.error(error)
+        return deleted
+
+    def evict(self, threshold_mb: int) -> int:
+        """
+        when less than {threshold_mb} are free, the eldest files are deleted in one batch
+        until {min_free_disk_space_mb} + {eviction_headroom_mb} are free again,
+        with {retention_keep_favourites} the favourites are deleted last,
+        nothing is deleted if {min_free_disk_space_mb} is 0,
+        returns the number of deleted files
+        """
+        if self._config.min_free_disk_space_mb <= 0:
+            return 0
+        target_mb = self._config.min_free_disk_space_mb + self._config.eviction_headroom_mb
+        return self.evict_bytes(bytes_to_free(self.free_bytes(), threshold_mb, target_mb))
+
+    def free_bytes(self) -> int:
+        return disk_usage(self._config.media_path).free
+
+    def evict_bytes(self, required_bytes: int) -> int:
+        """
+        deletes the eldest files until they cover {required_bytes},
+        returns the number of deleted files
+        """
+        if required_bytes <= 0:
+            return 0
+
+        self.media_index.reconcile()
+
+        def candidates():
+            for (path, size, plaintext_sha256) in self.media_index.iter_oldest_hashed(
+                    self._config.retention_keep_favourites):
+                derivative_size = (self.derivatives.size_of(plaintext_sha256, path)
+                                   if self.derivatives else 0)
+                yield (path, (size or 0) + derivative_size)
+
+        plan = plan_eviction(candidates(), required_bytes)
+        self.log.trace(f'evict {len(plan.files)} files to free {plan.size} bytes')
+
+        deleted = self._delete_media(plan.files)
+        self.metrics.evicted_files.inc(len(deleted))
+        self.reread()
+        return len(deleted)
+
+    def _delete_media(self, paths: List[str]) -> List[str]:
+        """
+        deletes the files together with their display sized copies and captions,
+        returns the deleted files which are also removed from the index
+        """
+        hashes = self.media_index.plaintext_hashes(paths)
+        deleted = self._delete_files(paths)
+        displayed = list(deleted)
+        if self.derivatives:
+            for path in deleted:
+                plaintext_sha256 = hashes.get(path)
+                if plaintext_sha256:
+                    displayed.append(self.derivatives.path_for(plaintext_sha256, path))
+                self.derivatives.remove(plaintext_sha256, path)
+        self._forget_captions(displayed)
+        self.media_index.remove_many(deleted)
+        return deleted
+
+    def apply_retention(self, now: float = None) -> int:
+        """
+        deletes the files selected by the retention policies, returns the number of deleted files
+        """
+        deleted = sum(self.retention.enforce(self.media_index, self._delete_media, now).values())
+        if deleted:
+            self.log.info(f'retention deleted {deleted} files')
+            self.metrics.retention_deleted_files.inc(deleted)
+            self.reread()
+        return deleted
+
+    def _caption_source_path(self, target: str) -> str:
+        return os.path.join(self._config.media_path, CAPTION_SOURCE_DIRECTORY,
+                            os.path.basename(target))
+
+    def caption_source(self, target: str) -> str:
+        """
+        the copy of {target} without captions, it is created before the first caption
+        is drawn so the captions are always rendered from the same image
+        """
+        source = self._caption_source_path(target)
+        if not os.path.exists(source):
+            os.makedirs(os.path.dirname(source), exist_ok=True)
+            shutil.copy2(target, source)
+        return source
+
+    def _forget_captions(self, paths: List[str]) -> None:
+        self._delete_files([self._caption_source_path(path) for path in paths])
+        self.media_index.remove_captions(paths)
+
+    async def run_eviction(self) -> None:
+        """
+        evicts files in the background before the {min_free_disk_space_mb} limit is reached,
+        so storing new files does not have to wait for it, and applies the retention policies
+        """
+        threshold_mb = self._config.min_free_disk_space_mb + self._config.eviction_headroom_mb
+        while True:
+            try:
+                self.apply_retention()
+                self.evict(threshold_mb)
+            # pylint: disable=broad-except
+            except Exception as error:
+                self.log.error(error)
+            # pylint: enable=broad-except
+            await asyncio.sleep(self._config.eviction_interval_seconds)
+
+    def reread(self) -> None:
+        """
+        recreates the media files from the {media_path},
+        the files are listed with their display sized copy if there is one
+        """
+        file_list = [self._display_path(path, plaintext_sha256)
+                     for (path, plaintext_sha256) in self.media_index.hashed_paths()]
+        reread_files(self._config.media_path,
+                     self._config.media_file,
+                     self._config.complete_media_file,
+                     self._config.max_file_count,
+                     file_list)
+        self.recent_media.reload()
+
+    async def create_missing_derivatives(self) -> None:
+        """
+        creates the display sized copies of the latest {max_file_count} files in the background,
+        e.g. after {derivative_size} was changed or the cache was evicted
+        """
+        if not self.derivatives:
+            return
+        latest = self.media_index.hashed_paths()[-self._config.max_file_count:]
+        missing = [(path, plaintext_sha256) for (path, plaintext_sha256) in latest
+                   if plaintext_sha256 and not self.derivatives.lookup(plaintext_sha256, path)]
+        for (path, plaintext_sha256) in missing:
+            await self.derivatives.create(plaintext_sha256, path)
+        if missing:
+            self.derivatives.enforce_limit()
+            self.reread()
+
+    def _publish(self, target: str) -> None:
+        self._add_to_media_file(target)
+        self._append_to_complete_media_file(target)
+
+    async def store(self, data: bytes, filename: str) -> None:
         target = DefaultStorageStrategy._get_next_filename(
             os.path.join(self._config.media_path, filename))
 
-        self._check_storage_limit()
-
         self.log.trace(f'save file as {target}')
         with open(target, "wb") as binary_file:
             binary_file.write(data)
             binary_file.close()
 
-        if self._config.convert.convert_on_save:
-            self._convert_file(target)
+        plaintext_sha256 = hashlib.sha256(data).hexdigest()
+        await self._prepare_file(target, plaintext_sha256)
 
-        self._add_to_media_file(target)
-        self._append_to_complete_media_file(target)
+        self.media_index.add(target, plaintext_sha256)
+        self._publish(self._display_path(target, plaintext_sha256))
+
+    def find_duplicate(self, encrypted_sha256: str) -> Optional[str]:
+        return self.media_index.find_by_encrypted_hash(encrypted_sha256)
+
+    async def stage(self,
+                    chunks: AsyncIterator[bytes],
+                    filename: str,
+                    encrypted_sha256: str = None,
+                    part_filename: str = None) -> Optional[StagedFile]:
+        """
+        writes the chunks into a hidden temporary file in the {media_path},
+        the temporary file is removed if the iterator raises.
+        the chunks are appended to an existing {part_filename} which is kept if the
+        iterator raises, so an interrupted download can be continued later.
+        returns None if a file with the same content is already stored
+        """
+        sha256 = hashlib.sha256()
+        if part_filename:
+            temp_filename = part_filename
+            if os.path.exists(part_filename):
+                with open(part_filename, 'rb') as binary_file:
+                    for block in iter(lambda: binary_file.read(64 * 1024), b''):
+                        sha256.update(block)
+            # pylint: disable=consider-using-with
+            target_file = open(part_filename, 'ab')
+        else:
+            (_, ext) = os.path.splitext(filename)
+            (handle, temp_filename) = tempfile.mkstemp(prefix='.',
+                                                       suffix=f'.part{ext}',
+                                                       dir=self._config.media_path)
+            set_default_mode(handle)
+            target_file = os.fdopen(handle, "wb")
+        try:
+            with target_file as binary_file:
+                async for chunk in chunks:
+                    sha256.update(chunk)
+                    binary_file.write(chunk)
+                binary_file.flush()
+                os.fsync(binary_file.fileno())
+        except BaseException:
+            if not part_filename and os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+        plaintext_sha256 = sha256.hexdigest()
+        existing = self.media_index.find_by_plaintext_hash(plaintext_sha256)
+        if existing:
+            self.log.trace(f'skip file {filename}, same content as {existing}')
+            os.remove(temp_filename)
+            if encrypted_sha256:
+                self.media_index.add(existing, plaintext_sha256, encrypted_sha256)
+            return None
+
+        return StagedFile(temp_filename, filename, plaintext_sha256, encrypted_sha256)
+
+    @staticmethod
+    def _hash_filename(encrypted_sha256: str) -> str:
+        return encrypted_sha256.replace('/', '_').replace('+', '-')
+
+    def part_filename(self, encrypted_sha256: str, filename: str) -> str:
+        """
+        the hidden file an attachment is downloaded into, it is named after the
+        hash of the attachment so a restarted download finds it again
+        """
+        (_, ext) = os.path.splitext(filename)
+        name = DefaultStorageStrategy._hash_filename(encrypted_sha256)
+        return os.path.join(self._config.media_path, f'.{name}.part{ext}')
+
+    def thumbnail_path(self, encrypted_sha256: str, ext: str) -> str:
+        """
+        the thumbnail shown while the attachment is downloaded, it is named after the
+        hash of the attachment so the commit of the attachment finds it
+        """
+        name = DefaultStorageStrategy._hash_filename(encrypted_sha256)
+        return os.path.join(self._config.media_path, THUMBNAIL_DIRECTORY, f'{name}{ext}')
+
+    async def show_thumbnail(self,
+                             chunks: AsyncIterator[bytes],
+                             encrypted_sha256: str,
+                             ext: str) -> str:
+        """
+        writes the thumbnail of the attachment through a hidden temporary file and
+        adds it to the {media_file} until the attachment is committed
+        """
+        path = self.thumbnail_path(encrypted_sha256, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_filename = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}')
+        try:
+            with open(temp_filename, 'wb') as binary_file:
+                async for chunk in chunks:
+                    binary_file.write(chunk)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+        os.replace(temp_filename, path)
+        self._add_to_media_file(path)
+        return path
+
+    def remove_thumbnail(self, encrypted_sha256: str, replacement: str = None) -> bool:
+        """
+        deletes the thumbnail of the attachment and puts {replacement} at its position
+        in the {media_file}, returns False if no thumbnail was listed
+        """
+        pattern = glob.escape(self.thumbnail_path(encrypted_sha256, '')) + '.*'
+        listed = False
+        for path in glob.glob(pattern):
+            os.remove(path)
+            listed = self.recent_media.replace(path, replacement) or listed
+        return listed
+
+    async def convert_staged(self, staged: StagedFile) -> None:
+        await self._prepare_file(staged.temp_filename, staged.plaintext_sha256)
+
+    def commit(self,
+               staged: StagedFile,
+               timestamp: float = None,
+               room_id: str = None,
+               sender: str = None) -> str:
+        """
+        renames the staged file to its final filename and adds it to the media files,
+        a listed thumbnail of the file is replaced by the file. the modification time
+        is set to {timestamp} (e.g. of backfilled events) so the file is sorted in
+        by the time it was sent
+        """
+        target = DefaultStorageStrategy._get_next_filename(
+            os.path.join(self._config.media_path, staged.filename))
+        self.log.trace(f'save file as {target}')
+        os.replace(staged.temp_filename, target)
+        if timestamp:
+            os.utime(target, (timestamp, timestamp))
+
+        self.media_index.add(target, staged.plaintext_sha256, staged.encrypted_sha256,
+                             room_id, sender)
+        display_path = self._display_path(target, staged.plaintext_sha256)
+        if staged.encrypted_sha256 and self.remove_thumbnail(staged.encrypted_sha256,
+                                                             display_path):
+            self._append_to_complete_media_file(display_path)
+        else:
+            self._publish(display_path)
+        return target
+
+    def replace_transcoded(self, source: str, transcoded: str, ext: str) -> Optional[str]:
+        """
+        puts the {transcoded} copy in the place of {source} in the media files and the index,
+        the copy gets the modification time of {source} so the order of the files is kept,
+        returns None if {source} was deleted in the meantime
+        """
+        if not os.path.isfile(source):
+            self._delete_files([transcoded])
+            return None
+
+        (base, _) = os.path.splitext(source)
+        target = base + ext
+        if target != source:
+            target = DefaultStorageStrategy._get_next_filename(target)
+        stat = os.stat(source)
+        os.utime(transcoded, (stat.st_atime, stat.st_mtime))
+        os.replace(transcoded, target)
+        if target != source:
+            self._delete_files([source])
+        self.media_index.rename(source, target)
+        self.reread()
+        return target
+
+    @staticmethod
+    def discard(staged: StagedFile) -> None:
+        if os.path.exists(staged.temp_filename):
+            os.remove(staged.temp_filename)
+
+    async def store_stream(self,
+                           chunks: AsyncIterator[bytes],
+                           filename: str,
+                           encrypted_sha256: str = None) -> Optional[str]:
+        """
+        stages, converts and commits the file in one go,
+        returns None if a file with the same content is already stored
+        """
+        staged = await self.stage(chunks, filename, encrypted_sha256)
+        if not staged:
+            return None
+
+        try:
+            await self.convert_staged(staged)
+            return self.commit(staged)
+        except BaseException:
+            DefaultStorageStrategy.discard(staged)
+            raise
@@ -0,0 +1,118 @@
+"""
+    Supervisor mode, runs the clients of several photo frame accounts in one process.
+
+    The accounts are listed in the accounts section of the configuration, every entry
+    overrides the values of the matrix section (at least user_id, user_password,
+    device_id and the media paths).
+"""
+import asyncio
+from typing import Dict, List
+from mautrix.util.async_db import Database as AsyncDatabase
+from .configuration import MatrixConfiguration
+from .database import DatabaseSettings, create_database, start_database
+from .file_convert import ConvertPool
+from .photos_client import AccountMismatchException, PhotOsClient
+
+RETRY_SECONDS = 5
+
+
+def load_account_configurations(config: Dict) -> List[MatrixConfiguration]:
+    """
+    one configuration per entry of the accounts section merged with the matrix section,
+    or only the matrix section if there is no accounts section
+    """
+    matrix = config['matrix']
+    accounts = config.get('accounts')
+    if not accounts:
+        return [MatrixConfiguration.from_dict(matrix)]
+
+    configurations = [MatrixConfiguration.from_dict({**matrix, **account})
+                      for account in accounts]
+    # an empty complete_media_file and metrics_port 0 are disabled and can be shared
+    for attribute in ('user_id', 'device_id', 'media_path', 'media_file',
+                      'complete_media_file', 'metrics_port'):
+        values = [getattr(configuration, attribute) for configuration in configurations]
+        values = [value for value in values if value]
+        if len(set(values)) != len(values):
+            raise ValueError(f'every account needs its own {attribute}')
+    return configurations
+
+
+class Supervisor:
+    """
+    runs one PhotOsClient per account on the same event loop, all clients share
+    the http session, one database pool per {database_url} and the convert pool
+    (configured by the convert section of the first account)
+    """
+
+    def __init__(self,
+                 configurations: List[MatrixConfiguration],
+                 client_session,
+                 logger) -> None:
+        self.configurations = configurations
+        self.client_session = client_session
+        self.log = logger
+        self.convert_pool = ConvertPool(configurations[0].convert, logger)
+        self.databases: Dict[str, AsyncDatabase] = {}
+        self.clients: List[PhotOsClient] = []
+        self._tasks: List[asyncio.Task] = []
+
+    async def _database(self, configuration: MatrixConfiguration) -> AsyncDatabase:
+        """
+        the pool settings of the first account with a {database_url} are used
+        """
+        database_url = configuration.database_url
+        if database_url not in self.databases:
+            settings = DatabaseSettings.from_configuration(configuration)
+            database = create_database(settings)
+            await start_database(database, settings)
+            self.databases[database_url] = database
+        return self.databases[database_url]
+
+    async def _run_client(self, client: PhotOsClient) -> None:
+        """
+        connects the client until it succeeds, an account which does not match the
+        homeserver is dropped without stopping the other accounts
+        """
+        while True:
+            # pylint: disable=broad-except
+            try:
+                await client.initialize()
+                await client.start()
+                return
+            except AccountMismatchException as error:
+                client.log.error(f'{error}, the account is not started')
+                return
+            except Exception as error:
+                client.log.exception(error)
+            # pylint: enable=broad-except
+            await asyncio.sleep(RETRY_SECONDS)
+
+    async def start(self) -> None:
+        """
+        creates the clients and connects them in the background,
+        an account which can not connect does not delay the others
+        """
+        for configuration in self.configurations:
+            database = await self._database(configuration)
+            client = PhotOsClient(configuration,
+                                  self.client_session,
+                                  self.log.getChild(configuration.user_id),
+                                  database,
+                                  self.convert_pool)
+            self.clients.append(client)
+            self._tasks.append(asyncio.create_task(self._run_client(client)))
+        self.log.info(f'supervising {len(self.clients)} accounts')
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        results = await asyncio.gather(*(client.stop() for client in self.clients),
+                                       return_exceptions=True)
+        for error in results:
+            if isinstance(error, Exception):
+                self.log.error(error)
+        await self.convert_pool.stop()
+        for database in self.databases.values():
+            await database.stop()
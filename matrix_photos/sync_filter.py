@@ -0,0 +1,54 @@
+"""
+    Server side filter for the sync requests.
+
+    The photo frame only needs invites, room messages, encrypted events and the
+    to-device traffic (which is not filtered), presence, typing notifications,
+    receipts and account data are dropped by the homeserver.
+"""
+import hashlib
+import json
+from mautrix.types import EventType
+from mautrix.types.filter import (EventFilter,
+                                  Filter,
+                                  RoomEventFilter,
+                                  RoomFilter,
+                                  StateFilter)
+
+# pylint: disable=no-member
+TIMELINE_TYPES = [EventType.ROOM_MESSAGE, EventType.ROOM_ENCRYPTED, EventType.ROOM_MEMBER]
+STATE_TYPES = [EventType.ROOM_MEMBER, EventType.ROOM_ENCRYPTION]
+# pylint: enable=no-member
+
+
+# the attrs based filter classes are not understood by pylint
+# pylint: disable=unexpected-keyword-arg
+def _nothing() -> EventFilter:
+    return EventFilter(not_types=['*'])
+
+
+def build_sync_filter(timeline_limit: int, lazy_load_members: bool) -> Filter:
+    """
+    at most {timeline_limit} timeline events per room and sync, with {lazy_load_members}
+    the homeserver only sends the members which sent the synced events
+    """
+    return Filter(
+        presence=_nothing(),
+        account_data=_nothing(),
+        room=RoomFilter(
+            ephemeral=RoomEventFilter(not_types=['*']),
+            account_data=RoomEventFilter(not_types=['*']),
+            state=StateFilter(types=STATE_TYPES, lazy_load_members=lazy_load_members),
+            timeline=RoomEventFilter(types=TIMELINE_TYPES,
+                                     limit=timeline_limit,
+                                     lazy_load_members=lazy_load_members),
+        ),
+    )
+# pylint: enable=unexpected-keyword-arg
+
+
+def filter_hash(sync_filter: Filter) -> str:
+    """
+    identifies the filter definition, an uploaded filter is reused as long as it does not change
+    """
+    serialized = json.dumps(sync_filter.serialize(), sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
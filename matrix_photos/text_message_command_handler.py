@@ -1,49 +1,117 @@
+import asyncio
+from typing import Dict, List, Optional
 from mautrix.types.event.message import MessageType, TextMessageEventContent
-from .file_convert import FileConvert
+from .file_convert import FileConvert, ConvertPool
 from .configuration import MatrixConfiguration
 
 
 class TextmessageCommandHandler:
+    """
+    draws the text messages onto the media message they follow (or the last image),
+    all messages which are sent within
+    {caption_delay_seconds} of each other are drawn in one convert pass,
+    the captions are stored in the media index and always rendered from the
+    image without captions
+    """
 
-    def __init__(self, config: MatrixConfiguration, logger) -> None:
+    def __init__(self,
+                 config: MatrixConfiguration,
+                 logger,
+                 convert_pool: ConvertPool,
+                 storage_strategy) -> None:
         self.log = logger
         self._config = config
+        self.storage_strategy = storage_strategy
         self._convert = FileConvert(
-            config.message_convert.convert_binary, logger)
+            config.message_convert.convert_binary, logger, convert_pool, config.convert.backend)
+        self._pending: Dict[str, List[str]] = {}
+        self._last_message: Dict[str, float] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
 
     def _get_last_filename(self):
-        file_data = []
-        try:
-            with open(self._config.media_file, 'r', encoding='utf-8') as text_file:
-                file_data = text_file.readlines()
-                return file_data[-1]
-        except IOError:
-            pass
-        return ""
+        return self.storage_strategy.recent_media.last()
 
     #pylint: disable=fixme, line-too-long
     # ToDo better exception handling when command fails
-    def _add_message_to_file(self, filename, message):
+    async def _add_message_to_file(self, filename, message, target=None):
         self.log.trace(f'_add_text_to_file {message}')
-        self._convert.convert_file(filename,
+        await self._convert.convert_file(filename,
                                    self._config.message_convert.convert_parameters,
                                    message=message,
-                                   convert_text_parameter=self._config.message_convert.convert_text_parameter
+                                   convert_text_parameter=self._config.message_convert.convert_text_parameter,
+                                   target=target
                                    )
     #pylint: enable=fixme, line-too-long
 
-    def _handle_text_message(self, content: TextMessageEventContent):
-        target_filename = str(self._get_last_filename()).strip()
+    async def render_captions(self, target_filename: str) -> None:
+        """
+        draws the stored and the pending captions of {target_filename} in one pass
+        """
+        messages = self._pending.pop(target_filename, [])
+        self._last_message.pop(target_filename, None)
+        media_index = self.storage_strategy.media_index
+        captions = media_index.captions(target_filename) + messages
+        if not captions:
+            return
+        media_index.set_captions(target_filename, captions)
+
+        source = self.storage_strategy.caption_source(target_filename)
+        self.log.trace(f'render {len(captions)} captions onto {target_filename}')
+        await self._add_message_to_file(source, '\n'.join(captions), target=target_filename)
+
+    async def _render_later(self, target_filename: str) -> None:
+        loop = asyncio.get_running_loop()
+        delay = self._config.message_convert.caption_delay_seconds
+        try:
+            while loop.time() < self._last_message[target_filename] + delay:
+                await asyncio.sleep(self._last_message[target_filename] + delay - loop.time())
+        finally:
+            # messages which arrive while rendering start a new timer
+            del self._timers[target_filename]
+
+        try:
+            await self.render_captions(target_filename)
+        # pylint: disable=broad-except
+        except Exception as error:
+            self.log.error(error)
+        # pylint: enable=broad-except
+
+    def _add_caption(self, target_filename: str, message: str) -> None:
+        self._pending.setdefault(target_filename, []).append(message)
+        self._last_message[target_filename] = asyncio.get_running_loop().time()
+        if target_filename not in self._timers:
+            self._timers[target_filename] = asyncio.create_task(
+                self._render_later(target_filename))
+
+    async def _handle_text_message(self,
+                                   content: TextMessageEventContent,
+                                   target_filename: Optional[str]):
+        if target_filename is None:
+            target_filename = str(self._get_last_filename()).strip()
         self.log.trace('_handle_text_message')
         if target_filename:
-            self._add_message_to_file(target_filename, content.body)
+            self._add_caption(target_filename, content.body)
+
+    async def flush(self) -> None:
+        """
+        renders the pending captions without waiting for the delay, e.g. on shutdown
+        """
+        for timer in self._timers.values():
+            timer.cancel()
+        await asyncio.gather(*self._timers.values(), return_exceptions=True)
+        for target_filename in list(self._pending):
+            await self.render_captions(target_filename)
 
-    def handle(self, content: TextMessageEventContent):
+    async def handle(self, content: TextMessageEventContent, target_filename: str = None):
+        """
+        draws the message onto {target_filename}, the file of the media message the text
+        follows, or onto the last image if it is None. nothing is drawn if it is empty
+        """
         try:
             if (content.msgtype == MessageType.TEXT
                 and not content.body.startswith('!')
                     and self._config.message_convert.write_text_messages):
-                return self._handle_text_message(content)
+                return await self._handle_text_message(content, target_filename)
 
             return None
         # pylint: disable=broad-except
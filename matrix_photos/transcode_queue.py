@@ -0,0 +1,204 @@
+"""
+    Background transcoding of the stored videos into a format the frame can play.
+
+    The videos are transcoded with ffmpeg while the original stays in the media files,
+    the original is replaced only when its transcoded copy is finished. The jobs are
+    kept in the media index, so pending and interrupted jobs start again after a restart.
+"""
+import asyncio
+import mimetypes
+import os
+from typing import Dict, List, Tuple
+from .configuration import MatrixConfiguration
+from .metrics import Metrics
+from .storage_strategy import DefaultStorageStrategy
+
+PENDING = 'pending'
+RUNNING = 'running'
+FAILED = 'failed'
+
+
+class TranscodeQueue:
+    """
+    transcodes the stored files of the {transcode.mimetypes} with the
+    {transcode.ffmpeg_parameters}, at most {transcode.max_concurrent_jobs}
+    ffmpeg processes run at the same time
+    """
+
+    def __init__(self,
+                 config: MatrixConfiguration,
+                 logger,
+                 storage_strategy: DefaultStorageStrategy,
+                 metrics: Metrics = None) -> None:
+        self._config = config.transcode
+        self.log = logger
+        self.storage_strategy = storage_strategy
+        self.metrics = metrics or Metrics()
+        # the progress of the running jobs from 0 to 1
+        self.progress: Dict[str, float] = {}
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    @property
+    def media_index(self):
+        return self.storage_strategy.media_index
+
+    def wants(self, path: str) -> bool:
+        return (self._config.enabled
+                and mimetypes.guess_type(path)[0] in self._config.mimetypes)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, path: str) -> bool:
+        """
+        adds a job for the stored file if it is a video which is transcoded,
+        returns False for all other files
+        """
+        if not self.wants(path):
+            return False
+        self.media_index.transcode_add(path)
+        self._queue.put_nowait(path)
+        return True
+
+    async def run(self) -> None:
+        """
+        continues the jobs of the last run and transcodes the submitted files
+        until it is cancelled
+        """
+        if not self._config.enabled:
+            return
+        for job in self.media_index.transcode_jobs():
+            if job.state == RUNNING:
+                self.media_index.transcode_set_state(job.source, PENDING)
+            if job.state != FAILED:
+                self._queue.put_nowait(job.source)
+
+        workers = [asyncio.create_task(self._worker())
+                   for _ in range(max(1, self._config.max_concurrent_jobs))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _worker(self) -> None:
+        while True:
+            source = await self._queue.get()
+            job = self.media_index.transcode_job(source)
+            # a file can be queued twice, e.g. when it was submitted during the start
+            if job and job.state == PENDING:
+                await self.transcode(source)
+
+    @staticmethod
+    def _temp_filename(source: str, ext: str) -> str:
+        (base, _) = os.path.splitext(os.path.basename(source))
+        return os.path.join(os.path.dirname(source), f'.{base}.transcode{ext}')
+
+    async def transcode(self, source: str) -> None:
+        """
+        transcodes {source} into a hidden file and replaces {source} with it when ffmpeg
+        succeeded, a failed job keeps {source} and is not retried
+        """
+        if not os.path.isfile(source):
+            self.media_index.transcode_remove(source)
+            return
+
+        self.media_index.transcode_set_state(source, RUNNING)
+        temp_filename = TranscodeQueue._temp_filename(source, self._config.target_extension)
+        self.progress[source] = 0.0
+        try:
+            (returncode, error) = await self._run_ffmpeg(source, temp_filename)
+        except asyncio.TimeoutError:
+            (returncode, error) = (None, f'timed out after {self._config.job_timeout_seconds}s')
+        except OSError as os_error:
+            (returncode, error) = (None, str(os_error))
+        except BaseException:
+            self._remove(temp_filename)
+            raise
+        finally:
+            self.progress.pop(source, None)
+
+        if returncode != 0 or not os.path.isfile(temp_filename):
+            self._remove(temp_filename)
+            self.log.error(f'transcode of {os.path.basename(source)} failed: {error}')
+            self.media_index.transcode_set_state(source, FAILED, error.strip()[-500:])
+            return
+
+        target = self.storage_strategy.replace_transcoded(source, temp_filename,
+                                                          self._config.target_extension)
+        self.media_index.transcode_remove(source)
+        if target:
+            self.metrics.transcoded_files.inc()
+            self.log.info(f'transcoded {os.path.basename(source)} to {os.path.basename(target)}')
+
+    @staticmethod
+    def _remove(filename: str) -> None:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    async def _duration(self, source: str) -> float:
+        process = await asyncio.create_subprocess_exec(
+            self._config.ffprobe_binary, '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', source,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        (stdout, _) = await process.communicate()
+        try:
+            return float(stdout.decode().strip())
+        except ValueError:
+            return 0.0
+
+    async def _read_progress(self, stream: asyncio.StreamReader, source: str,
+                             duration: float) -> None:
+        """
+        reads the key=value lines of ffmpeg -progress
+        """
+        async for line in stream:
+            (key, _, value) = line.decode(errors='replace').strip().partition('=')
+            # out_time_ms is also given in microseconds
+            if key in ('out_time_us', 'out_time_ms') and duration and value.isdigit():
+                self.progress[source] = min(1.0, int(value) / 1000000 / duration)
+
+    async def _run_ffmpeg(self, source: str, target: str) -> Tuple[int, str]:
+        """
+        returns the returncode and the error output of ffmpeg,
+        the process is killed when it is cancelled or times out
+        """
+        duration = await self._duration(source)
+        params: List[str] = [self._config.ffmpeg_binary, '-y', '-nostdin', '-loglevel', 'error',
+                             '-i', source, *self._config.ffmpeg_parameters,
+                             '-progress', 'pipe:1', target]
+        process = await asyncio.create_subprocess_exec(*params,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+        try:
+            (_, stderr) = await asyncio.wait_for(
+                asyncio.gather(self._read_progress(process.stdout, source, duration),
+                               process.stderr.read()),
+                self._config.job_timeout_seconds)
+            await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        return (process.returncode, stderr.decode(errors='replace'))
+
+    def status(self) -> str:
+        """
+        the state of the unfinished and the failed jobs, with the progress of the running jobs
+        """
+        jobs = self.media_index.transcode_jobs()
+        if not jobs:
+            return 'no transcode jobs'
+        lines = []
+        for job in jobs:
+            name = os.path.basename(job.source)
+            if job.source in self.progress:
+                lines.append(f'{name}: {job.state} {self.progress[job.source]:.0%}')
+            elif job.state == FAILED:
+                lines.append(f'{name}: {job.state}, {job.error}')
+            else:
+                lines.append(f'{name}: {job.state}')
+        return '\n'.join(lines)
@@ -1,10 +1,29 @@
 import os
-from typing import Dict
+import tempfile
+from typing import Dict, Iterable, List
 from collections import namedtuple
 
 DiskUsage = namedtuple('DiskUsage', 'total used free')
 
 
+def _read_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# read once at the start, changing the umask is not thread safe
+UMASK = _read_umask()
+
+
+def set_default_mode(handle: int) -> None:
+    """
+    gives a file created by tempfile.mkstemp (mode 0600) the mode open() would
+    have given it, so the media can be read by other users (e.g. the slideshow)
+    """
+    os.fchmod(handle, 0o666 & ~UMASK)
+
+
 class MissingConfigEntryException(Exception):
 
     def __init__(self, config_key, message="Missing config entry"):
@@ -44,8 +63,15 @@ def disk_usage(path):
     return DiskUsage(total, used, free)
 
 
+def is_media_filename(file: str) -> bool:
+    # hidden files are partial downloads or internal files of the client
+    if os.path.basename(file).startswith('.'):
+        return False
+    return not file.endswith('.txt')
+
+
 def is_file(file: str):
-    if not file.endswith('.txt'):
+    if is_media_filename(file):
         return os.path.isfile(file)
     return False
 
@@ -59,18 +85,35 @@ def get_media_file_list(media_path: str):
                   key=os.path.getmtime)
 
 
+def write_lines_atomic(filename: str, lines: Iterable[str]) -> None:
+    """
+    writes the lines into a temporary file next to {filename} and renames it,
+    so readers never see a partially written file
+    """
+    (handle, temp_filename) = tempfile.mkstemp(prefix='.',
+                                               suffix='.tmp',
+                                               dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        set_default_mode(handle)
+        with os.fdopen(handle, 'w', encoding='utf-8') as text_file:
+            text_file.writelines(f'{line}\n' for line in lines)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
 def reread_files(media_path: str,
                  media_file: str,
                  complete_media_file: str,
-                 max_file_count: int) -> str:
+                 max_file_count: int,
+                 file_list: List[str] = None) -> str:
 
-    file_list = get_media_file_list(media_path)
+    if file_list is None:
+        file_list = get_media_file_list(media_path)
 
-    with open(media_file, 'w+', encoding='utf-8') as text_file:
-        new_data = map(lambda f: f'{f}\n', file_list[-max_file_count:])
-        text_file.writelines(new_data)
+    write_lines_atomic(media_file, file_list[-max_file_count:])
 
     if complete_media_file:
-        with open(complete_media_file, 'w+', encoding='utf-8') as text_file:
-            new_data = map(lambda f: f'{f}\n', file_list)
-            text_file.writelines(new_data)
+        write_lines_atomic(complete_media_file, file_list)
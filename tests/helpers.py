@@ -0,0 +1,26 @@
+import os
+import yaml
+from matrix_photos.configuration import MatrixConfiguration
+
+EXAMPLE_CONFIG_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                   '..',
+                                                   'matrix_photos',
+                                                   'config-example.yml'))
+
+
+def load_example_config() -> dict:
+    with open(EXAMPLE_CONFIG_FILE, 'r', encoding='utf-8') as stream:
+        return yaml.load(stream, Loader=yaml.SafeLoader)
+
+
+def example_configuration(workdir: str, **changes) -> MatrixConfiguration:
+    """
+    the matrix section of the example configuration which stores the media in {workdir},
+    without the complete media file and the derivatives unless they are in {changes}
+    """
+    config = MatrixConfiguration.from_dict(load_example_config()['matrix'])
+    defaults = {'media_path': os.path.join(workdir, 'media'),
+                'media_file': os.path.join(workdir, 'filelist.txt'),
+                'complete_media_file': '',
+                'derivative_size': ''}
+    return config._replace(**{**defaults, **changes})
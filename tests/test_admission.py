@@ -0,0 +1,100 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+import asyncio
+from mautrix.crypto.attachments import encrypt_attachment
+from matrix_photos.admission import AdmissionController, InsufficientDiskSpaceException
+from matrix_photos.eviction import MEGABYTE
+from matrix_photos.ingest_pipeline import IngestPipeline
+
+
+class FakeStorageStrategy:
+
+    def __init__(self, free_bytes, evictable_bytes=0):
+        self.free = free_bytes
+        self.evictable = evictable_bytes
+        self.media_index = MagicMock()
+        self.media_index.stats.return_value.size = evictable_bytes
+
+    def free_bytes(self):
+        return self.free
+
+    def evict_bytes(self, required_bytes):
+        freed = min(self.evictable, required_bytes)
+        self.evictable -= freed
+        self.free += freed
+        return 1 if freed else 0
+
+
+class TestAdmissionController(IsolatedAsyncioTestCase):
+
+    def _controller(self, storage, derivative_size=''):
+        config = MagicMock(allowed_mimetypes=['image/jpeg', 'video/mp4'],
+                           max_download_size_mb=15,
+                           min_free_disk_space_mb=1,
+                           eviction_headroom_mb=0,
+                           derivative_size=derivative_size)
+        config.convert.convert_on_save = False
+        return AdmissionController(config, MagicMock(), storage)
+
+    def test_that_events_are_rejected_before_the_download(self):
+        controller = self._controller(FakeStorageStrategy(10 * MEGABYTE, 5 * MEGABYTE))
+
+        self.assertEqual(controller.check('image/jpeg', 12 * MEGABYTE), '')
+        self.assertIn('mimetype', controller.check('image/gif', MEGABYTE))
+        self.assertIn('size', controller.check('video/mp4', 16 * MEGABYTE))
+        self.assertIn('disk space', controller.check('video/mp4', 15 * MEGABYTE))
+
+    def test_that_converted_images_reserve_the_copy(self):
+        controller = self._controller(FakeStorageStrategy(0), derivative_size='1024x600')
+
+        self.assertEqual(controller.expected_bytes(MEGABYTE, 'image/jpeg'), 2 * MEGABYTE)
+        self.assertEqual(controller.expected_bytes(MEGABYTE, 'video/mp4'), MEGABYTE)
+        self.assertEqual(controller.expected_bytes(None, 'video/mp4'), 15 * MEGABYTE)
+
+    async def test_that_files_are_evicted_ahead_of_the_download(self):
+        storage = FakeStorageStrategy(2 * MEGABYTE, 10 * MEGABYTE)
+        controller = self._controller(storage)
+
+        async with controller.reserve(4 * MEGABYTE, 'video/mp4'):
+            self.assertEqual(storage.free, 5 * MEGABYTE)
+            self.assertEqual(controller.reserved_bytes, 4 * MEGABYTE)
+
+        self.assertEqual(controller.reserved_bytes, 0)
+
+    async def test_that_images_without_a_file_extension_reserve_the_copy(self):
+        controller = self._controller(FakeStorageStrategy(10 * MEGABYTE),
+                                      derivative_size='1024x600')
+        pipeline = IngestPipeline(MagicMock(), MagicMock(), 1, MagicMock(), admission=controller)
+        reserved = []
+
+        async def stage(*args):
+            reserved.append(controller.reserved_bytes)
+        pipeline.storage_strategy.stage = stage
+        (_, encrypted_file) = encrypt_attachment(b'image')
+
+        await pipeline.ingest('!room:localhost', encrypted_file, 'photo', size=MEGABYTE,
+                              mimetype='image/jpeg')
+
+        self.assertEqual(reserved, [2 * MEGABYTE])
+
+    async def test_that_a_download_waits_until_the_reserved_space_is_released(self):
+        controller = self._controller(FakeStorageStrategy(11 * MEGABYTE))
+        order = []
+
+        async def download(name):
+            async with controller.reserve(6 * MEGABYTE, 'video/mp4'):
+                order.append(f'start {name}')
+                await asyncio.sleep(0.01)
+                order.append(f'end {name}')
+
+        await asyncio.gather(download('a'), download('b'))
+
+        self.assertEqual(order, ['start a', 'end a', 'start b', 'end b'])
+        self.assertEqual(controller.metrics.deferred_downloads.value, 1)
+
+    async def test_that_a_download_which_never_fits_is_refused(self):
+        controller = self._controller(FakeStorageStrategy(2 * MEGABYTE))
+
+        with self.assertRaises(InsufficientDiskSpaceException):
+            async with controller.reserve(4 * MEGABYTE, 'video/mp4'):
+                pass
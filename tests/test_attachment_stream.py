@@ -0,0 +1,85 @@
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import MagicMock
+import os
+from mautrix.crypto.attachments import encrypt_attachment
+from mautrix.errors import DecryptionError
+from matrix_photos.attachment_stream import AttachmentDecryptor, iter_decrypted_media
+
+
+class TestAttachmentDecryptor(TestCase):
+
+    def test_that_chunked_decryption_returns_the_plaintext(self):
+        plaintext = os.urandom(100_000)
+        ciphertext, encrypted_file = encrypt_attachment(plaintext)
+
+        decryptor = AttachmentDecryptor.from_encrypted_file(encrypted_file)
+        chunks = [decryptor.update(ciphertext[i:i + 4096])
+                  for i in range(0, len(ciphertext), 4096)]
+        decryptor.verify()
+
+        self.assertEqual(b''.join(chunks), plaintext)
+
+    def test_that_verify_raises_when_the_hash_does_not_match(self):
+        ciphertext, encrypted_file = encrypt_attachment(b'some image data')
+
+        decryptor = AttachmentDecryptor.from_encrypted_file(encrypted_file)
+        decryptor.update(ciphertext[:-1])
+
+        with self.assertRaises(DecryptionError):
+            decryptor.verify()
+
+    def test_that_a_resumed_decryptor_continues_after_the_decrypted_part(self):
+        plaintext = os.urandom(10_000)
+        ciphertext, encrypted_file = encrypt_attachment(plaintext)
+
+        decryptor = AttachmentDecryptor.from_encrypted_file(encrypted_file)
+        decryptor.resume(plaintext[:4000])
+        rest = decryptor.update(ciphertext[4000:])
+        decryptor.verify()
+
+        self.assertEqual(rest, plaintext[4000:])
+
+
+class FakeResponse:
+
+    def __init__(self, status, data):
+        self.status = status
+        self.content = MagicMock()
+
+        async def iter_chunked(chunk_size):
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+        self.content.iter_chunked = iter_chunked
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+
+class TestRangeDownload(IsolatedAsyncioTestCase):
+
+    async def _download_rest(self, status, sent):
+        plaintext = os.urandom(10_000)
+        ciphertext, encrypted_file = encrypt_attachment(plaintext)
+        client = MagicMock()
+        client.api.session.get = MagicMock(return_value=FakeResponse(status, sent(ciphertext)))
+        decryptor = AttachmentDecryptor.from_encrypted_file(encrypted_file)
+        decryptor.resume(plaintext[:3000])
+
+        chunks = [chunk async for chunk in iter_decrypted_media(
+            client, encrypted_file, chunk_size=1024, decryptor=decryptor, offset=3000)]
+
+        self.assertEqual(b''.join(chunks), plaintext[3000:])
+        self.assertEqual(client.api.session.get.call_args.kwargs['headers'],
+                         {'Range': 'bytes=3000-'})
+
+    async def test_that_only_the_requested_range_is_decrypted(self):
+        await self._download_rest(206, lambda ciphertext: ciphertext[3000:])
+
+    async def test_that_the_known_part_is_skipped_without_range_support(self):
+        await self._download_rest(200, lambda ciphertext: ciphertext)
@@ -0,0 +1,97 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock
+import tempfile
+from mautrix.crypto.attachments import encrypt_attachment
+from matrix_photos.backfill import Backfill
+from matrix_photos.media_index import MediaIndex
+
+ROOM_ID = '!room:localhost'
+
+
+def media_event(event_id: str, encrypted_file) -> dict:
+    return {
+        'type': 'm.room.message',
+        'event_id': event_id,
+        'room_id': ROOM_ID,
+        'sender': '@user:localhost',
+        'origin_server_ts': 1600000000000,
+        'content': {'msgtype': 'm.image', 'body': f'{event_id[1:]}.jpg',
+                    'info': {'mimetype': 'image/jpeg', 'size': 5},
+                    'file': encrypted_file.serialize()},
+    }
+
+
+class FakeStorageStrategy:
+
+    def __init__(self) -> None:
+        self.media_index = MediaIndex(tempfile.mkdtemp(), MagicMock())
+        self.known = set()
+        self.reread = MagicMock()
+
+    def find_duplicate(self, encrypted_sha256):
+        return encrypted_sha256 in self.known
+
+
+class TestBackfill(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.storage = FakeStorageStrategy()
+        self.client = MagicMock()
+        self.client.sync_store.get_next_batch = AsyncMock(return_value='now')
+        self.ingested = []
+
+        async def ingest(room_id, encrypted_file, filename, timestamp=None, sender=None,
+                         size=None, mimetype=None):
+            self.ingested.append(filename)
+            return filename
+        self.pipeline = MagicMock()
+        self.pipeline.ingest = ingest
+        config = MagicMock(backfill_page_size=2, backfill_downloads_per_minute=0)
+        self.backfill = Backfill(config, MagicMock(), self.client, self.pipeline,
+                                 self.storage, lambda evt: True)
+
+    def tearDown(self):
+        self.storage.media_index.close()
+
+    def _pages(self, pages):
+        self.requests = []
+
+        async def request(method, path, query_params):
+            self.requests.append(query_params['from'])
+            return pages[query_params['from']]
+        self.client.api.request = request
+
+    async def test_that_the_history_is_imported_oldest_first_per_page(self):
+        files = [encrypt_attachment(b'image')[1] for _ in range(3)]
+        self._pages({
+            'now': {'chunk': [media_event('$3', files[2]), media_event('$2', files[1])],
+                    'end': 'older'},
+            'older': {'chunk': [media_event('$1', files[0])]},
+        })
+
+        result = await self.backfill.run([ROOM_ID])
+
+        self.assertEqual(self.ingested, ['2.jpg', '3.jpg', '1.jpg'])
+        self.assertEqual(result.stored, 3)
+        self.assertEqual(self.storage.media_index.backfill_state(ROOM_ID), (None, True))
+        self.storage.reread.assert_called_once()
+
+    async def test_that_an_interrupted_backfill_continues_at_the_saved_token(self):
+        self.storage.media_index.set_backfill_state(ROOM_ID, 'older', False)
+        self._pages({'older': {'chunk': []}})
+
+        await self.backfill.run([ROOM_ID])
+
+        self.assertEqual(self.requests, ['older'])
+
+    async def test_that_completed_rooms_stop_at_the_first_page_without_new_media(self):
+        encrypted_file = encrypt_attachment(b'image')[1]
+        self.storage.known.add(encrypted_file.hashes['sha256'])
+        self.storage.media_index.set_backfill_state(ROOM_ID, None, True)
+        self._pages({'now': {'chunk': [media_event('$1', encrypted_file)], 'end': 'older'}})
+
+        result = await self.backfill.run([ROOM_ID])
+
+        self.assertEqual(self.requests, ['now'])
+        self.assertEqual(result.duplicates, 1)
+        self.assertEqual(self.ingested, [])
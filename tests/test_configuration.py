@@ -1,7 +1,7 @@
 from unittest import TestCase
 import os
 import yaml
-from matrix_photos.configuration import MatrixConfiguration
+from matrix_photos.configuration import MatrixConfiguration, TranscodeConfiguration
 
 
 class TestModels(TestCase):
@@ -23,8 +23,11 @@ class TestModels(TestCase):
             convert = configuration_as_dictionary.pop('convert')
             matrix_convert = configuration_as_dictionary.pop('message_convert')
 
+            transcode = configuration_as_dictionary.pop('transcode')
+
             configuration_as_dictionary['convert'] = convert._asdict()
             configuration_as_dictionary['message_convert'] = matrix_convert._asdict()
+            configuration_as_dictionary['transcode'] = transcode._asdict()
 
             self.assertDictEqual(loaded_matrix_configuration,
                                  configuration_as_dictionary)
@@ -42,4 +45,10 @@ class TestModels(TestCase):
             matrix_configuration = MatrixConfiguration.from_dict(loaded_matrix_configuration)
             self.assertIsNotNone(matrix_configuration)
             self.assertEqual(matrix_configuration.convert.convert_binary, '/usr/bin/convert')
-            
\ No newline at end of file
+            
+
+    def test_that_the_transcode_defaults_are_not_shared_lists(self):
+        defaults = TranscodeConfiguration()
+
+        self.assertIsInstance(defaults.mimetypes, tuple)
+        self.assertIsInstance(defaults.ffmpeg_parameters, tuple)
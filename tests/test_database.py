@@ -0,0 +1,48 @@
+from unittest import IsolatedAsyncioTestCase
+import os
+import tempfile
+from matrix_photos.database import DatabaseSettings, create_database, start_database
+
+
+class TestDatabase(IsolatedAsyncioTestCase):
+
+    def test_that_driver_defaults_are_used_for_unset_pool_sizes(self):
+        self.assertEqual(DatabaseSettings('postgres://localhost').database_args(), {})
+        self.assertEqual(DatabaseSettings('postgres://localhost', 2, 1).database_args(),
+                         {'min_size': 2, 'max_size': 2})
+        self.assertEqual(DatabaseSettings('sqlite:///crypto.db', 0, 8).database_args(),
+                         {'min_size': 1})
+
+    async def test_that_sqlite_connections_are_tuned(self):
+        settings = DatabaseSettings(
+            f'sqlite:///{os.path.join(tempfile.mkdtemp(), "crypto.db")}', pool_min_size=2)
+        database = create_database(settings)
+        await start_database(database, settings)
+        try:
+            for _ in range(settings.sqlite_connections):
+                async with database.acquire() as connection:
+                    self.assertEqual(await connection.fetchval('PRAGMA journal_mode'), 'wal')
+                    self.assertEqual(await connection.fetchval('PRAGMA synchronous'), 1)
+        finally:
+            await database.stop()
+
+    async def test_that_the_state_store_tables_are_created_with_the_database(self):
+        settings = DatabaseSettings(f'sqlite:///{os.path.join(tempfile.mkdtemp(), "crypto.db")}')
+        database = create_database(settings)
+        await start_database(database, settings)
+        try:
+            self.assertIsNotNone(await database.fetchval(
+                "SELECT name FROM sqlite_master WHERE name='mx_room_state'"))
+        finally:
+            await database.stop()
+
+    async def test_that_unknown_pragma_values_are_rejected(self):
+        settings = DatabaseSettings(
+            f'sqlite:///{os.path.join(tempfile.mkdtemp(), "crypto.db")}',
+            sqlite_synchronous='normal; DROP TABLE crypto_account')
+        database = create_database(settings)
+        try:
+            with self.assertRaises(ValueError):
+                await start_database(database, settings)
+        finally:
+            await database.stop()
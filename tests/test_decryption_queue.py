@@ -0,0 +1,65 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock
+import asyncio
+from matrix_photos.decryption_queue import PendingDecryptionQueue
+from matrix_photos.metrics import Metrics
+
+
+def create_event(event_id: str, session_id: str = 'session'):
+    evt = MagicMock()
+    evt.event_id = event_id
+    evt.content.session_id = session_id
+    return evt
+
+
+class TestPendingDecryptionQueue(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.crypto.crypto_store.has_group_session = AsyncMock(return_value=False)
+        self.client.crypto.request_room_key = AsyncMock()
+        self.client.crypto.decrypt_megolm_event = AsyncMock(side_effect=lambda evt: evt.event_id)
+        self.session_received = asyncio.Event()
+
+        async def wait_for_session(room_id, sender_key, session_id, timeout):
+            try:
+                await asyncio.wait_for(self.session_received.wait(), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+        self.client.crypto.wait_for_session = wait_for_session
+        self.metrics = Metrics()
+
+    async def test_that_events_are_decrypted_when_the_keys_arrive(self):
+        queue = PendingDecryptionQueue(self.client, MagicMock(), self.metrics)
+        queue.add(create_event('$1'))
+        queue.add(create_event('$2'))
+        await asyncio.sleep(0)
+
+        self.session_received.set()
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.client.crypto.request_room_key.await_count, 1)
+        self.assertEqual([call.args[0] for call in self.client.dispatch_event.call_args_list],
+                         ['$1', '$2'])
+        self.assertEqual(len(queue), 0)
+
+    async def test_that_events_are_dropped_after_the_ttl(self):
+        queue = PendingDecryptionQueue(self.client, MagicMock(), self.metrics, ttl_seconds=0.05)
+        queue.add(create_event('$1'))
+
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(self.metrics.decryption_failures.value, 1)
+        self.client.dispatch_event.assert_not_called()
+
+    async def test_that_the_eldest_events_are_dropped_when_the_queue_is_full(self):
+        queue = PendingDecryptionQueue(self.client, MagicMock(), self.metrics, max_events=2)
+        for event_id in ['$1', '$2', '$3']:
+            queue.add(create_event(event_id, event_id))
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(self.metrics.decryption_failures.value, 1)
+        await queue.stop()
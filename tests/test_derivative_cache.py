@@ -0,0 +1,67 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+import os
+import shutil
+import tempfile
+from matrix_photos.derivative_cache import DerivativeCache
+
+
+class FakeConvert:
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    async def convert_file(self, filename, convert_params, target=None):
+        self.calls.append((filename, convert_params))
+        shutil.copyfile(filename, target)
+
+
+class TestDerivativeCache(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.media_path = tempfile.mkdtemp()
+        self.convert = FakeConvert()
+
+    def _cache(self, max_bytes: int = 0) -> DerivativeCache:
+        return DerivativeCache(self.media_path, '1024x600', max_bytes,
+                               self.convert, ['-auto-orient'], MagicMock())
+
+    def _create_file(self, name: str, size: int) -> str:
+        path = os.path.join(self.media_path, name)
+        with open(path, 'wb') as binary_file:
+            binary_file.write(b'x' * size)
+        return path
+
+    async def test_that_copies_are_created_once_per_content_hash(self):
+        cache = self._cache()
+        original = self._create_file('image.jpg', 10)
+
+        path = await cache.create('hash', original)
+        self.assertEqual(await cache.create('hash', original), path)
+
+        self.assertEqual(os.path.basename(path), 'hash_1024x600.jpg')
+        self.assertEqual(self.convert.calls,
+                         [(original, ['-auto-orient', '-resize', '1024x600>'])])
+        self.assertEqual(os.listdir(cache.directory), ['hash_1024x600.jpg'])
+
+    async def test_that_the_least_recently_used_copies_are_evicted(self):
+        cache = self._cache(max_bytes=25)
+        first = await cache.create('first', self._create_file('first.jpg', 10))
+        second = await cache.create('second', self._create_file('second.jpg', 10))
+        cache.lookup('first', 'first.jpg')
+        third = await cache.create('third', self._create_file('third.jpg', 10))
+
+        self.assertEqual(cache.enforce_limit(), 10)
+
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+        self.assertEqual(cache.total_bytes, 20)
+
+    async def test_that_existing_copies_are_loaded(self):
+        await self._cache().create('hash', self._create_file('image.jpg', 10))
+
+        cache = self._cache()
+
+        self.assertIsNotNone(cache.lookup('hash', 'image.jpg'))
+        self.assertEqual(cache.total_bytes, 10)
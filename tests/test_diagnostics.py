@@ -0,0 +1,57 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import os
+import tempfile
+import tracemalloc
+from mautrix.types.event.message import MessageType, TextMessageEventContent
+from matrix_photos.admin_command_handler import AdminCommandHandler
+from matrix_photos.diagnostics import Diagnostics
+
+
+def busy_function():
+    return sum(index * index for index in range(20000))
+
+
+class TestDiagnostics(TestCase):
+
+    def setUp(self):
+        self.config = MagicMock(media_path=tempfile.mkdtemp(), diagnostics_path='')
+        self.diagnostics = Diagnostics(self.config, MagicMock())
+
+    def tearDown(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _dumps(self):
+        return sorted(os.listdir(os.path.join(self.config.media_path, '.diagnostics')))
+
+    def test_that_the_profile_replies_the_hot_spots_and_writes_the_profile(self):
+        self.diagnostics.start_profile()
+        busy_function()
+        reply = self.diagnostics.stop_profile()
+
+        self.assertIn('genexpr', reply)
+        self.assertEqual(len(self._dumps()), 1)
+        self.assertEqual(self.diagnostics.stop_profile(), 'profiling is not running')
+
+    def test_that_the_second_heap_snapshot_replies_the_growth(self):
+        self.diagnostics.start_heap()
+        first = self.diagnostics.heap_snapshot()
+        kept = [bytearray(1024) for _ in range(100)]
+        second = self.diagnostics.heap_snapshot()
+
+        self.assertIn('top allocation sites', first)
+        self.assertIn('top growth', second)
+        self.assertIn('test_diagnostics.py', second)
+        self.assertEqual(len(self._dumps()), 2)
+        self.assertEqual(len(kept), 100)
+
+    def test_that_the_admin_commands_control_the_profiler(self):
+        handler = AdminCommandHandler(self.config, MagicMock())
+
+        def command(body):
+            return handler.handle(TextMessageEventContent(msgtype=MessageType.TEXT, body=body))
+
+        self.assertIn('started', command('!profile start'))
+        self.assertIn('top functions', command('!profile stop'))
+        self.assertIn('start|snapshot|stop', command('!heap'))
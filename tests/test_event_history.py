@@ -0,0 +1,32 @@
+from unittest import TestCase
+from matrix_photos.event_history import EventHistory
+
+
+class TestEventHistory(TestCase):
+
+    def test_that_the_previous_message_type_of_the_sender_is_returned(self):
+        history = EventHistory()
+
+        self.assertIsNone(history.record('!room', '@user', True))
+        self.assertIsNone(history.record('!room', '@other', False))
+        self.assertTrue(history.record('!room', '@user', False))
+        self.assertFalse(history.record('!room', '@user', False))
+        self.assertIsNone(history.record('!other_room', '@user', False))
+
+    def test_that_the_latest_media_message_is_kept_after_text_messages(self):
+        history = EventHistory()
+        history.record('!room', '@user', True, 'first')
+        history.record('!room', '@user', True, 'second')
+        history.record('!room', '@user', False)
+
+        self.assertEqual(history.media_sha256('!room', '@user'), 'second')
+        self.assertIsNone(history.media_sha256('!room', '@other'))
+
+    def test_that_the_eldest_entries_are_dropped(self):
+        history = EventHistory(max_entries=2)
+        history.record('!room', '@a', True)
+        history.record('!room', '@b', True)
+        history.record('!room', '@c', True)
+
+        self.assertIsNone(history.record('!room', '@a', False))
+        self.assertTrue(history.record('!room', '@c', False))
@@ -0,0 +1,47 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import os
+import tempfile
+from matrix_photos.eviction import MEGABYTE, bytes_to_free, plan_eviction
+from matrix_photos.file_convert import ConvertPool
+from matrix_photos.storage_strategy import DefaultStorageStrategy
+from tests.helpers import example_configuration
+
+
+class TestEviction(TestCase):
+
+    def test_that_nothing_is_freed_above_the_threshold(self):
+        self.assertEqual(bytes_to_free(30 * MEGABYTE, 20, 70), 0)
+        self.assertEqual(bytes_to_free(0, 0, 70), 0)
+
+    def test_that_the_headroom_is_freed_below_the_threshold(self):
+        self.assertEqual(bytes_to_free(10 * MEGABYTE, 20, 70), 60 * MEGABYTE)
+
+    def test_that_the_eldest_files_covering_the_required_bytes_are_planned(self):
+        candidates = [('a.jpg', 10), ('b.jpg', 20), ('c.jpg', 30), ('d.jpg', 40)]
+
+        plan = plan_eviction(candidates, 25)
+
+        self.assertEqual(plan.files, ['a.jpg', 'b.jpg'])
+        self.assertEqual(plan.size, 30)
+
+    def test_that_all_files_are_planned_when_they_do_not_cover_the_required_bytes(self):
+        plan = plan_eviction([('a.jpg', 10)], 25)
+
+        self.assertEqual(plan.files, ['a.jpg'])
+
+    def test_that_no_file_is_evicted_without_min_free_disk_space(self):
+        config = example_configuration(tempfile.mkdtemp(),
+                                       min_free_disk_space_mb=0,
+                                       eviction_headroom_mb=50)
+        storage = DefaultStorageStrategy(config, MagicMock(),
+                                         ConvertPool(config.convert, MagicMock()))
+        path = os.path.join(config.media_path, 'photo.jpg')
+        with open(path, 'wb') as binary_file:
+            binary_file.write(b'image')
+        storage.media_index.add(path, 'plaintext')
+        storage.free_bytes = lambda: 10 * MEGABYTE
+
+        self.assertEqual(storage.evict(config.eviction_headroom_mb), 0)
+        self.assertTrue(os.path.exists(path))
+        storage.media_index.close()
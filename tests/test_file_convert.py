@@ -0,0 +1,82 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+import asyncio
+import sys
+import threading
+from matrix_photos.configuration import ConvertConfiguration
+from matrix_photos.file_convert import ConvertPool
+
+
+class TestConvertPool(IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def _create_pool(**kwargs) -> ConvertPool:
+        config = ConvertConfiguration(convert_on_save=True,
+                                      convert_binary='convert',
+                                      convert_parameters=[],
+                                      **kwargs)
+        return ConvertPool(config, MagicMock())
+
+    async def test_that_the_process_result_is_returned(self):
+        pool = self._create_pool()
+        result = await pool.run([sys.executable, '-c', 'print("converted")'])
+        await pool.stop()
+
+        self.assertEqual(result[0], 0)
+        self.assertEqual(result[1].strip(), 'converted')
+
+    async def test_that_not_more_than_max_concurrent_jobs_are_running(self):
+        pool = self._create_pool(max_concurrent_jobs=2)
+        active = []
+
+        async def observe():
+            while True:
+                active.append(pool.active_jobs)
+                await asyncio.sleep(0.01)
+
+        observer = asyncio.create_task(observe())
+        await asyncio.gather(*[pool.run([sys.executable, '-c', 'import time; time.sleep(0.2)'])
+                               for _ in range(5)])
+        observer.cancel()
+        await pool.stop()
+
+        self.assertEqual(max(active), 2)
+
+    async def test_that_jobs_are_killed_after_the_timeout(self):
+        pool = self._create_pool(job_timeout_seconds=0.2)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await pool.run([sys.executable, '-c', 'import time; time.sleep(5)'])
+        await pool.stop()
+
+    async def test_that_a_timed_out_thread_keeps_its_slot_until_it_returns(self):
+        pool = self._create_pool(max_concurrent_jobs=1, job_timeout_seconds=0.05)
+        release = threading.Event()
+        order = []
+
+        def convert(name):
+            if name == 'slow':
+                release.wait()
+            order.append(name)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await pool.run_in_executor(convert, 'slow')
+        fast = asyncio.create_task(pool.run_in_executor(convert, 'fast'))
+        await asyncio.sleep(0.1)
+        self.assertEqual(order, [])
+
+        release.set()
+        await fast
+        await pool.stop()
+
+        self.assertEqual(order, ['slow', 'fast'])
+
+    async def test_that_queued_jobs_are_cancelled_when_the_pool_stops(self):
+        pool = self._create_pool(max_concurrent_jobs=1, max_queued_jobs=2)
+        jobs = [asyncio.create_task(pool.submit(lambda: asyncio.sleep(5))) for _ in range(2)]
+        await asyncio.sleep(0.01)
+
+        await pool.stop()
+
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results))
@@ -0,0 +1,59 @@
+from unittest import TestCase, skipUnless
+import os
+import stat
+import tempfile
+from matrix_photos.image_operations import (ImageOperations,
+                                            apply_image_operations,
+                                            is_available)
+from matrix_photos.utils import UMASK
+
+try:
+    from PIL import Image
+except ImportError:
+    pass
+
+
+class TestImageOperations(TestCase):
+
+    def test_that_the_example_convert_parameters_are_supported(self):
+        operations = ImageOperations.from_convert_parameters(
+            ['-resize', '1280x768', '-font', 'helvetica', '-fill', 'blue',
+             '-pointsize', '60', '-draw'],
+            'text 20,60')
+
+        self.assertEqual(operations.unsupported, ())
+        self.assertEqual(operations.resize, '1280x768')
+        self.assertEqual(operations.pointsize, 60)
+        self.assertEqual(operations.text_position, (20, 60))
+
+    def test_that_unknown_parameters_are_reported(self):
+        operations = ImageOperations.from_convert_parameters(['-sepia-tone', '80%',
+                                                              '-resize', 'huge'])
+
+        self.assertEqual(operations.unsupported, ('-sepia-tone', '80%', '-resize', 'huge'))
+
+    @skipUnless(is_available(), 'Pillow is not installed')
+    def test_that_images_are_resized_to_fit_and_captioned(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'image.jpg')
+        Image.new('RGB', (4000, 3000), 'white').save(filename)
+        operations = ImageOperations.from_convert_parameters(
+            ['-resize', '1280x768', '-fill', 'blue', '-draw'], 'text 20,60')
+
+        apply_image_operations(filename, operations, message='hello')
+
+        with Image.open(filename) as image:
+            self.assertEqual(image.size, (1024, 768))
+            self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(os.listdir(os.path.dirname(filename)), ['image.jpg'])
+        self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0o666 & ~UMASK)
+
+    @skipUnless(is_available(), 'Pillow is not installed')
+    def test_that_smaller_images_are_kept_with_the_shrink_only_flag(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'image.png')
+        Image.new('RGB', (640, 480), 'white').save(filename)
+
+        apply_image_operations(filename,
+                               ImageOperations.from_convert_parameters(['-resize', '1280x768>']))
+
+        with Image.open(filename) as image:
+            self.assertEqual(image.size, (640, 480))
@@ -0,0 +1,143 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+import asyncio
+import tempfile
+import aiohttp
+from mautrix.crypto.attachments import encrypt_attachment
+from matrix_photos.ingest_pipeline import IngestPipeline, Thumbnail
+from matrix_photos.media_index import MediaIndex
+from matrix_photos.photos_client import ClientDecryptionDispatcher
+from matrix_photos.storage_strategy import StagedFile
+
+
+class FakeStorageStrategy:
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.committed = []
+        self.thumbnails = []
+        self.running = 0
+        self.max_running = 0
+        self.media_index = MagicMock()
+
+    @staticmethod
+    def part_filename(encrypted_sha256, filename):
+        return f'/nonexistent/.{filename}.part'
+
+    async def stage(self, chunks, filename, encrypted_sha256, part_filename=None):
+        if self.delays.get(filename) is None:
+            raise aiohttp.ClientConnectionError('connection lost')
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delays[filename])
+        self.running -= 1
+        return StagedFile(filename, filename, 'plaintext', encrypted_sha256)
+
+    async def convert_staged(self, staged):
+        pass
+
+    def commit(self, staged, timestamp=None, room_id=None, sender=None):
+        self.committed.append(staged.filename)
+        return staged.filename
+
+    async def show_thumbnail(self, chunks, encrypted_sha256, ext):
+        self.thumbnails.append((ext, list(self.committed)))
+
+    def remove_thumbnail(self, encrypted_sha256, replacement=None):
+        return False
+
+
+class FakeClient:
+    """
+    decrypts the events after their delay and runs the handler as a task like mautrix
+    """
+
+    def __init__(self, pipeline, decrypt_delays):
+        self.pipeline = pipeline
+        self.decrypt_delays = decrypt_delays
+        self.crypto = MagicMock(decrypt_megolm_event=self.decrypt_megolm_event)
+        self.crypto_log = MagicMock()
+        (_, self.encrypted_file) = encrypt_attachment(b'image')
+
+    async def decrypt_megolm_event(self, evt):
+        await asyncio.sleep(self.decrypt_delays[evt.event_id])
+        return evt
+
+    async def _handle_message(self, evt):
+        if evt.event_id.endswith('.jpg'):
+            await self.pipeline.ingest(evt.room_id, self.encrypted_file, evt.event_id,
+                                       event_id=evt.event_id)
+
+    def dispatch_event(self, evt, source):
+        return [asyncio.create_task(self._handle_message(evt))]
+
+
+class TestIngestPipeline(IsolatedAsyncioTestCase):
+
+    async def test_that_files_are_committed_in_event_order_per_room(self):
+        storage = FakeStorageStrategy({'1.jpg': 0.3, '2.jpg': 0.1, '3.jpg': 0.2, '4.jpg': 0.0})
+        pipeline = IngestPipeline(MagicMock(), storage, 2, MagicMock())
+        (_, encrypted_file) = encrypt_attachment(b'image')
+
+        await asyncio.gather(*[pipeline.ingest('!room:localhost', encrypted_file, filename)
+                               for filename in ['1.jpg', '2.jpg', '3.jpg', '4.jpg']])
+
+        self.assertEqual(storage.committed, ['1.jpg', '2.jpg', '3.jpg', '4.jpg'])
+        self.assertEqual(storage.max_running, 2)
+        self.assertEqual(pipeline.timings.count['commit'], 4)
+
+    async def test_that_encrypted_events_are_committed_in_sync_order(self):
+        storage = FakeStorageStrategy({'1.jpg': 0, '2.jpg': 0, '3.jpg': 0})
+        pipeline = IngestPipeline(MagicMock(), storage, 3, MagicMock())
+        client = FakeClient(pipeline, {'1.jpg': 0.2, 'text': 0.1, '2.jpg': 0, '3.jpg': 0.1})
+        dispatcher = ClientDecryptionDispatcher(client)
+        dispatcher.ingest_pipeline = pipeline
+
+        await asyncio.gather(*[dispatcher.handle(MagicMock(room_id='!room:localhost',
+                                                           event_id=event_id))
+                               for event_id in ['1.jpg', 'text', '2.jpg', '3.jpg']])
+
+        self.assertEqual(storage.committed, ['1.jpg', '2.jpg', '3.jpg'])
+
+    async def test_that_a_caption_waits_until_the_media_message_before_is_committed(self):
+        storage = FakeStorageStrategy({'1.jpg': 0.1})
+        pipeline = IngestPipeline(MagicMock(), storage, 1, MagicMock())
+        (_, encrypted_file) = encrypt_attachment(b'image')
+
+        ingest = asyncio.create_task(pipeline.ingest('!room:localhost', encrypted_file, '1.jpg'))
+        await asyncio.sleep(0)
+        await pipeline.wait_for_previous('!room:localhost')
+
+        self.assertEqual(storage.committed, ['1.jpg'])
+        await ingest
+
+    async def test_that_the_thumbnail_is_shown_before_the_file_is_committed(self):
+        storage = FakeStorageStrategy({'1.jpg': 0.1})
+        pipeline = IngestPipeline(MagicMock(), storage, 1, MagicMock())
+        (_, encrypted_file) = encrypt_attachment(b'image')
+        (_, thumbnail_file) = encrypt_attachment(b'thumbnail')
+
+        await pipeline.ingest('!room:localhost', encrypted_file, '1.jpg',
+                              thumbnail=Thumbnail(thumbnail_file, 'image/png'))
+
+        self.assertEqual(storage.thumbnails, [('.png', [])])
+        self.assertEqual(storage.committed, ['1.jpg'])
+        self.assertEqual(pipeline.metrics.display_seconds.count, 1)
+
+    async def test_that_failed_downloads_stay_in_the_journal_until_they_are_stored(self):
+        storage = FakeStorageStrategy({})
+        storage.media_index = MediaIndex(tempfile.mkdtemp(), MagicMock())
+        storage.find_duplicate = lambda encrypted_sha256: None
+        pipeline = IngestPipeline(MagicMock(), storage, 1, MagicMock(), download_retries=0)
+        (_, encrypted_file) = encrypt_attachment(b'image')
+
+        with self.assertRaises(aiohttp.ClientError):
+            await pipeline.ingest('!room:localhost', encrypted_file, '1.jpg', sender='@a:b')
+        self.assertEqual(len(storage.media_index.journal_entries()), 1)
+
+        storage.delays['1.jpg'] = 0
+        self.assertEqual(await pipeline.resume_journal(), 1)
+
+        self.assertEqual(storage.committed, ['1.jpg'])
+        self.assertEqual(storage.media_index.journal_entries(), [])
+        storage.media_index.close()
@@ -0,0 +1,89 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import os
+import tempfile
+from matrix_photos.media_index import MediaIndex, file_sha256
+
+
+class TestMediaIndex(TestCase):
+
+    def setUp(self):
+        self.media_path = tempfile.mkdtemp()
+        self.index = MediaIndex(self.media_path, MagicMock())
+
+    def tearDown(self):
+        self.index.close()
+
+    def _create_file(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.media_path, name)
+        with open(path, 'wb') as binary_file:
+            binary_file.write(data)
+        return path
+
+    def test_that_stored_files_are_found_by_both_hashes(self):
+        path = self._create_file('image.jpg', b'image')
+        self.index.add(path, 'plain', 'encrypted')
+
+        self.assertEqual(self.index.find_by_encrypted_hash('encrypted'), path)
+        self.assertEqual(self.index.find_by_plaintext_hash('plain'), path)
+        self.assertIsNone(self.index.find_by_plaintext_hash('other'))
+
+    def test_that_a_file_sent_with_several_keys_is_found_by_every_encrypted_hash(self):
+        path = self._create_file('image.jpg', b'image')
+        self.index.add(path, 'plain', 'first upload')
+        self.index.add(path, 'plain', 'second upload')
+        self.index.add(path, 'plain')
+
+        self.assertEqual(self.index.find_by_encrypted_hash('first upload'), path)
+        self.assertEqual(self.index.find_by_encrypted_hash('second upload'), path)
+
+        self.index.remove(path)
+        self.assertIsNone(self.index.find_by_encrypted_hash('first upload'))
+
+    def test_that_entries_of_deleted_files_are_dropped(self):
+        path = self._create_file('image.jpg', b'image')
+        self.index.add(path, 'plain', 'encrypted')
+        os.remove(path)
+
+        self.assertIsNone(self.index.find_by_encrypted_hash('encrypted'))
+        self.assertEqual(self.index.paths(), [])
+
+    def test_that_rebuild_indexes_new_files_and_keeps_known_hashes(self):
+        known = self._create_file('known.jpg', b'converted')
+        self.index.add(known, 'plain', 'encrypted')
+        new = self._create_file('new.jpg', b'new')
+        gone = self._create_file('gone.jpg', b'gone')
+        self.index.add(gone, 'gone')
+        os.remove(gone)
+
+        self.index.rebuild()
+
+        self.assertCountEqual(self.index.paths(), [known, new])
+        self.assertEqual(self.index.find_by_plaintext_hash('plain'), known)
+        self.assertEqual(self.index.find_by_plaintext_hash(file_sha256(new)), new)
+
+    def test_that_reconcile_picks_up_files_in_mtime_order(self):
+        newer = self._create_file('newer.jpg', b'newer')
+        older = self._create_file('older.jpg', b'older!')
+        os.utime(newer, (2000, 2000))
+        os.utime(older, (1000, 1000))
+        self._create_file('.hidden.part', b'partial')
+        self._create_file('filelist.txt', b'')
+
+        self.index.reconcile()
+
+        self.assertEqual(self.index.paths(), [older, newer])
+        self.assertEqual(self.index.oldest(1), [(older, 6)])
+        self.assertEqual(self.index.stats().count, 2)
+        self.assertEqual(self.index.stats().size, 11)
+
+    def test_that_the_favourite_mark_and_the_origin_survive_a_new_hash(self):
+        path = self._create_file('image.jpg', b'image')
+        self.index.add(path, 'plain', None, '!room:localhost', '@user:localhost')
+        self.assertTrue(self.index.set_favourite(path, True))
+
+        self.index.add(path, 'plain', 'encrypted')
+
+        self.assertTrue(self.index.is_favourite(path))
+        self.assertEqual(self.index.usage_over('sender', 0), [('@user:localhost', 5)])
+        self.assertFalse(self.index.set_favourite(os.path.join(self.media_path, 'x.jpg'), True))
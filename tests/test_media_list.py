@@ -0,0 +1,52 @@
+from unittest import TestCase
+import os
+import stat
+import tempfile
+from matrix_photos.media_list import RecentMediaList
+from matrix_photos.utils import UMASK
+
+
+class TestRecentMediaList(TestCase):
+
+    def setUp(self):
+        self.media_file = os.path.join(tempfile.mkdtemp(), 'filelist.txt')
+
+    def _read_media_file(self):
+        with open(self.media_file, 'r', encoding='utf-8') as text_file:
+            return text_file.read().splitlines()
+
+    def test_that_only_the_latest_files_are_kept(self):
+        recent_media = RecentMediaList(self.media_file, 2)
+        for filename in ['a.jpg', 'b.jpg', 'c.jpg']:
+            recent_media.append(filename)
+
+        self.assertEqual(recent_media.entries(), ['b.jpg', 'c.jpg'])
+        self.assertEqual(recent_media.last(), 'c.jpg')
+        self.assertEqual(self._read_media_file(), ['b.jpg', 'c.jpg'])
+
+    def test_that_the_media_file_is_readable_like_files_created_with_open(self):
+        RecentMediaList(self.media_file, 2).append('a.jpg')
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.media_file).st_mode), 0o666 & ~UMASK)
+
+    def test_that_an_existing_media_file_is_loaded(self):
+        with open(self.media_file, 'w', encoding='utf-8') as text_file:
+            text_file.write('a.jpg\nb.jpg\nc.jpg\n')
+
+        recent_media = RecentMediaList(self.media_file, 2)
+
+        self.assertEqual(recent_media.entries(), ['b.jpg', 'c.jpg'])
+
+    def test_that_last_is_empty_without_media_file(self):
+        self.assertEqual(RecentMediaList(self.media_file, 2).last(), '')
+
+    def test_that_a_replaced_entry_keeps_its_position(self):
+        recent_media = RecentMediaList(self.media_file, 3)
+        for filename in ['a.jpg', '.thumbnails/b.jpg', 'c.jpg']:
+            recent_media.append(filename)
+
+        self.assertTrue(recent_media.replace('.thumbnails/b.jpg', 'b.jpg'))
+        self.assertFalse(recent_media.replace('.thumbnails/d.jpg', 'd.jpg'))
+        self.assertTrue(recent_media.replace('c.jpg', None))
+
+        self.assertEqual(self._read_media_file(), ['a.jpg', 'b.jpg'])
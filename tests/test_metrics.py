@@ -0,0 +1,29 @@
+from unittest import TestCase
+from matrix_photos.metrics import Histogram, Metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_that_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('photos_test_seconds', 'test', buckets=(1, 5))
+        for value in [0.5, 2, 10]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.samples(), [
+            'photos_test_seconds_bucket{le="1"} 1',
+            'photos_test_seconds_bucket{le="5"} 2',
+            'photos_test_seconds_bucket{le="+Inf"} 3',
+            'photos_test_seconds_sum 12.5',
+            'photos_test_seconds_count 3',
+        ])
+
+    def test_that_all_metrics_are_rendered_with_type_information(self):
+        metrics = Metrics()
+        metrics.stored_files.inc()
+        metrics.disk_free_bytes.function = lambda: 42
+
+        text = metrics.render()
+
+        self.assertIn('# TYPE photos_stored_files_total counter\nphotos_stored_files_total 1', text)
+        self.assertIn('photos_disk_free_bytes 42', text)
+        self.assertIn('# TYPE photos_convert_seconds histogram', text)
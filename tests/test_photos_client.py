@@ -0,0 +1,129 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock
+import asyncio
+import tempfile
+from mautrix.crypto.attachments import encrypt_attachment
+from mautrix.types.event.message import (ImageInfo, MediaMessageEventContent, MessageType,
+                                         TextMessageEventContent)
+from matrix_photos.ingest_pipeline import IngestPipeline
+from matrix_photos.photos_client import ClientDecryptionDispatcher, PhotOsClient
+from matrix_photos.storage_strategy import StagedFile
+from tests.helpers import example_configuration
+
+ROOM_ID = '!room:localhost'
+SENDER = '@user:localhost'
+
+
+class FakeStorageStrategy:
+    """
+    stores the files by their encrypted hash without writing them, the downloads take
+    their delays
+    """
+
+    def __init__(self):
+        self.stored = {}
+        self.download_delays = {}
+        self.media_index = MagicMock()
+
+    @staticmethod
+    def part_filename(encrypted_sha256, filename):
+        return f'/nonexistent/.{filename}.part'
+
+    async def stage(self, chunks, filename, encrypted_sha256, part_filename=None):
+        await asyncio.sleep(self.download_delays.get(filename, 0))
+        return StagedFile(filename, filename, 'plaintext', encrypted_sha256)
+
+    async def convert_staged(self, staged):
+        pass
+
+    def commit(self, staged, timestamp=None, room_id=None, sender=None):
+        self.stored[staged.encrypted_sha256] = staged.filename
+        return staged.filename
+
+    def remove_thumbnail(self, encrypted_sha256, replacement=None):
+        return False
+
+    def find_duplicate(self, encrypted_sha256):
+        return self.stored.get(encrypted_sha256)
+
+    @staticmethod
+    def display_path_of(path):
+        return path
+
+
+class FakeClient:
+    """
+    decrypts the events after their delay and runs the handler as a task like mautrix
+    """
+
+    def __init__(self, handler, decrypt_delays):
+        self.handler = handler
+        self.decrypt_delays = decrypt_delays
+        self.crypto = MagicMock(decrypt_megolm_event=self.decrypt_megolm_event)
+        self.crypto_log = MagicMock()
+        self.sync_store = MagicMock(get_next_batch=AsyncMock(return_value=None))
+
+    async def decrypt_megolm_event(self, evt):
+        await asyncio.sleep(self.decrypt_delays[evt.event_id])
+        return evt
+
+    def dispatch_event(self, evt, source):
+        return [asyncio.create_task(self.handler(evt))]
+
+
+class TestPhotOsClient(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        config = example_configuration(tempfile.mkdtemp(), random_response_messages=[])
+        self.photos = PhotOsClient(config, None, MagicMock())
+        self.photos.storage_strategy.media_index.close()
+        self.photos.storage_strategy = FakeStorageStrategy()
+        self.photos.admission = MagicMock(check=MagicMock(return_value=''))
+        self.photos.text_message_command_handler = MagicMock(handle=AsyncMock())
+
+    async def _receive(self, events, decrypt_delays):
+        """
+        receives the encrypted events in one sync, they are decrypted after their delays
+        """
+        self.photos.client = FakeClient(self.photos._handle_message, decrypt_delays)
+        self.photos.ingest_pipeline = IngestPipeline(self.photos.client,
+                                                     self.photos.storage_strategy,
+                                                     2,
+                                                     MagicMock())
+        dispatcher = ClientDecryptionDispatcher(self.photos.client)
+        dispatcher.ingest_pipeline = self.photos.ingest_pipeline
+        dispatcher.event_history = self.photos.event_history
+        await asyncio.gather(*[dispatcher.handle(evt) for evt in events])
+
+    @staticmethod
+    def _image(event_id):
+        (_, encrypted_file) = encrypt_attachment(event_id.encode())
+        content = MediaMessageEventContent(msgtype=MessageType.IMAGE,
+                                           body=event_id,
+                                           file=encrypted_file,
+                                           info=ImageInfo(mimetype='image/jpeg', size=5))
+        return MagicMock(room_id=ROOM_ID, event_id=event_id, sender=SENDER, content=content)
+
+    @staticmethod
+    def _text(event_id, body):
+        content = TextMessageEventContent(msgtype=MessageType.TEXT, body=body)
+        return MagicMock(room_id=ROOM_ID, event_id=event_id, sender=SENDER, content=content)
+
+    async def test_that_a_caption_which_is_decrypted_before_its_image_is_drawn(self):
+        caption = self._text('caption', 'first')
+
+        await self._receive([self._image('1.jpg'), caption],
+                            {'1.jpg': 0.1, 'caption': 0})
+
+        self.photos.text_message_command_handler.handle.assert_awaited_once_with(
+            caption.content, '1.jpg')
+
+    async def test_that_a_caption_is_drawn_onto_its_delayed_image_and_not_the_next_one(self):
+        caption = self._text('caption', 'first')
+        self.photos.storage_strategy.download_delays['1.jpg'] = 0.1
+
+        await self._receive([self._image('1.jpg'), caption, self._image('2.jpg')],
+                            {'1.jpg': 0.1, 'caption': 0, '2.jpg': 0})
+
+        self.photos.text_message_command_handler.handle.assert_awaited_once_with(
+            caption.content, '1.jpg')
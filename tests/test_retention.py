@@ -0,0 +1,71 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import os
+import tempfile
+from matrix_photos.media_index import MediaIndex
+from matrix_photos.retention import (DAY_SECONDS,
+                                     MaxAgePolicy,
+                                     MaxTotalSizePolicy,
+                                     QuotaPolicy,
+                                     RetentionEngine)
+
+NOW = 100 * DAY_SECONDS
+
+
+class TestRetention(TestCase):
+
+    def setUp(self):
+        self.media_path = tempfile.mkdtemp()
+        self.index = MediaIndex(self.media_path, MagicMock())
+        self.deleted = []
+
+    def tearDown(self):
+        self.index.close()
+
+    # pylint: disable=too-many-arguments
+    def _add(self, name: str, size: int, age_days: float, room_id='!a:localhost',
+             sender='@user:localhost') -> str:
+        path = os.path.join(self.media_path, name)
+        with open(path, 'wb') as binary_file:
+            binary_file.write(b'x' * size)
+        mtime = NOW - age_days * DAY_SECONDS
+        os.utime(path, (mtime, mtime))
+        self.index.add(path, name, None, room_id, sender)
+        return path
+
+    def _delete(self, paths):
+        self.deleted.extend(os.path.basename(path) for path in paths)
+        self.index.remove_many(paths)
+        return paths
+
+    def _enforce(self, *policies):
+        return RetentionEngine(list(policies), MagicMock()).enforce(self.index, self._delete, NOW)
+
+    def test_that_old_files_except_favourites_are_deleted(self):
+        self._add('old.jpg', 1, 40)
+        self.index.set_favourite(self._add('favourite.jpg', 1, 50), True)
+        self._add('new.jpg', 1, 1)
+
+        self._enforce(MaxAgePolicy(30))
+
+        self.assertEqual(self.deleted, ['old.jpg'])
+
+    def test_that_only_the_rooms_above_the_quota_lose_their_eldest_files(self):
+        self._add('a1.jpg', 10, 3)
+        self._add('a2.jpg', 10, 2)
+        self._add('a3.jpg', 10, 1)
+        self._add('b1.jpg', 10, 4, room_id='!b:localhost')
+
+        self._enforce(QuotaPolicy('room_id', 15))
+
+        self.assertEqual(self.deleted, ['a1.jpg', 'a2.jpg'])
+
+    def test_that_later_policies_see_the_deletions_of_earlier_policies(self):
+        self._add('old.jpg', 10, 40)
+        self._add('middle.jpg', 10, 2)
+        self._add('new.jpg', 10, 1)
+
+        counts = self._enforce(MaxAgePolicy(30), MaxTotalSizePolicy(15))
+
+        self.assertEqual(self.deleted, ['old.jpg', 'middle.jpg'])
+        self.assertEqual(counts, {'max age': 1, 'max total size': 1})
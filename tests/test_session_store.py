@@ -0,0 +1,37 @@
+from unittest import IsolatedAsyncioTestCase
+import os
+import tempfile
+from mautrix.util.async_db import Database
+from matrix_photos.session_store import SessionStore, StoredSession
+
+
+class TestSessionStore(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = Database.create(f'sqlite:///{os.path.join(tempfile.mkdtemp(), "crypto.db")}')
+        await self.db.start()
+        self.store = SessionStore(self.db, '@frame:localhost')
+        await self.store.open()
+
+    async def asyncTearDown(self):
+        await self.db.stop()
+
+    async def test_that_the_latest_access_token_is_kept(self):
+        self.assertIsNone(await self.store.get())
+
+        await self.store.put('FRAME', 'first')
+        await self.store.put('FRAME', 'second')
+
+        self.assertEqual(await self.store.get(), StoredSession('FRAME', 'second'))
+
+    async def test_that_deleted_sessions_are_gone(self):
+        await self.store.put('FRAME', 'token')
+        await self.store.delete()
+
+        self.assertIsNone(await self.store.get())
+
+    async def test_that_the_filter_id_is_only_reused_for_the_same_filter(self):
+        await self.store.put_filter_id('hash', 'filter')
+
+        self.assertEqual(await self.store.get_filter_id('hash'), 'filter')
+        self.assertIsNone(await self.store.get_filter_id('changed'))
@@ -0,0 +1,30 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+import os
+import stat
+import tempfile
+from matrix_photos.file_convert import ConvertPool
+from matrix_photos.storage_strategy import DefaultStorageStrategy
+from matrix_photos.utils import UMASK
+from tests.helpers import example_configuration
+
+
+async def chunks_of(data: bytes):
+    yield data
+
+
+class TestDefaultStorageStrategy(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.config = example_configuration(tempfile.mkdtemp())
+        self.storage = DefaultStorageStrategy(self.config, MagicMock(),
+                                              ConvertPool(self.config.convert, MagicMock()))
+
+    def tearDown(self):
+        self.storage.media_index.close()
+
+    async def test_that_stored_files_are_readable_like_files_created_with_open(self):
+        staged = await self.storage.stage(chunks_of(b'image'), 'photo.jpg', 'encrypted')
+        target = self.storage.commit(staged)
+
+        self.assertEqual(stat.S_IMODE(os.stat(target).st_mode), 0o666 & ~UMASK)
@@ -0,0 +1,78 @@
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import AsyncMock, MagicMock
+import tempfile
+from matrix_photos.photos_client import AccountMismatchException
+from matrix_photos.supervisor import Supervisor, load_account_configurations
+from tests.helpers import example_configuration, load_example_config
+
+
+class TestSupervisor(TestCase):
+
+    def setUp(self):
+        self.config = load_example_config()
+
+    def test_that_the_matrix_section_is_used_without_accounts(self):
+        configurations = load_account_configurations(self.config)
+
+        self.assertEqual([configuration.user_id for configuration in configurations],
+                         [self.config['matrix']['user_id']])
+
+    def test_that_accounts_override_the_matrix_section(self):
+        self.config['accounts'] = [
+            {'user_id': '@one:localhost', 'device_id': 'ONE',
+             'media_path': '/data/one', 'media_file': '/data/one/list.txt',
+             'complete_media_file': '/data/one/complete.txt'},
+            {'user_id': '@two:localhost', 'device_id': 'TWO',
+             'media_path': '/data/two', 'media_file': '/data/two/list.txt',
+             'complete_media_file': '/data/two/complete.txt'},
+        ]
+
+        configurations = load_account_configurations(self.config)
+
+        self.assertEqual([configuration.media_path for configuration in configurations],
+                         ['/data/one', '/data/two'])
+        self.assertEqual(configurations[1].base_url, self.config['matrix']['base_url'])
+
+    def test_that_accounts_must_not_share_the_media_path(self):
+        self.config['accounts'] = [
+            {'user_id': '@one:localhost', 'device_id': 'ONE', 'media_file': '/one.txt'},
+            {'user_id': '@two:localhost', 'device_id': 'TWO', 'media_file': '/two.txt'},
+        ]
+
+        with self.assertRaises(ValueError):
+            load_account_configurations(self.config)
+
+    def test_that_accounts_must_not_share_the_complete_media_file_or_the_metrics_port(self):
+        accounts = [
+            {'user_id': '@one:localhost', 'device_id': 'ONE',
+             'media_path': '/data/one', 'media_file': '/data/one/list.txt'},
+            {'user_id': '@two:localhost', 'device_id': 'TWO',
+             'media_path': '/data/two', 'media_file': '/data/two/list.txt'},
+        ]
+        self.config['accounts'] = accounts
+        with self.assertRaisesRegex(ValueError, 'complete_media_file'):
+            load_account_configurations(self.config)
+
+        accounts[0]['complete_media_file'] = '/data/one/complete.txt'
+        accounts[1]['complete_media_file'] = '/data/two/complete.txt'
+        self.config['matrix']['metrics_port'] = 9101
+        with self.assertRaisesRegex(ValueError, 'metrics_port'):
+            load_account_configurations(self.config)
+
+        accounts[1]['metrics_port'] = 9102
+        self.assertEqual(len(load_account_configurations(self.config)), 2)
+
+
+class TestSupervisorClients(IsolatedAsyncioTestCase):
+
+    async def test_that_an_account_which_does_not_match_the_homeserver_is_dropped(self):
+        supervisor = Supervisor([example_configuration(tempfile.mkdtemp())], None, MagicMock())
+        client = MagicMock(initialize=AsyncMock(side_effect=AccountMismatchException(
+                               11, 'User ID mismatch')),
+                           start=AsyncMock())
+
+        await supervisor._run_client(client)
+
+        client.start.assert_not_awaited()
+        client.log.error.assert_called_once()
+        await supervisor.stop()
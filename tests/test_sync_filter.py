@@ -0,0 +1,19 @@
+from unittest import TestCase
+from matrix_photos.sync_filter import build_sync_filter, filter_hash
+
+
+class TestSyncFilter(TestCase):
+
+    def test_that_ephemeral_events_and_presence_are_filtered(self):
+        serialized = build_sync_filter(50, True).serialize()
+
+        self.assertEqual(serialized['presence'], {'not_types': ['*']})
+        self.assertEqual(serialized['room']['ephemeral']['not_types'], ['*'])
+        self.assertEqual(serialized['room']['timeline']['limit'], 50)
+        self.assertTrue(serialized['room']['state']['lazy_load_members'])
+
+    def test_that_the_hash_changes_with_the_filter(self):
+        self.assertEqual(filter_hash(build_sync_filter(50, True)),
+                         filter_hash(build_sync_filter(50, True)))
+        self.assertNotEqual(filter_hash(build_sync_filter(50, True)),
+                            filter_hash(build_sync_filter(20, True)))
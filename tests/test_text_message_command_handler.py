@@ -0,0 +1,72 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+import asyncio
+import os
+import tempfile
+from mautrix.types.event.message import MessageType, TextMessageEventContent
+from matrix_photos.configuration import ConvertConfiguration, MessageConvertConfiguration
+from matrix_photos.media_index import MediaIndex
+from matrix_photos.text_message_command_handler import TextmessageCommandHandler
+
+
+class FakeStorageStrategy:
+
+    def __init__(self, media_path: str, last: str) -> None:
+        self.media_index = MediaIndex(media_path, MagicMock())
+        self.recent_media = MagicMock()
+        self.recent_media.last.return_value = last
+
+    @staticmethod
+    def caption_source(target: str) -> str:
+        return f'{target}.source'
+
+
+class TestTextmessageCommandHandler(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        media_path = tempfile.mkdtemp()
+        self.target = os.path.join(media_path, 'image.jpg')
+        self.storage = FakeStorageStrategy(media_path, self.target)
+        config = MagicMock()
+        config.convert = ConvertConfiguration(False, 'convert', [])
+        config.message_convert = MessageConvertConfiguration(
+            True, 'convert', 'text 20,60', ['-draw'], caption_delay_seconds=0.05)
+        self.handler = TextmessageCommandHandler(config, MagicMock(), MagicMock(), self.storage)
+        self.calls = []
+
+        async def convert_file(filename, convert_params, message=None,
+                               convert_text_parameter=None, target=None):
+            self.calls.append((filename, message, target))
+        self.handler._convert.convert_file = convert_file
+
+    def tearDown(self):
+        self.storage.media_index.close()
+
+    async def _send(self, body: str, target_filename: str = None) -> None:
+        await self.handler.handle(TextMessageEventContent(msgtype=MessageType.TEXT, body=body),
+                                  target_filename)
+
+    async def test_that_messages_within_the_delay_are_rendered_in_one_pass(self):
+        await self._send('first')
+        await self._send('second')
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(self.calls, [(f'{self.target}.source', 'first\nsecond', self.target)])
+
+    async def test_that_the_caption_is_drawn_onto_the_file_of_its_media_message(self):
+        media_message = os.path.join(os.path.dirname(self.target), 'media.jpg')
+        await self._send('first', media_message)
+        await self._send('not stored', '')
+        await self.handler.flush()
+
+        self.assertEqual(self.calls, [(f'{media_message}.source', 'first', media_message)])
+
+    async def test_that_later_captions_are_rendered_from_the_source_with_the_stored_ones(self):
+        await self._send('first')
+        await self.handler.flush()
+        await self._send('second')
+        await self.handler.flush()
+
+        self.assertEqual([message for (_, message, _) in self.calls],
+                         ['first', 'first\nsecond'])
+        self.assertEqual(self.storage.media_index.captions(self.target), ['first', 'second'])
@@ -0,0 +1,102 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import MagicMock
+import asyncio
+import os
+import sys
+import tempfile
+from matrix_photos.configuration import TranscodeConfiguration
+from matrix_photos.file_convert import ConvertPool
+from matrix_photos.storage_strategy import DefaultStorageStrategy
+from matrix_photos.transcode_queue import RUNNING, TranscodeQueue
+from tests.helpers import example_configuration
+
+# copies the input like a transcode and reports the progress like ffmpeg -progress pipe:1
+FAKE_FFMPEG = f'''#!{sys.executable}
+import shutil, sys
+if '--fail' in sys.argv:
+    sys.stderr.write('unknown encoder')
+    sys.exit(1)
+print('out_time_us=500000', flush=True)
+shutil.copyfile(sys.argv[sys.argv.index('-i') + 1], sys.argv[-1])
+print('progress=end')
+'''
+FAKE_FFPROBE = f'''#!{sys.executable}
+print('1.0')
+'''
+
+
+def write_script(directory: str, name: str, content: str) -> str:
+    path = os.path.join(directory, name)
+    with open(path, 'w', encoding='utf-8') as script:
+        script.write(content)
+    os.chmod(path, 0o755)
+    return path
+
+
+class TestTranscodeQueue(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        workdir = tempfile.mkdtemp()
+        self.config = example_configuration(
+            workdir,
+            transcode=TranscodeConfiguration(
+                enabled=True,
+                ffmpeg_binary=write_script(workdir, 'ffmpeg', FAKE_FFMPEG),
+                ffprobe_binary=write_script(workdir, 'ffprobe', FAKE_FFPROBE)))
+        self.storage = DefaultStorageStrategy(self.config, MagicMock(),
+                                              ConvertPool(self.config.convert, MagicMock()))
+        self.source = os.path.join(self.config.media_path, 'clip.mov')
+        with open(self.source, 'wb') as video:
+            video.write(b'video')
+        self.storage.media_index.add(self.source, 'plaintext', 'encrypted')
+        self.storage.reread()
+
+    def tearDown(self):
+        self.storage.media_index.close()
+
+    def _read_media_file(self):
+        with open(self.config.media_file, 'r', encoding='utf-8') as text_file:
+            return text_file.read().splitlines()
+
+    async def _run_until_done(self, queue: TranscodeQueue):
+        task = asyncio.create_task(queue.run())
+        while any(job.state != 'failed' for job in self.storage.media_index.transcode_jobs()):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def test_that_a_finished_video_replaces_the_original(self):
+        queue = TranscodeQueue(self.config, MagicMock(), self.storage)
+        mtime = os.path.getmtime(self.source)
+
+        self.assertTrue(queue.submit(self.source))
+        self.assertFalse(queue.submit(os.path.join(self.config.media_path, 'photo.jpg')))
+        await self._run_until_done(queue)
+
+        target = os.path.join(self.config.media_path, 'clip.mp4')
+        self.assertEqual(self._read_media_file(), [target])
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(os.path.getmtime(target), mtime)
+        self.assertEqual(self.storage.media_index.find_by_encrypted_hash('encrypted'), target)
+        self.assertEqual(queue.metrics.transcoded_files.value, 1)
+
+    async def test_that_an_interrupted_job_is_continued_after_a_restart(self):
+        self.storage.media_index.transcode_add(self.source)
+        self.storage.media_index.transcode_set_state(self.source, RUNNING)
+        queue = TranscodeQueue(self.config, MagicMock(), self.storage)
+
+        await self._run_until_done(queue)
+
+        self.assertEqual(self._read_media_file(),
+                         [os.path.join(self.config.media_path, 'clip.mp4')])
+
+    async def test_that_a_failed_job_keeps_the_original(self):
+        self.config = self.config._replace(transcode=self.config.transcode._replace(
+            ffmpeg_parameters=['--fail']))
+        queue = TranscodeQueue(self.config, MagicMock(), self.storage)
+
+        queue.submit(self.source)
+        await self._run_until_done(queue)
+
+        self.assertEqual(self._read_media_file(), [self.source])
+        self.assertEqual(queue.status(), 'clip.mov: failed, unknown encoder')